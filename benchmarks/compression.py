@@ -0,0 +1,104 @@
+"""
+Compares storing capture content compressed at several levels against storing
+it as text: the bytes sent to the database, the CPU time spent compressing and,
+with --insert, the latency of the insert.
+
+    python -m benchmarks.compression [--sizes 1000 1000000 100000000] [--levels gzip:1 gzip:6 zstd:3] [--insert]
+
+--insert writes rows to the Postgres configured by DB_HOST, DB_PORT, DB_NAME,
+DB_USER and DB_PASSWORD, which needs the capture.json_data table of
+benchmarks/schema.sql. zstd levels are skipped unless zstandard is installed.
+"""
+import argparse
+import gc
+import json
+import time
+
+from src.etl.compression import compress, encodings
+
+from .insert import capture_datum, insert
+from .payloads import human_size
+
+DEFAULT_SIZES = [1000, 1000000, 10000000, 100000000]
+DEFAULT_LEVELS = ['gzip:1', 'gzip:6', 'gzip:9', 'zstd:1', 'zstd:3', 'zstd:9', 'zstd:19']
+
+
+def compress_seconds(text, encoding, level, repeat):
+    best, compressed = None, None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.process_time()
+        compressed = compress(text, encoding, level)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, compressed
+
+
+def insert_seconds(rds, datum, encoding, level, repeat):
+    """ the best wall time of compressing and inserting the capture, or copying it in as text """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        if encoding is None:
+            insert(rds, 'copied', datum)
+        else:
+            compressed = compress(datum.content, encoding, level)
+            params = rds._attribute_params(datum, datum.api)
+            rds._prepare('compressed_content_stage', 'insert_compressed_json_data_from_stage')
+            rds._insert_once(datum, lambda: rds._insert_compressed(compressed, params))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--levels', nargs='+', default=DEFAULT_LEVELS, help='encoding:level to compare')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--insert', action='store_true', help='also time inserting into the database')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    levels = [(None, None)]
+    for option in args.levels:
+        encoding, _, level = option.partition(':')
+        if encoding in encodings():
+            levels.append((encoding, int(level) if level else None))
+        else:
+            print(f'skipping {option}, {encoding} is not available')
+    rds = None
+    if args.insert:
+        from src.etl.rds import RDS
+        rds = RDS(dedup=False)
+
+    results = []
+    print(f'{"size":>10} {"encoding":>10} {"sent MB":>10} {"ratio":>8} {"cpu ms":>10} {"MB/s":>10} {"insert ms":>10}')
+    try:
+        for size in args.sizes:
+            datum = capture_datum(size)
+            raw_size = len(datum.content.encode('utf-8'))
+            repeat = args.repeat if size < 10000000 else 1
+            for encoding, level in levels:
+                if encoding is None:
+                    name, seconds, sent = 'none', 0.0, raw_size
+                else:
+                    name = f'{encoding}:{level}' if level is not None else encoding
+                    seconds, compressed = compress_seconds(datum.content, encoding, level, repeat)
+                    sent = compressed.size
+                inserted = insert_seconds(rds, datum, encoding, level, repeat) if rds else None
+                results.append({'size': raw_size, 'encoding': name, 'sent_bytes': sent,
+                                'cpu_seconds': seconds, 'insert_seconds': inserted})
+                print(f'{human_size(raw_size):>10} {name:>10} {sent / 1e6:>10.3f} {raw_size / sent:>8.1f} '
+                      f'{seconds * 1000:>10.2f} {raw_size / 1e6 / max(seconds, 1e-9) if seconds else 0:>10.1f} '
+                      f'{inserted * 1000 if inserted is not None else float("nan"):>10.2f}')
+    finally:
+        if rds:
+            rds.disconnect()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
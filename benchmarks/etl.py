@@ -0,0 +1,176 @@
+"""
+Runs etl() end to end across capture sizes and reports throughput, latency
+percentiles and peak RSS for each size.
+
+Captures are written to a directory standing in for S3 (S3_LOCAL_ROOT) and
+loaded into the Postgres configured by DB_HOST, DB_PORT, DB_NAME, DB_USER and
+DB_PASSWORD, which needs a capture.json_data table (see benchmarks/schema.sql,
+applied with --create-schema). Each size runs in a fresh process so that its
+peak RSS is its own.
+
+    python -m benchmarks.etl --sizes 1000 1000000 100000000 --output results.json
+    python -m benchmarks.etl --baseline results.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from multiprocessing import get_context
+
+from .payloads import capture, human_size, percentile, s3_event
+
+DEFAULT_SIZES = [1000, 100000, 1000000, 10000000, 25000000, 50000000, 100000000, 150000000]
+BUCKET = 'benchmark-bucket'
+SCHEMA = os.path.join(os.path.dirname(__file__), 'schema.sql')
+# Lambda memory is allocated in 1 MB steps, leave this much headroom over the measured peak
+HEADROOM = 1.25
+
+
+def create_schema():
+    from src.etl.rds import RDS
+    rds = RDS()
+    with open(SCHEMA) as f:
+        rds.cursor.execute(f.read())
+    rds.disconnect()
+
+
+def write_captures(root, size, count):
+    from src.etl.local_s3 import LocalS3Client
+    client = LocalS3Client(root)
+    events = []
+    for _ in range(count):
+        key = f'benchmark/{size}/body_{uuid.uuid4()}.json'
+        body = capture(size)
+        client.put_object(Bucket=BUCKET, Key=key, Body=body)
+        events.append(s3_event(BUCKET, key, len(body)))
+    return events
+
+
+def run_size(root, events, mode):
+    """
+    loads the events in this process, which is fresh for each size
+    """
+    from src.etl.config import CONFIG
+    from src.etl.metrics import max_rss
+    from src.load import etl
+
+    CONFIG['aws']['s3-local-root'] = root
+
+    baseline_rss = max_rss()
+    latencies = []
+    stages = {}
+    out = io.StringIO()
+    for event in events:
+        start = time.perf_counter()
+        with redirect_stdout(out):
+            etl(event, mode)
+        latencies.append(time.perf_counter() - start)
+    for line in out.getvalue().splitlines():
+        document = json.loads(line)
+        for name, value in document.items():
+            if name.endswith('_ms') and name != 'total_ms':
+                stages[name[:-3]] = stages.get(name[:-3], 0.0) + value / len(events)
+    return {'latencies': latencies, 'peak_rss': max_rss(), 'baseline_rss': baseline_rss, 'stages_ms': stages}
+
+
+def summarize(size, mode, events, run):
+    total_bytes = sum(event['Record']['s3']['object']['size'] for event in events)
+    seconds = sum(run['latencies'])
+    latencies_ms = [latency * 1000 for latency in run['latencies']]
+    return {
+        'size': size,
+        'mode': mode,
+        'records': len(events),
+        'bytes': total_bytes,
+        'seconds': seconds,
+        'mb_per_s': total_bytes / 1e6 / seconds,
+        'records_per_s': len(events) / seconds,
+        'latency_ms': {
+            'p50': percentile(latencies_ms, 0.5),
+            'p90': percentile(latencies_ms, 0.9),
+            'p99': percentile(latencies_ms, 0.99),
+            'max': max(latencies_ms),
+        },
+        'peak_rss': run['peak_rss'],
+        'baseline_rss': run['baseline_rss'],
+        'suggested_memory_mb': int(run['peak_rss'] * HEADROOM / 2 ** 20) + 1,
+        'stages_ms': run['stages_ms'],
+    }
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {(r['size'], r['mode']): r for r in json.load(f)['results']}
+    print(f'\nchange against {baseline_path}')
+    print(f'{"size":>10} {"mode":>7} {"MB/s":>9} {"p50":>9} {"peak RSS":>9}')
+    for result in results:
+        before = baseline.get((result['size'], result['mode']))
+        if before is None:
+            continue
+
+        def change(after, earlier):
+            return f'{(after - earlier) / earlier * 100:+.1f}%'
+
+        print(f'{human_size(result["size"]):>10} {result["mode"]:>7} '
+              f'{change(result["mb_per_s"], before["mb_per_s"]):>9} '
+              f'{change(result["latency_ms"]["p50"], before["latency_ms"]["p50"]):>9} '
+              f'{change(result["peak_rss"], before["peak_rss"]):>9}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--modes', nargs='+', choices=['memory', 'buffer', 'spill', 'stream'],
+                        default=['memory', 'buffer', 'spill', 'stream'])
+    parser.add_argument('--records', type=int, default=None,
+                        help='captures loaded per size, by default more for small sizes than large')
+    parser.add_argument('--s3-root', help='directory standing in for S3, a temporary one by default')
+    parser.add_argument('--create-schema', action='store_true', help='create capture.json_data if it is missing')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='compare the results against an earlier output file')
+    args = parser.parse_args()
+
+    if args.create_schema:
+        create_schema()
+    temporary = None if args.s3_root else tempfile.TemporaryDirectory()
+    root = args.s3_root or temporary.name
+    results = []
+    print(f'{"size":>10} {"mode":>7} {"MB/s":>9} {"rec/s":>9} {"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9} '
+          f'{"peak RSS":>10} {"suggest":>8}')
+    try:
+        for size in args.sizes:
+            count = args.records or max(3, min(100, 10000000 // size))
+            events = write_captures(root, size, count)
+            for mode in args.modes:
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+                    run = pool.submit(run_size, root, events, mode).result()
+                result = summarize(size, mode, events, run)
+                results.append(result)
+                latency = result['latency_ms']
+                print(f'{human_size(size):>10} {mode:>7} {result["mb_per_s"]:>9.1f} {result["records_per_s"]:>9.1f} '
+                      f'{latency["p50"]:>9.1f} {latency["p90"]:>9.1f} {latency["p99"]:>9.1f} '
+                      f'{human_size(result["peak_rss"]):>10} {result["suggested_memory_mb"]:>6}MB')
+    finally:
+        if temporary:
+            temporary.cleanup()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': sys.version,
+                'platform': platform.platform(),
+                'results': results,
+            }, f, indent=2)
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Compares checking that the content and parameters of a capture are JSON here
+before inserting it against leaving the check to the database, which casts
+them to jsonb as the row is inserted (JSON_VALIDATOR=jsonb). For each it
+reports the CPU time spent in this process and the latency of persist_data.
+
+    python -m benchmarks.ingest [--sizes 1000 1000000 100000000] [--validators scan jsonb] [--count 100]
+
+Rows are inserted into the Postgres configured by DB_HOST, DB_PORT, DB_NAME,
+DB_USER and DB_PASSWORD, which needs a capture.json_data table (see
+benchmarks/schema.sql). The database's own time shows in the latency only.
+"""
+import argparse
+import json
+import time
+
+from .insert import capture_datum
+from .payloads import human_size, percentile
+
+DEFAULT_SIZES = [1000, 100000, 1000000, 10000000, 100000000]
+DEFAULT_VALIDATORS = ['scan', 'jsonb']
+
+
+def run(rds, datum, count):
+    """ the CPU seconds used here and the latency of each of count loads of datum """
+    cpu, latencies = 0.0, []
+    for _ in range(count):
+        start, start_cpu = time.perf_counter(), time.process_time()
+        rds.persist_data(datum)
+        cpu += time.process_time() - start_cpu
+        latencies.append(time.perf_counter() - start)
+    return cpu, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--validators', nargs='+', default=DEFAULT_VALIDATORS,
+                        help='JSON_VALIDATOR values to compare, jsonb leaves the check to the database')
+    parser.add_argument('--count', type=int, default=100, help='loads of each size below 1 MB')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    from src.etl.rds import RDS
+    connections = {name: RDS(json_validator=name, dedup=False, compression='') for name in args.validators}
+    results = []
+    print(f'{"size":>10} {"validator":>10} {"cpu ms":>10} {"p50 ms":>10} {"p99 ms":>10}')
+    try:
+        for size in args.sizes:
+            datum = capture_datum(size)
+            count = args.count if size < 1000000 else max(args.count * 1000000 // size, 3)
+            for name, rds in connections.items():
+                # the first load prepares the statements, leave it out
+                rds.persist_data(datum)
+                cpu, latencies = run(rds, datum, count)
+                results.append({'size': len(datum.content), 'validator': name, 'count': count,
+                                'cpu_seconds': cpu / count, 'p50_seconds': percentile(latencies, 0.5),
+                                'p99_seconds': percentile(latencies, 0.99)})
+                print(f'{human_size(len(datum.content)):>10} {name:>10} {cpu / count * 1000:>10.2f} '
+                      f'{percentile(latencies, 0.5) * 1000:>10.2f} {percentile(latencies, 0.99) * 1000:>10.2f}')
+    finally:
+        for rds in connections.values():
+            rds.disconnect()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Compares the ways a capture row can be sent to the database: the INSERT with
+the content interpolated into its text, the prepared insert run with EXECUTE,
+and the content copied into the staging table ahead of the prepared insert.
+
+    python -m benchmarks.insert [--sizes 1000 1000000 100000000] [--count 200] [--output results.json]
+
+Rows are inserted into the Postgres configured by DB_HOST, DB_PORT, DB_NAME,
+DB_USER and DB_PASSWORD, which needs a capture.json_data table (see
+benchmarks/schema.sql). Each insert is committed on its own, as a load is.
+"""
+import argparse
+import json
+import time
+from types import SimpleNamespace
+
+from .payloads import content, human_size, metadata, percentile
+
+DEFAULT_SIZES = [1000, 100000, 1000000, 10000000, 100000000]
+METHODS = ['interpolated', 'prepared', 'copied']
+
+
+def capture_datum(size):
+    fields = {name: value['StringValue'] for name, value in metadata().items()}
+    return SimpleNamespace(
+        start_time=fields['StartTime'], response_time=fields['ResponseTime'],
+        response_code=fields['ResponseCode'], url=fields['URL'], api=fields['API'],
+        script_name=fields['ScriptName'], script_pid=fields['PID'], parameters=fields['Parameters'],
+        content=content(size))
+
+
+def insert(rds, method, datum):
+    from src.etl.rds import EXECUTE_INSERT_JSON_DATA, INSERT_JSON_DATA
+    params = rds._attribute_params(datum, datum.api)
+    if method == 'interpolated':
+        return rds._insert_once(datum, lambda: rds._fetch(INSERT_JSON_DATA, params + (datum.content,)))
+    if method == 'prepared':
+        rds._prepare('insert_json_data')
+        return rds._insert_once(datum, lambda: rds._fetch(EXECUTE_INSERT_JSON_DATA, params + (datum.content,)))
+    rds._prepare('json_content_stage', 'insert_json_data_from_stage')
+    return rds._insert_once(datum, lambda: rds._insert_copied(datum.content, params))
+
+
+def run(rds, method, datum, count):
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        insert(rds, method, datum)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--methods', nargs='+', choices=METHODS, default=METHODS)
+    parser.add_argument('--count', type=int, default=200, help='inserts of each size below 1 MB')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    from src.etl.rds import RDS
+    rds = RDS(dedup=False)
+    results = []
+    print(f'{"size":>10} {"method":>12} {"records/s":>10} {"MB/s":>10} {"p50 ms":>10} {"p99 ms":>10}')
+    try:
+        for size in args.sizes:
+            datum = capture_datum(size)
+            count = args.count if size < 1000000 else max(args.count * 1000000 // size, 3)
+            for method in args.methods:
+                # the first insert prepares the statements, leave it out
+                insert(rds, method, datum)
+                latencies = run(rds, method, datum, count)
+                seconds = sum(latencies)
+                results.append({'size': len(datum.content), 'method': method, 'count': count,
+                                'seconds': seconds, 'p50_seconds': percentile(latencies, 0.5),
+                                'p99_seconds': percentile(latencies, 0.99)})
+                print(f'{human_size(len(datum.content)):>10} {method:>12} {count / seconds:>10.1f} '
+                      f'{count * len(datum.content) / 1e6 / seconds:>10.1f} '
+                      f'{percentile(latencies, 0.5) * 1000:>10.2f} {percentile(latencies, 0.99) * 1000:>10.2f}')
+    finally:
+        rds.disconnect()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
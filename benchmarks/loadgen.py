@@ -0,0 +1,226 @@
+"""
+Replays S3 event traffic through lambda_handler from many processes at once,
+each standing in for a warm Lambda container with its own database connection,
+to find how much concurrency the database takes before loads slow down or fail.
+
+    python -m benchmarks.loadgen --tier iowCaptureExtraSmall --records 1000
+    python -m benchmarks.loadgen --concurrency 5 10 20 50 --sizes 1000 100000 --output loadgen.json
+    python -m benchmarks.loadgen --events recorded.jsonl --s3-root captures --concurrency 15
+
+Captures are read from a directory standing in for S3 (S3_LOCAL_ROOT) and
+loaded into the Postgres configured by DB_HOST, DB_PORT, DB_NAME, DB_USER and
+DB_PASSWORD (--create-schema creates a stand-in capture.json_data). Synthetic
+captures are written afresh for each concurrency level, so the loads of one
+level are never duplicates of another's. Recorded events are given as JSON
+lines, each a {"Record": ...} event or an S3 notification, and their objects
+must already be under --s3-root; set DEDUP_LOADS=false to replay them at more
+than one level.
+
+While the loads run the database is sampled for its connections, the sessions
+waiting on a lock, and those waiting on a lock on capture.json_data.
+"""
+import argparse
+import io
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from multiprocessing import get_context
+
+from .etl import BUCKET, create_schema, write_captures
+from .payloads import human_size, percentile
+
+# the memory size and reserved concurrency of each function in serverless.yml
+TIERS = {
+    'iowCaptureExtraSmall': (256, 50),
+    'iowCaptureSmall': (512, 15),
+    'iowCapture': (1024, 5),
+    'iowCaptureMedium': (1536, 5),
+}
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+SAMPLE_CONNECTIONS = 'SELECT count(*) FROM pg_stat_activity WHERE datname = current_database()'
+SAMPLE_LOCK_WAITS = """
+    SELECT count(*), count(*) FILTER (WHERE l.relation = 'capture.json_data'::regclass)
+    FROM pg_locks l WHERE NOT l.granted"""
+
+
+def start_container(root, memory_size):
+    """ makes a pool process look like a Lambda container of the tier """
+    from src.etl.config import CONFIG
+    CONFIG['aws']['s3-local-root'] = root
+    if memory_size:
+        CONFIG['load']['memory_size'] = str(memory_size)
+
+
+def warm(_):
+    """ imports the handler, taking long enough that every process of the pool gets one of these """
+    from src.load import lambda_handler  # noqa: F401
+    time.sleep(0.2)
+
+
+def invoke(event):
+    """ runs one event through the handler, returning its latency, the error it raised if any, and the process """
+    from src.load import lambda_handler
+    error = None
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        try:
+            lambda_handler(event, None)
+        except Exception as e:
+            error = type(e).__name__
+    return time.perf_counter() - start, error, os.getpid()
+
+
+class DatabaseSampler(threading.Thread):
+    """ samples the connections and lock waits of the database every interval seconds until stopped """
+
+    def __init__(self, interval):
+        super().__init__(daemon=True)
+        from src.etl.rds import RDS
+        self.rds = RDS(dedup=False)
+        self.interval = interval
+        self.samples = []
+        self.stopping = threading.Event()
+
+    def run(self):
+        cursor = self.rds.cursor
+        while not self.stopping.is_set():
+            cursor.execute(SAMPLE_CONNECTIONS)
+            connections = cursor.fetchone()[0]
+            cursor.execute(SAMPLE_LOCK_WAITS)
+            waiting, waiting_json_data = cursor.fetchone()
+            self.samples.append((connections, waiting, waiting_json_data))
+            self.stopping.wait(self.interval)
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+        self.rds.disconnect()
+
+    def summary(self):
+        samples = self.samples or [(0, 0, 0)]
+        columns = list(zip(*samples))
+        return {
+            'connections_max': max(columns[0]),
+            'lock_waits_max': max(columns[1]),
+            'lock_waits_mean': sum(columns[1]) / len(samples),
+            'json_data_lock_waits_max': max(columns[2]),
+            'samples': len(self.samples),
+        }
+
+
+def recorded_events(path):
+    """ the events of a JSON lines file, one per record """
+    events = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            records = event['Records'] if 'Records' in event else [event['Record']]
+            events.extend({'Record': record} for record in records)
+    return events
+
+
+def synthetic_events(root, sizes, records):
+    """ records captures spread evenly over sizes, written under root """
+    per_size = -(-records // len(sizes))
+    # interleaved so that every size is being loaded throughout
+    by_size = [write_captures(root, size, per_size) for size in sizes]
+    return list(itertools.chain.from_iterable(zip(*by_size)))[:records]
+
+
+def run_level(root, events, concurrency, memory_size, sample_interval):
+    sampler = DatabaseSampler(sample_interval)
+    with ProcessPoolExecutor(max_workers=concurrency, mp_context=get_context('spawn'),
+                             initializer=start_container, initargs=(root, memory_size)) as pool:
+        # start every container and let it import the handler before the clock starts
+        list(pool.map(warm, range(concurrency)))
+        sampler.start()
+        start = time.perf_counter()
+        outcomes = list(pool.map(invoke, events))
+        seconds = time.perf_counter() - start
+    sampler.stop()
+
+    latencies_ms = [latency * 1000 for latency, _, _ in outcomes]
+    errors = {}
+    for _, error, _ in outcomes:
+        if error is not None:
+            errors[error] = errors.get(error, 0) + 1
+    total_bytes = sum(int(event['Record']['s3']['object'].get('size', 0)) for event in events)
+    result = {
+        'concurrency': concurrency,
+        'records': len(events),
+        'bytes': total_bytes,
+        'seconds': seconds,
+        'records_per_s': len(events) / seconds,
+        'mb_per_s': total_bytes / 1e6 / seconds,
+        'latency_ms': {
+            'p50': percentile(latencies_ms, 0.5),
+            'p90': percentile(latencies_ms, 0.9),
+            'p99': percentile(latencies_ms, 0.99),
+            'max': max(latencies_ms),
+        },
+        'errors': errors,
+        'processes': len({pid for _, _, pid in outcomes}),
+    }
+    result.update(sampler.summary())
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tier', choices=sorted(TIERS), help='run at the memory size and concurrency of a function')
+    parser.add_argument('--concurrency', type=int, nargs='+', help='concurrency levels to run at, in turn')
+    parser.add_argument('--memory-size', type=int, help='the memory size of the function in MB')
+    parser.add_argument('--events', help='JSON lines of recorded events to replay rather than synthetic captures')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='sizes of synthetic captures')
+    parser.add_argument('--records', type=int, default=500, help='synthetic captures loaded at each level')
+    parser.add_argument('--s3-root', help='directory standing in for S3, a temporary one by default')
+    parser.add_argument('--sample-interval', type=float, default=0.25, help='seconds between database samples')
+    parser.add_argument('--create-schema', action='store_true', help='create capture.json_data if it is missing')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    memory_size, tier_concurrency = TIERS[args.tier] if args.tier else (None, 50)
+    memory_size = args.memory_size or memory_size
+    levels = args.concurrency or [tier_concurrency]
+    if args.events and not args.s3_root:
+        parser.error('--events needs the --s3-root their objects are under')
+
+    if args.create_schema:
+        create_schema()
+    temporary = None if args.s3_root else tempfile.TemporaryDirectory()
+    root = args.s3_root or temporary.name
+    recorded = recorded_events(args.events) if args.events else None
+    results = []
+    print(f'{"conc":>5} {"rec/s":>8} {"MB/s":>8} {"p50 ms":>8} {"p99 ms":>8} {"max ms":>8} '
+          f'{"conns":>6} {"waits":>6} {"on table":>8} {"errors":>7}')
+    try:
+        for concurrency in levels:
+            events = recorded or synthetic_events(root, args.sizes, args.records)
+            result = run_level(root, events, concurrency, memory_size, args.sample_interval)
+            results.append(result)
+            latency = result['latency_ms']
+            print(f'{concurrency:>5} {result["records_per_s"]:>8.1f} {result["mb_per_s"]:>8.2f} '
+                  f'{latency["p50"]:>8.1f} {latency["p99"]:>8.1f} {latency["max"]:>8.1f} '
+                  f'{result["connections_max"]:>6} {result["lock_waits_max"]:>6} '
+                  f'{result["json_data_lock_waits_max"]:>8} {sum(result["errors"].values()):>7}')
+    finally:
+        if temporary:
+            temporary.cleanup()
+
+    if not recorded:
+        print(f'\nsynthetic captures of {", ".join(human_size(size) for size in args.sizes)} in bucket {BUCKET}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'tier': args.tier, 'memory_size': memory_size, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Compares storing the url, api, script_name and parameters of each capture in
+its row against storing their ids from capture.json_data_lookup
+(ATTRIBUTE_LOOKUPS=true), by the width of the rows, the WAL written for each
+insert and the latency of the inserts.
+
+    python -m benchmarks.lookups [--sizes 100 1000 10000] [--count 500] [--calls 200]
+
+Captures cycle through --calls distinct calls, as the retriever repeats the
+same calls, and each call is loaded once before timing so that the ids of its
+values are cached as they would be in a warm container. Rows are inserted
+into the Postgres configured by DB_HOST, DB_PORT, DB_NAME, DB_USER and
+DB_PASSWORD, whose capture.json_data needs the columns added by
+migrations/003_json_data_lookup.sql; --create-schema runs it. The WAL is measured
+over the whole server, so run it where nothing else is writing.
+"""
+import argparse
+import json
+import os
+import time
+from types import SimpleNamespace
+
+from .insert import capture_datum
+from .payloads import human_size, percentile
+
+SCHEMA = os.path.join(os.path.dirname(__file__), os.pardir, 'migrations', '003_json_data_lookup.sql')
+DEFAULT_SIZES = [100, 1000, 10000]
+METHODS = {'values': False, 'lookups': True}
+
+SELECT_WAL_LSN = "SELECT pg_current_wal_lsn();"
+SELECT_WAL_BYTES = "SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), %s);"
+SELECT_ROW_WIDTH = "SELECT avg(pg_column_size(j.*)) FROM capture.json_data j WHERE json_data_id = ANY(%s);"
+
+
+def calls(datum, count):
+    """ count captures of datum, each making a call of its own """
+    captures = []
+    for i in range(count):
+        unique_id = f'{i:032x}'
+        parameters = json.dumps({'TimeSeriesUniqueId': unique_id, 'QueryFrom': '2020-01-01T00:00:00-06:00',
+                                 'QueryTo': '2020-02-01T00:00:00-06:00', 'ApplyRounding': True})
+        captures.append(SimpleNamespace(**dict(vars(datum), url=f'{datum.url}?TimeSeriesUniqueId={unique_id}',
+                                               parameters=parameters)))
+    return captures
+
+
+def run(rds, captures, count):
+    latencies = []
+    ids = []
+    for i in range(count):
+        start = time.perf_counter()
+        ids.append(rds.persist_data(captures[i % len(captures)])[0])
+        latencies.append(time.perf_counter() - start)
+    return latencies, ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='sizes of the content')
+    parser.add_argument('--count', type=int, default=500, help='inserts of each size by each method')
+    parser.add_argument('--calls', type=int, default=200, help='distinct calls the captures cycle through')
+    parser.add_argument('--create-schema', action='store_true', help='add the lookup table, columns and view')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    from src.etl.lookups import LOOKUP_STATS
+    from src.etl.rds import RDS
+    connections = {name: RDS(dedup=False, attribute_lookups=lookups) for name, lookups in METHODS.items()}
+    cursor = connections['values'].cursor
+    if args.create_schema:
+        with open(SCHEMA) as f:
+            cursor.execute(f.read())
+    results = []
+    print(f'{"content":>10} {"method":>8} {"row bytes":>10} {"WAL/insert":>11} {"records/s":>10} '
+          f'{"p50 ms":>10} {"p99 ms":>10}')
+    try:
+        for size in args.sizes:
+            captures = calls(capture_datum(size), args.calls)
+            for name, rds in connections.items():
+                # every call once first, which prepares the statements and caches the ids of its values
+                run(rds, captures, len(captures))
+                cursor.execute(SELECT_WAL_LSN)
+                start_lsn = cursor.fetchone()[0]
+                latencies, ids = run(rds, captures, args.count)
+                cursor.execute(SELECT_WAL_BYTES, (start_lsn,))
+                wal_bytes = float(cursor.fetchone()[0]) / args.count
+                cursor.execute(SELECT_ROW_WIDTH, (ids,))
+                row_bytes = float(cursor.fetchone()[0])
+                seconds = sum(latencies)
+                results.append({'size': len(captures[0].content), 'method': name, 'count': args.count,
+                                'row_bytes': row_bytes, 'wal_bytes_per_insert': wal_bytes, 'seconds': seconds,
+                                'p50_seconds': percentile(latencies, 0.5),
+                                'p99_seconds': percentile(latencies, 0.99)})
+                print(f'{human_size(len(captures[0].content)):>10} {name:>8} {row_bytes:>10.0f} {wal_bytes:>11.0f} '
+                      f'{args.count / seconds:>10.1f} {percentile(latencies, 0.5) * 1000:>10.2f} '
+                      f'{percentile(latencies, 0.99) * 1000:>10.2f}')
+    finally:
+        for rds in connections.values():
+            rds.disconnect()
+    print(f'\nlookup cache hits: {LOOKUP_STATS["hits"]}, misses: {LOOKUP_STATS["misses"]}, '
+          f'values added: {LOOKUP_STATS["added"]}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
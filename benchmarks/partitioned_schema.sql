@@ -0,0 +1,31 @@
+-- a stand-in for capture.json_data partitioned by month of start_time over 2020, for a database of its own
+CREATE SCHEMA IF NOT EXISTS capture;
+
+CREATE TABLE IF NOT EXISTS capture.json_data (
+    json_data_id bigserial NOT NULL,
+    partition_number integer NOT NULL DEFAULT 1,
+    start_time timestamp NOT NULL,
+    response_time timestamp NOT NULL,
+    response_code integer NOT NULL,
+    url text NOT NULL,
+    api text NOT NULL,
+    script_name text,
+    script_pid integer,
+    parameters text,
+    json_content text,
+    json_content_compressed bytea,
+    content_encoding text,
+    PRIMARY KEY (json_data_id, start_time)
+) PARTITION BY RANGE (start_time);
+
+DO $$
+BEGIN
+    FOR month IN 1..12 LOOP
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS capture.json_data_2020_%s PARTITION OF capture.json_data '
+            'FOR VALUES FROM (%L) TO (%L)',
+            lpad(month::text, 2, '0'),
+            make_timestamp(2020, month, 1, 0, 0, 0), make_timestamp(2020, month, 1, 0, 0, 0) + interval '1 month');
+    END LOOP;
+END
+$$;
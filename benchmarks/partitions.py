@@ -0,0 +1,94 @@
+"""
+Compares inserting batches of captures through the partitioned
+capture.json_data, which routes every row to its partition, against copying
+each batch straight into its partitions grouped by the partition of each row
+(PARTITION_ROUTING=true), for batches spread over more and more partitions.
+
+    python -m benchmarks.partitions [--partitions 1 4 12] [--batch-sizes 10 100 1000] [--size 10000]
+
+Rows are inserted into the Postgres configured by DB_HOST, DB_PORT, DB_NAME,
+DB_USER and DB_PASSWORD, which needs a capture.json_data partitioned by month
+of start_time over 2020. --create-schema creates one from
+benchmarks/partitioned_schema.sql, in a database without the unpartitioned
+stand-in of benchmarks/schema.sql.
+"""
+import argparse
+import datetime
+import json
+import os
+import time
+
+from .insert import capture_datum
+from .payloads import human_size, percentile
+
+SCHEMA = os.path.join(os.path.dirname(__file__), 'partitioned_schema.sql')
+DEFAULT_PARTITIONS = [1, 4, 12]
+DEFAULT_BATCH_SIZES = [10, 100, 1000]
+METHODS = {'table': False, 'partitions': True}
+
+
+def batch_rows(rds, datum, batch_size, partitions):
+    """ batch_size rows of datum, their start times spread over the first partitions months of 2020 """
+    row = rds._attribute_params(datum, datum.api) + (datum.content,)
+    return [(datetime.datetime(2020, 1 + i % partitions, 1 + i % 28),) + row[1:] for i in range(batch_size)]
+
+
+def run(rds, rows, count):
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        rds.persist_rows(rows)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--partitions', type=int, nargs='+', default=DEFAULT_PARTITIONS,
+                        help='how many partitions the rows of each batch are spread over, at most 12')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=DEFAULT_BATCH_SIZES)
+    parser.add_argument('--size', type=int, default=10000, help='the size of the content of each row')
+    parser.add_argument('--count', type=int, default=20, help='batches inserted of each kind')
+    parser.add_argument('--create-schema', action='store_true', help='create the partitioned capture.json_data')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    from src.etl.partitions import PARTITION_STATS
+    from src.etl.rds import RDS
+    connections = {name: RDS(dedup=False, partition_routing=routing) for name, routing in METHODS.items()}
+    if args.create_schema:
+        with open(SCHEMA) as f:
+            connections['table'].cursor.execute(f.read())
+    datum = capture_datum(args.size)
+    results = []
+    print(f'{"content":>10} {"batch":>6} {"parts":>6} {"method":>11} {"rows/s":>10} {"MB/s":>8} '
+          f'{"p50 ms":>10} {"p99 ms":>10}')
+    try:
+        for batch_size in args.batch_sizes:
+            for partitions in args.partitions:
+                rows = batch_rows(connections['table'], datum, batch_size, min(partitions, 12))
+                for name, rds in connections.items():
+                    # the first batch prepares the connection and reads the partition map, leave it out
+                    rds.persist_rows(rows)
+                    latencies = run(rds, rows, args.count)
+                    seconds = sum(latencies)
+                    results.append({'size': len(datum.content), 'batch_size': batch_size, 'partitions': partitions,
+                                    'method': name, 'count': args.count, 'seconds': seconds,
+                                    'p50_seconds': percentile(latencies, 0.5),
+                                    'p99_seconds': percentile(latencies, 0.99)})
+                    print(f'{human_size(len(datum.content)):>10} {batch_size:>6} {partitions:>6} {name:>11} '
+                          f'{args.count * batch_size / seconds:>10.1f} '
+                          f'{args.count * batch_size * len(datum.content) / 1e6 / seconds:>8.1f} '
+                          f'{percentile(latencies, 0.5) * 1000:>10.2f} {percentile(latencies, 0.99) * 1000:>10.2f}')
+    finally:
+        for rds in connections.values():
+            rds.disconnect()
+    print(f'\nrows copied into partitions: {PARTITION_STATS["routed"]}, '
+          f'inserted through the table: {PARTITION_STATS["unrouted"]}, map reads: {PARTITION_STATS["refreshes"]}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Synthetic captures in the shape the retriever writes to S3.
+"""
+import json
+import math
+import time
+
+POINT = ('{"Timestamp":"2020-01-01T00:%02d:00.0000000-06:00","Value":{"Display":"%d.%02d","Numeric":%d.%02d},'
+         '"GradeCode":50,"Qualifiers":[]}')
+API = 'GetTimeSeriesCorrectedData'
+URL = f'https://aquarius.example.gov/AQUARIUS/Publish/v2/{API}'
+
+
+def content(size):
+    """
+    AQTS style time series JSON of roughly size characters
+    """
+    head = '{"UniqueId":"4b9d9e6ba3e34e7b9f9d6b4c3b1a2e7f","Unit":"ft^3/s","Points":['
+    points = []
+    length = len(head) + 2
+    i = 0
+    while length < size:
+        point = POINT % (i % 60, i % 1000, i % 100, i % 1000, i % 100)
+        points.append(point)
+        length += len(point) + 1
+        i += 1
+    return head + ','.join(points) + ']}'
+
+
+def metadata(start_time=None, response_code='200'):
+    start_time = time.time() if start_time is None else start_time
+
+    def value(text):
+        return {'StringValue': str(text), 'DataType': 'String'}
+
+    return {
+        'URL': value(URL),
+        'API': value(API),
+        'Parameters': value(json.dumps({'TimeSeriesUniqueId': '4b9d9e6ba3e34e7b9f9d6b4c3b1a2e7f'})),
+        'StartTime': value(start_time),
+        'ResponseTime': value(start_time + 1.5),
+        'PID': value(24640),
+        'ScriptName': value('aqts-capture-retriever'),
+        'ResponseCode': value(response_code),
+    }
+
+
+def capture(size, **kwargs):
+    """
+    the bytes of a capture object whose content is roughly size characters
+    """
+    return json.dumps({'metadata': metadata(**kwargs), 'content': content(size)}).encode('utf-8')
+
+
+def human_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1000 or unit == 'GB':
+            return f'{size:g} {unit}'
+        size /= 1000
+
+
+def s3_event(bucket, key, size):
+    """ the event the loader is triggered with for an object """
+    return {
+        'Record': {
+            'eventSource': 'aws:s3',
+            'eventName': 'ObjectCreated:Put',
+            's3': {
+                'bucket': {'name': bucket, 'arn': f'arn:aws:s3:::{bucket}'},
+                'object': {'key': key, 'size': size},
+            }
+        }
+    }
+
+
+def percentile(values, fraction):
+    """ nearest rank percentile of a list of numbers """
+    ordered = sorted(values)
+    rank = max(math.ceil(fraction * len(ordered)) - 1, 0)
+    return ordered[rank]
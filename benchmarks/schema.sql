@@ -0,0 +1,19 @@
+-- a stand-in for the capture.json_data table, for loading into a local Postgres
+CREATE SCHEMA IF NOT EXISTS capture;
+
+CREATE TABLE IF NOT EXISTS capture.json_data (
+    json_data_id bigserial NOT NULL,
+    partition_number integer NOT NULL DEFAULT 1,
+    start_time timestamp NOT NULL,
+    response_time timestamp NOT NULL,
+    response_code integer NOT NULL,
+    url text NOT NULL,
+    api text NOT NULL,
+    script_name text,
+    script_pid integer,
+    parameters text,
+    json_content text,
+    json_content_compressed bytea,
+    content_encoding text,
+    PRIMARY KEY (json_data_id, partition_number)
+);
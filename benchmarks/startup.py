@@ -0,0 +1,89 @@
+"""
+Measures the cold start of the Lambda entry point: how long a fresh
+interpreter takes to import the handler module and to create the S3 client
+the first invocation needs, and which imports that time goes to.
+
+    python -m benchmarks.startup [--runs 10] [--module src.load] [--top 15] [--output startup.json]
+
+Each run is a new process started with -X importtime. No AWS call is made,
+creating the client only loads its service model.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+INIT = '''
+import json, time
+start = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+from src.etl.config import CONFIG
+from src.etl.s3 import get_client
+get_client(CONFIG['aws']['region'])
+created = time.perf_counter()
+print(json.dumps({{'import_ms': (imported - start) * 1000, 'client_ms': (created - imported) * 1000}}))
+'''
+
+
+def import_times(stderr):
+    """ the self and cumulative microseconds of each module from -X importtime output """
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(own), int(cumulative))
+    return times
+
+
+def cold_start(module):
+    """ the timings of one fresh process importing module and creating the S3 client """
+    environment = dict(os.environ, S3_LOCAL_ROOT='')
+    environment.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', INIT.format(module=module)],
+                               cwd=ROOT, env=environment, capture_output=True, text=True, check=True)
+    result = json.loads(completed.stdout.splitlines()[-1])
+    result['process_ms'] = (time.perf_counter() - start) * 1000
+    result['modules'] = import_times(completed.stderr)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--module', default='src.load', help='the module the Lambda handler lives in')
+    parser.add_argument('--top', type=int, default=15, help='how many of the slowest imports to list')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    runs = [cold_start(args.module) for _ in range(args.runs)]
+    summary = {}
+    print(f'{"":>12} {"median ms":>10} {"min ms":>10}')
+    for name in ('process_ms', 'import_ms', 'client_ms'):
+        values = [run[name] for run in runs]
+        summary[name] = {'median': statistics.median(values), 'min': min(values)}
+        print(f'{name[:-3]:>12} {summary[name]["median"]:>10.1f} {summary[name]["min"]:>10.1f}')
+
+    names = set.intersection(*(set(run['modules']) for run in runs))
+    own = {name: statistics.median(run['modules'][name][0] for run in runs) / 1000 for name in names}
+    cumulative = {name: statistics.median(run['modules'][name][1] for run in runs) / 1000 for name in names}
+    slowest = sorted(names, key=own.get, reverse=True)[:args.top]
+    print(f'\n{"self ms":>10} {"cumulative ms":>14}  module')
+    for name in slowest:
+        print(f'{own[name]:>10.2f} {cumulative[name]:>14.2f}  {name}')
+    summary['modules'] = [{'module': name, 'self_ms': own[name], 'cumulative_ms': cumulative[name]}
+                          for name in slowest]
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Compares the JSON validators behind RDS.validate_json.
+
+    python -m benchmarks.validate_json [--sizes 1000 1000000 100000000] [--output results.json]
+
+CPU time is measured without tracing, peak memory is measured separately with tracemalloc.
+"""
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+
+from src.etl.rds import JSON_VALIDATORS
+
+from .payloads import content, human_size
+
+DEFAULT_SIZES = [1000, 1000000, 100000000]
+
+
+def cpu_seconds(validator, text, repeat):
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.process_time()
+        validator(text)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def peak_bytes(validator, text):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        validator(text)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--validators', nargs='+', default=sorted(JSON_VALIDATORS))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = []
+    print(f'{"size":>10} {"validator":>10} {"cpu ms":>10} {"MB/s":>10} {"peak MB":>10}')
+    for size in args.sizes:
+        text = content(size)
+        for name in args.validators:
+            validator = JSON_VALIDATORS[name]
+            seconds = cpu_seconds(validator, text, args.repeat if size < 10000000 else 1)
+            peak = peak_bytes(validator, text)
+            results.append({'size': len(text), 'validator': name, 'cpu_seconds': seconds, 'peak_bytes': peak})
+            print(f'{human_size(len(text)):>10} {name:>10} {seconds * 1000:>10.2f} '
+                  f'{len(text) / 1e6 / max(seconds, 1e-9):>10.1f} {peak / 1e6:>10.2f}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+-- the captures already loaded, by the uuid of their S3 object, for DEDUP_LOADS=true. run as the schema owner
+-- before turning DEDUP_LOADS on, the function does not create it
+CREATE TABLE IF NOT EXISTS capture.json_data_load
+(uuid text PRIMARY KEY, content_hash text, json_data_id bigint, partition_number integer,
+ loaded_at timestamp NOT NULL DEFAULT now());
@@ -0,0 +1,5 @@
+-- the captures lambda_handler failed to load, for DEAD_LETTER_SPOOL=table. run as the schema owner before
+-- spooling to the table, the function does not create it
+CREATE TABLE IF NOT EXISTS capture.json_data_failure
+(json_data_failure_id bigserial PRIMARY KEY, failed_at timestamp NOT NULL,
+ stage text NOT NULL, error text NOT NULL, message text, record text NOT NULL);
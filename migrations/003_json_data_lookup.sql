@@ -0,0 +1,28 @@
+-- stores the url, api, script_name and parameters of captures loaded with ATTRIBUTE_LOOKUPS=true by id, and reads
+-- every capture through capture.json_data_expanded whichever way it was stored. run as the schema owner before
+-- turning ATTRIBUTE_LOOKUPS on, the function does not create the table or its index
+CREATE TABLE IF NOT EXISTS capture.json_data_lookup
+(lookup_id serial PRIMARY KEY, attribute text NOT NULL, value text NOT NULL);
+CREATE UNIQUE INDEX IF NOT EXISTS json_data_lookup_value ON capture.json_data_lookup (attribute, md5(value));
+
+ALTER TABLE capture.json_data
+    ALTER COLUMN url DROP NOT NULL,
+    ALTER COLUMN api DROP NOT NULL,
+    ADD COLUMN IF NOT EXISTS url_id integer REFERENCES capture.json_data_lookup (lookup_id),
+    ADD COLUMN IF NOT EXISTS api_id integer REFERENCES capture.json_data_lookup (lookup_id),
+    ADD COLUMN IF NOT EXISTS script_name_id integer REFERENCES capture.json_data_lookup (lookup_id),
+    ADD COLUMN IF NOT EXISTS parameters_id integer REFERENCES capture.json_data_lookup (lookup_id);
+
+CREATE OR REPLACE VIEW capture.json_data_expanded AS
+SELECT j.json_data_id, j.partition_number, j.start_time, j.response_time, j.response_code,
+       coalesce(j.url, url.value) AS url,
+       coalesce(j.api, api.value) AS api,
+       coalesce(j.script_name, script_name.value) AS script_name,
+       j.script_pid,
+       coalesce(j.parameters, parameters.value) AS parameters,
+       j.json_content, j.json_content_compressed, j.content_encoding
+FROM capture.json_data j
+LEFT JOIN capture.json_data_lookup url ON url.lookup_id = j.url_id
+LEFT JOIN capture.json_data_lookup api ON api.lookup_id = j.api_id
+LEFT JOIN capture.json_data_lookup script_name ON script_name.lookup_id = j.script_name_id
+LEFT JOIN capture.json_data_lookup parameters ON parameters.lookup_id = j.parameters_id;
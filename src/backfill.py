@@ -0,0 +1,212 @@
+"""
+Reloads the captures under an S3 prefix, for example to replay a day of
+captures, without re-firing S3 events one Lambda at a time.
+
+    python -m src.backfill BUCKET PREFIX [--workers 8] [--connections 4] [--rate 20]
+                                         [--checkpoint backfill.json] [--stream]
+
+Keys are loaded in key order by a bounded pool of worker threads that share a
+small pool of database connections. The checkpoint records the last key
+before which every key has been dealt with, and the keys that failed to load,
+so an interrupted run started again with the same checkpoint retries those
+keys and resumes from there.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .etl.config import CONFIG
+from .etl.rds import RdsPool
+from .etl.s3 import S3
+from .load import MEMORY, STREAM, load_record
+
+log_level = os.getenv('LOG_LEVEL', logging.ERROR)
+logger = logging.getLogger(__name__)
+logger.setLevel(log_level)
+
+
+def s3_record(bucket, key, size):
+    return {'Record': {'s3': {'bucket': {'name': bucket}, 'object': {'key': key, 'size': size}}}}
+
+
+class RateLimiter:
+    """ spaces calls to wait so that they start no more than rate times a second """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class Checkpoint:
+    """
+    tracks keys completed out of order and persists the last key before which
+    every key has been dealt with, along with the keys among them that failed
+    """
+
+    def __init__(self, path, bucket, prefix):
+        self.path = path
+        self.bucket = bucket
+        self.prefix = prefix
+        self.after = ''
+        self.loaded = 0
+        self.failed = 0
+        self.bytes = 0
+        # the size of each key that failed and has not loaded since, retried on resume
+        self.failures = {}
+        self._pending = deque()
+        self._done = set()
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if (saved['bucket'], saved['prefix']) != (bucket, prefix):
+                raise ValueError(f'{path} is the checkpoint of s3://{saved["bucket"]}/{saved["prefix"]}')
+            self.after = saved['after']
+            self.loaded, self.failed, self.bytes = saved['loaded'], saved['failed'], saved['bytes']
+            self.failures = saved.get('failures', {})
+
+    def started(self, key):
+        with self._lock:
+            self._pending.append(key)
+
+    def finished(self, key, size, error=None):
+        with self._lock:
+            # a key that failed before the checkpoint was resumed is not among those started
+            retried = key in self.failures
+            if error is None:
+                self.loaded += 1
+                self.bytes += size
+                if self.failures.pop(key, None) is not None:
+                    self.failed -= 1
+            elif not retried:
+                self.failed += 1
+                self.failures[key] = size
+            if retried:
+                self.save()
+                return
+            self._done.add(key)
+            advanced = False
+            while self._pending and self._pending[0] in self._done:
+                self.after = self._pending.popleft()
+                self._done.discard(self.after)
+                advanced = True
+            if advanced:
+                self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        temporary = f'{self.path}.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({'bucket': self.bucket, 'prefix': self.prefix, 'after': self.after,
+                       'loaded': self.loaded, 'failed': self.failed, 'bytes': self.bytes,
+                       'failures': self.failures}, f)
+        os.replace(temporary, self.path)
+
+
+class Backfill:
+
+    def __init__(self, bucket, prefix, workers=8, connections=4, rate=None, checkpoint=None, stream=False,
+                 report_interval=10.0, out=sys.stderr):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.workers = workers
+        self.pool = RdsPool(min(connections, workers))
+        self.limiter = RateLimiter(rate)
+        self.checkpoint = Checkpoint(checkpoint, bucket, prefix)
+        self.stream = stream
+        self.report_interval = report_interval
+        self.out = out
+        self._in_flight = threading.BoundedSemaphore(workers * 2)
+        self._started = None
+        self._start_counts = (0, 0)
+        self._last_report = 0.0
+
+    def _load(self, key, size):
+        error = None
+        try:
+            with self.pool.connection() as rds:
+                load_record(s3_record(self.bucket, key, size), rds, STREAM if self.stream else MEMORY)
+        except Exception as e:
+            error = e
+            logger.warning(f'Failed to load s3://{self.bucket}/{key}: {repr(e)}')
+            self.out.write(f'failed {key}: {repr(e)}\n')
+        finally:
+            self.checkpoint.finished(key, size, error)
+            self._in_flight.release()
+            self.report()
+
+    def report(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_report < self.report_interval:
+            return
+        self._last_report = now
+        elapsed = max(now - self._started, 1e-9)
+        records = self.checkpoint.loaded - self._start_counts[0]
+        size = self.checkpoint.bytes - self._start_counts[1]
+        self.out.write(f'loaded {self.checkpoint.loaded} failed {self.checkpoint.failed} '
+                       f'{records / elapsed:.1f} records/s {size / 1e6 / elapsed:.2f} MB/s '
+                       f'through {self.checkpoint.after or "(start)"}\n')
+
+    def run(self):
+        """
+        loads the keys that failed before the checkpoint and then every key under the prefix
+        after it, returns the checkpoint
+        """
+        s3 = S3(CONFIG['aws']['region'])
+        self._started = time.monotonic()
+        self._start_counts = (self.checkpoint.loaded, self.checkpoint.bytes)
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for key, size in list(self.checkpoint.failures.items()):
+                    self._in_flight.acquire()
+                    self.limiter.wait()
+                    executor.submit(self._load, key, size)
+                for key, size in s3.iter_objects(self.bucket, self.prefix, self.checkpoint.after):
+                    # keep the listing only a little ahead of the workers
+                    self._in_flight.acquire()
+                    self.limiter.wait()
+                    self.checkpoint.started(key)
+                    executor.submit(self._load, key, size)
+        finally:
+            self.pool.close()
+            self.report(force=True)
+        return self.checkpoint
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('bucket')
+    parser.add_argument('prefix')
+    parser.add_argument('--workers', type=int, default=8, help='captures loaded at once')
+    parser.add_argument('--connections', type=int, default=4, help='database connections shared by the workers')
+    parser.add_argument('--rate', type=float, help='most captures started per second')
+    parser.add_argument('--checkpoint', help='file recording progress, resumed from when it exists')
+    parser.add_argument('--stream', action='store_true', help='stream each capture rather than read it whole')
+    parser.add_argument('--report-interval', type=float, default=10.0, help='seconds between progress reports')
+    args = parser.parse_args(argv)
+
+    checkpoint = Backfill(args.bucket, args.prefix, args.workers, args.connections, args.rate, args.checkpoint,
+                          args.stream, args.report_interval).run()
+    return 1 if checkpoint.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,223 @@
+"""
+This module compresses capture content for storage as it is fed in pieces,
+and reads stored content back. It also recognises captured objects stored
+compressed in S3 and decompresses them a piece at a time.
+
+gzip is always available, zstd when the zstandard package is installed.
+"""
+import gzip
+import io
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+
+# the level each encoding compresses at when none is configured
+DEFAULT_LEVELS = {GZIP: 6, ZSTD: 3}
+
+# how a compressed object is recognised: its leading bytes, the Content-Encoding it was stored with, or its key
+MAGIC = {GZIP: b'\x1f\x8b', ZSTD: b'\x28\xb5\x2f\xfd'}
+CONTENT_ENCODINGS = {'gzip': GZIP, 'x-gzip': GZIP, 'zstd': ZSTD}
+SUFFIXES = {'.gz': GZIP, '.gzip': GZIP, '.zst': ZSTD, '.zstd': ZSTD}
+# the most leading bytes needed to recognise an object and read the size it declares
+HEAD_SIZE = 18
+# what decompressing corrupt or cut short data raises
+_ERRORS = (OSError, EOFError, zlib.error) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+class DecompressionError(ValueError):
+    """
+    raised when a compressed object cannot be decompressed, or would decompress to more than allowed
+    """
+
+
+def encodings():
+    """ the content encodings that can be used here """
+    return [GZIP, ZSTD] if zstandard is not None else [GZIP]
+
+
+def compressor(encoding, level=None):
+    """
+    an incremental compressor for encoding, with compress and flush methods
+    """
+    level = DEFAULT_LEVELS.get(encoding) if level is None else level
+    if encoding == GZIP:
+        # wbits of 31 writes a gzip header and trailer
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+    if encoding == ZSTD and zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    raise ValueError(f'Content encoding {encoding} is not available')
+
+
+class CompressedContent:
+    """
+    Content compressed as it is fed, a piece of text at a time.
+
+    Only the compressed bytes are kept, as the chunks the compressor hands
+    back, so that they can be sent on without being joined.
+    """
+
+    def __init__(self, encoding, level=None):
+        self.encoding = encoding
+        self._compressor = compressor(encoding, level)
+        self.chunks = []
+        self.length = 0
+        self.raw_size = 0
+        self.size = 0
+
+    def feed(self, text):
+        data = text.encode('utf-8')
+        self.length += len(text)
+        self.raw_size += len(data)
+        self._add(self._compressor.compress(data))
+
+    def close(self):
+        self._add(self._compressor.flush())
+        self._compressor = None
+        return self
+
+    def _add(self, chunk):
+        if chunk:
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+
+
+def compress(text, encoding, level=None, piece_size=1048576):
+    """ text compressed with encoding a piece at a time, as CompressedContent """
+    content = CompressedContent(encoding, level)
+    for start in range(0, len(text), piece_size):
+        content.feed(text[start:start + piece_size])
+    return content.close()
+
+
+def decompress(data, encoding):
+    """
+    the text of content stored compressed with encoding
+    """
+    if encoding == GZIP:
+        return zlib.decompress(data, 31).decode('utf-8')
+    if encoding == ZSTD and zstandard is not None:
+        # frames written by a streaming compressor do not record their size, so decompress them as a stream
+        return zstandard.ZstdDecompressor().decompressobj().decompress(bytes(data)).decode('utf-8')
+    raise ValueError(f'Content encoding {encoding} is not available')
+
+
+def object_encoding(key='', content_encoding=None, head=b''):
+    """
+    the encoding an S3 object is compressed with, None when it is not compressed.
+    the leading bytes of the object decide when they are given, otherwise its
+    Content-Encoding or the suffix of its key do
+    """
+    if head:
+        for encoding, magic in MAGIC.items():
+            if head[:len(magic)] == magic:
+                return encoding
+        return None
+    if content_encoding:
+        return CONTENT_ENCODINGS.get(content_encoding.strip().lower())
+    for suffix, encoding in SUFFIXES.items():
+        if key.endswith(suffix):
+            return encoding
+    return None
+
+
+def strip_suffix(key):
+    """ the key of an object without the suffix naming its compression """
+    for suffix in SUFFIXES:
+        if key.endswith(suffix):
+            return key[:-len(suffix)]
+    return key
+
+
+def declared_size(encoding, head=b'', tail=b''):
+    """
+    the size an object says it decompresses to, from its leading or trailing
+    bytes, None when it does not say. gzip records it modulo 4 GiB in its last
+    four bytes, zstd in the header of its frame when the compressor knew it
+    """
+    if encoding == GZIP and len(tail) >= 4:
+        return struct.unpack('<I', tail[-4:])[0]
+    if encoding == ZSTD and zstandard is not None and head:
+        try:
+            size = zstandard.frame_content_size(bytes(head))
+        except zstandard.ZstdError:
+            return None
+        return size if size >= 0 else None
+    return None
+
+
+class ChunkFile(io.RawIOBase):
+    """ a readable file over an iterable of byte chunks """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = memoryview(b'')
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._pos == len(self._chunk):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._chunk, self._pos = memoryview(chunk), 0
+        size = min(len(b), len(self._chunk) - self._pos)
+        b[:size] = self._chunk[self._pos:self._pos + size]
+        self._pos += size
+        return size
+
+
+def iter_decompressed(chunks, encoding, limit, chunk_size=1048576):
+    """
+    generator decompressing an object read as byte chunks into chunks of at
+    most chunk_size, raising DecompressionError once more than limit bytes come out
+    """
+    source = ChunkFile(chunks)
+    if encoding == GZIP:
+        reader = gzip.GzipFile(fileobj=source, mode='rb')
+    elif encoding == ZSTD and zstandard is not None:
+        reader = zstandard.ZstdDecompressor().stream_reader(source)
+    else:
+        raise DecompressionError(f'Content encoding {encoding} is not available')
+    total = 0
+    try:
+        while True:
+            chunk = reader.read(chunk_size)
+            if not chunk:
+                return
+            total += len(chunk)
+            if total > limit:
+                raise DecompressionError(f'Decompresses to more than {limit} bytes')
+            yield chunk
+    except _ERRORS as e:
+        raise DecompressionError(f'Unable to decompress {encoding}: {e}')
+
+
+def decompress_head(data, encoding, limit):
+    """
+    as much of the decompressed object as the leading bytes data hold, at most limit bytes
+    """
+    try:
+        if encoding == GZIP:
+            return zlib.decompressobj(31).decompress(data, limit)
+        if encoding == ZSTD and zstandard is not None:
+            # read up to limit, rather than decompressing the whole of data and cutting it down after
+            reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data))
+            head = b''
+            while len(head) < limit:
+                chunk = reader.read(limit - len(head))
+                if not chunk:
+                    break
+                head += chunk
+            return head
+    except _ERRORS as e:
+        raise DecompressionError(f'Unable to decompress {encoding}: {e}')
+    raise DecompressionError(f'Content encoding {encoding} is not available')
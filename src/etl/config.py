@@ -14,6 +14,9 @@ CONFIG = {
         # everything is in one region right now
         'region': env('AWS_DEPLOYMENT_REGION', 'us-west-2'),
         'endpoint-base': env('AWS-BASE-ENDPOINT', '.c8adwxz9sely.us-west-2.rds.amazonaws.com'),
+        # for local runs, an S3 compatible endpoint or a directory standing in for S3
+        's3-endpoint-url': env('S3_ENDPOINT_URL', None),
+        's3-local-root': env('S3_LOCAL_ROOT', None),
     },
     'rds': {
         'host': env('DB_HOST'),
@@ -22,5 +25,63 @@ CONFIG = {
         # default to postgres but could be a schema owner instead
         'user': env('DB_USER', 'postgres'),
         'password': env('DB_PASSWORD')
+    },
+    'connect': {
+        # seconds one attempt to connect may wait, and all the attempts of one connection together
+        'timeout': int(env('DB_CONNECT_TIMEOUT', '10')),
+        'budget': float(env('DB_CONNECT_BUDGET', '30')),
+        # transient failures are retried after a jittered delay doubling from the base up to the max seconds
+        'retry_base_delay': float(env('DB_RETRY_BASE_DELAY', '0.25')),
+        'retry_max_delay': float(env('DB_RETRY_MAX_DELAY', '4')),
+        # after this many failed connection attempts in a row, connecting fails fast for the cooldown seconds
+        'breaker_failures': int(env('DB_BREAKER_FAILURES', '5')),
+        'breaker_cooldown': float(env('DB_BREAKER_COOLDOWN', '30')),
+        # at most this many loads, across every container, use the database at once when set
+        'max_active': int(env('DB_MAX_ACTIVE', '0')),
+        'admission_timeout': float(env('DB_ADMISSION_TIMEOUT', '20')),
+    },
+    'load': {
+        # size of the pieces read from S3 when a capture is streamed
+        'stream_chunk_size': int(env('STREAM_CHUNK_SIZE', '1048576')),
+        # how many objects of a batch are fetched from S3 at once
+        'batch_fetch_workers': int(env('BATCH_FETCH_WORKERS', '8')),
+        # objects of at least this size are downloaded as concurrent ranged GETs of part size bytes
+        'ranged_download_threshold': int(env('RANGED_DOWNLOAD_THRESHOLD', '16777216')),
+        'download_part_size': int(env('DOWNLOAD_PART_SIZE', '8388608')),
+        'download_concurrency': int(env('DOWNLOAD_CONCURRENCY', '8')),
+        # the metadata of objects of at least this size is validated from their leading bytes before they are fetched
+        'prevalidate_min_size': int(env('PREVALIDATE_MIN_SIZE', '1048576')),
+        'prevalidate_bytes': int(env('PREVALIDATE_BYTES', '65536')),
+        # how JSON values are validated: scan, json or orjson (when installed)
+        'json_validator': env('JSON_VALIDATOR', 'scan'),
+        # the memory the function is configured with in MB, which sets how large a capture is loaded in memory
+        'memory_size': env('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', None),
+        # memory taken by the runtime and libraries, and the peak memory of an in-memory load per byte of capture
+        'memory_reserve': int(env('MEMORY_RESERVE', '104857600')),
+        'in_memory_factor': float(env('IN_MEMORY_FACTOR', '6')),
+        # where captures too large to hold in memory are downloaded to
+        'spill_dir': env('SPILL_DIR', '/tmp'),
+        # compressed objects may decompress to at most this many times their size
+        'max_decompression_ratio': float(env('MAX_DECOMPRESSION_RATIO', '100')),
+        # content of at least this many characters is copied into the database rather than sent in the statement
+        'copy_content_min_size': int(env('COPY_CONTENT_MIN_SIZE', '1048576')),
+        # content is stored compressed with gzip or zstd (when installed) when set, at the level given or their default
+        'content_compression': env('CONTENT_COMPRESSION', None),
+        'compression_level': int(env('COMPRESSION_LEVEL', '0')) or None,
+        # whether captures already loaded, by the uuid in their S3 key, are skipped
+        'dedup': env('DEDUP_LOADS', 'false').lower() == 'true',
+        # whether batches are copied straight into the partitions of capture.json_data their rows belong in,
+        # by a map of the partitions read from the catalog again once it is this many seconds old
+        'partition_routing': env('PARTITION_ROUTING', 'false').lower() == 'true',
+        'partition_map_ttl': float(env('PARTITION_MAP_TTL', '300')),
+        # where the records of failed loads are kept for replaying: a JSON lines file, s3://bucket/prefix or table
+        'dead_letter_spool': env('DEAD_LETTER_SPOOL', None),
+        # where they are kept instead, a file or s3://bucket/prefix, when the spool is the table and the load
+        # failed for want of a connection to the database
+        'dead_letter_fallback': env('DEAD_LETTER_FALLBACK', None),
+        # whether single captures store the ids of their url, api, script_name and parameters, kept in
+        # capture.json_data_lookup, in place of the values, and how many of those ids are cached
+        'attribute_lookups': env('ATTRIBUTE_LOOKUPS', 'false').lower() == 'true',
+        'lookup_cache_size': int(env('LOOKUP_CACHE_SIZE', '4096')),
     }
 }
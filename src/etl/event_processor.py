@@ -2,11 +2,18 @@
 This module handles processing of a file object in S3.
 
 """
+import hashlib
 import json
 import logging
 import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 
-from .s3 import S3
+from . import metrics
+from .compression import HEAD_SIZE, DecompressionError, decompress_head, object_encoding, strip_suffix
+from .config import CONFIG
+from .json_stream import CaptureReader, leading_metadata
+from .s3 import S3, decompression_limit, estimated_download_ms
 
 log_level = os.getenv('LOG_LEVEL', logging.ERROR)
 logger = logging.getLogger(__name__)
@@ -15,6 +22,16 @@ logger.setLevel(log_level)
 BODY = 'body'
 STRING_VALUE = 'StringValue'
 
+# how a captured object is held while it is loaded: parsed in memory, kept as the bytes
+# of the object, kept in a temporary file mapped into memory, or read in chunks as the content is consumed
+MEMORY = 'memory'
+BUFFER = 'buffer'
+SPILL = 'spill'
+STREAM = 'stream'
+
+# what validating the metadata before fetching the whole object has found and saved
+PREVALIDATION_STATS = {'checked': 0, 'rejected': 0, 'not_found': 0, 'bytes_saved': 0, 'ms_saved': 0.0}
+
 
 class TriggerEvent:
 
@@ -22,19 +39,202 @@ class TriggerEvent:
         self.data = []
         self.region = region
 
-    def extract(self, event):
+    def prevalidate(self, event, validate):
+        """
+        validates the metadata from the leading bytes of the object before the
+        whole object is fetched, validate raises when the metadata is invalid.
+        returns False when the metadata does not lead the object, so could not be checked
+        """
+        with metrics.stage('prevalidate') as stage:
+            preview = CapturedMetadata(event['Record'], self.region)
+            stage.bytes = preview.bytes_read
+            if preview.metadata is None:
+                PREVALIDATION_STATS['not_found'] += 1
+                return False
+            PREVALIDATION_STATS['checked'] += 1
+            try:
+                validate(preview)
+            except Exception:
+                saved = max(preview.object_size - preview.bytes_read, 0)
+                PREVALIDATION_STATS['rejected'] += 1
+                PREVALIDATION_STATS['bytes_saved'] += saved
+                PREVALIDATION_STATS['ms_saved'] += estimated_download_ms(saved)
+                logger.debug(f'Rejected {preview.uuid} from its metadata, saving {saved} bytes of download.')
+                raise
+        return True
+
+    def object_encoding(self, event):
+        """ the encoding the object of the event is compressed with, by its leading bytes whatever its key """
+        record = event['Record']
+        head, _ = S3(self.region).get_head(record['s3']['bucket']['name'], record['s3']['object']['key'], HEAD_SIZE)
+        return object_encoding(head=head)
+
+    def decompressed_size(self, event, encoding):
+        """
+        the size the compressed object of the event decompresses to, by what it
+        declares or else the most it is allowed to. raises DecompressionError
+        when it declares more than it is allowed to
+        """
+        record = event['Record']
+        size = int(record['s3']['object'].get('size', 0))
+        limit = decompression_limit(size)
+        declared = S3(self.region).decompressed_size(record['s3']['bucket']['name'], record['s3']['object']['key'],
+                                                     size, encoding)
+        if declared is None:
+            return limit
+        if declared > limit:
+            raise DecompressionError(f'Declares {declared} bytes, more than {limit} bytes')
+        return declared
+
+    def extract(self, event, strategy=MEMORY):
         record = event['Record']
+        if strategy == STREAM:
+            # attributes are extracted once the streamed content has been read
+            self.data = StreamedCapturedData(record, self.region)
+            return
+        if strategy == BUFFER:
+            self.data = BufferedCapturedData(record, self.region)
+            return
+        if strategy == SPILL:
+            self.data = SpilledCapturedData(record, self.region)
+            return
+        self.data = CapturedData(record, self.region)
+
+
+class BatchTriggerEvent:
+    """
+        extracts the captured data for every S3 record of a batch event,
+        fetching the objects concurrently. the event is either an S3
+        notification or a batch of SQS messages whose bodies are S3 notifications.
+    """
+
+    def __init__(self, region, max_workers=None):
+        self.data = []
+        self.failures = []
+        self.duplicates = []
+        self.region = region
+        self.max_workers = max_workers or CONFIG['load']['batch_fetch_workers']
+
+    def records(self, event):
+        """
+        returns (item identifier, S3 record) pairs for the event; SQS messages are
+        identified by message ID so that failures can be reported back per message
+        """
+        pairs = []
+        for message in event.get('Records', [event.get('Record')]):
+            if message is None:
+                continue
+            item_id = message.get('messageId')
+            try:
+                if 'body' not in message:
+                    item_id = message['s3']['object']['key']
+                    pairs.append((item_id, message))
+                    continue
+                body = json.loads(message['body'])
+                # a test event or any other notification without records has nothing to load
+                records = [_s3_record(record) for record in body.get('Records', [body.get('Record')])
+                           if record is not None]
+                pairs.extend((item_id, record) for record in records)
+            except (ValueError, AttributeError, KeyError, TypeError) as e:
+                logger.debug(f'Unable to read message {item_id}: {repr(e)}', exc_info=True)
+                self.failures.append((item_id, e))
+        return pairs
+
+    def _fetch(self, record, size_limit=None):
         record_data = CapturedData(record, self.region)
-        record_data.extract_attributes()
-        record_data.fetch_body()
-        self.data = record_data
+        if size_limit is not None and len(record_data.content) >= size_limit:
+            # a compressed object is only known to be too large once it has been decompressed
+            raise Exception(f"Decompressed file too large to process for record {record}")
+        return record_data
+
+    def extract(self, event, size_limit=None, find_loaded=None):
+        """
+        fetches the record of each item, find_loaded maps uuids to the (json_data_id, partition_number)
+        of those of them already loaded, which are put in duplicates rather than fetched again
+        """
+        pending = []
+        for item_id, record in self.records(event):
+            try:
+                size = int(record['s3']['object'].get('size', 0))
+            except (TypeError, ValueError) as e:
+                self.failures.append((item_id, e))
+                continue
+            if size_limit is not None and size >= size_limit:
+                self.failures.append((item_id, Exception(f"File too large to process for record {record}")))
+            else:
+                pending.append((item_id, record))
+        if find_loaded is not None and pending:
+            uuids = [object_uuid(record['s3']['object']['key']) for _, record in pending]
+            loaded = find_loaded(set(uuids))
+            fetch = []
+            for (item_id, record), uuid in zip(pending, uuids):
+                if uuid in loaded:
+                    self.duplicates.append((item_id, loaded[uuid]))
+                else:
+                    fetch.append((item_id, record))
+            pending = fetch
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [(item_id, pool.submit(self._fetch, record, size_limit)) for item_id, record in pending]
+            for item_id, future in futures:
+                try:
+                    self.data.append((item_id, future.result()))
+                except Exception as e:
+                    logger.debug(f'Unable to fetch {item_id}: {repr(e)}', exc_info=True)
+                    self.failures.append((item_id, e))
+
+
+def _s3_record(record):
+    """ the record when it names an S3 object, so that a message that does not fails on its own """
+    if 'key' not in record['s3']['object']:
+        raise KeyError('key')
+    return record
+
+
+def object_uuid(key):
+    """ the uuid of a capture, from the key of its S3 object """
+    return strip_suffix(key).replace(".json", "")[-36:]
+
+
+class MetadataAttribute:
+    """
+        a metadata value of a captured data record, read from its metadata when
+        it is asked for rather than copied out of it. empty when it is missing
+        from the metadata, unavailable while the metadata is None
+    """
+
+    def __init__(self, in_name, value=STRING_VALUE):
+        self.in_name = in_name
+        self.value = value
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        if instance.metadata is None:
+            raise AttributeError(f'{self.in_name} has not been read yet')
+        try:
+            return instance.metadata.get(self.in_name).get(self.value)
+        except (ValueError, AttributeError):
+            return ""
 
 
 class CapturedData:
     """
         this class is more of a macro to store data values
-        it makes the code cleaner when accessing data properties
+        it makes the code cleaner when accessing data properties.
+        only the metadata and content of the parsed object are kept, and
+        an instance only has a __dict__ once something is put in it
     """
+    __slots__ = ('s3', 'event', '_bucket_name', '_object_key', 'uuid', '_digest', 'metadata', 'content',
+                 '__dict__')
+
+    url = MetadataAttribute('URL')
+    api = MetadataAttribute('API')
+    parameters = MetadataAttribute('Parameters')
+    start_time = MetadataAttribute('StartTime')
+    script_pid = MetadataAttribute('PID')
+    script_name = MetadataAttribute('ScriptName')
+    response_time = MetadataAttribute('ResponseTime')
+    response_code = MetadataAttribute('ResponseCode')
 
     def __init__(self, record, region):
         self.s3 = S3(region)
@@ -42,35 +242,142 @@ class CapturedData:
         self._bucket_name = record['s3']['bucket']['name']
         self._object_key = record['s3']['object']['key']
         logger.debug(f'Pulling data from the {self._object_key} in the {self._bucket_name} bucket.')
-        self._data = json.loads(self.s3.get_file(self._bucket_name, self._object_key))
-        self.metadata = self._data['metadata']
-        self.content = self._data['content']
-        self.uuid = self._object_key.replace(".json", "")[-36:]
+        self.uuid = object_uuid(self._object_key)
+        self._digest = hashlib.sha256()
+        self._load()
 
-    def fetch_body(self):
-        self.put(BODY, self.content)
+    @property
+    def content_hash(self):
+        """ the SHA-256 of the captured object, complete once the object has been read """
+        return self._digest.hexdigest()
+
+    @property
+    def body(self):
+        return self.content
+
+    def _load(self):
+        size = self.event['s3']['object'].get('size')
+        text = self.s3.get_file(self._bucket_name, self._object_key, None if size is None else int(size),
+                                self._digest)
+        with metrics.stage('parse', len(text)):
+            document = json.loads(text)
+        del text
+        self.metadata = document.pop('metadata')
+        self.content = document.pop('content')
+
+    def close(self):
+        """ releases whatever holds the captured object beyond the life of this instance """
 
     def extract_attributes(self):
-        """ This migrates the metadata values into a local convenience class """
-
-        # getting an individual attribute value
-
-        self.put_attribute("url", 'URL', STRING_VALUE)
-        self.put_attribute("api", 'API', STRING_VALUE)
-        self.put_attribute("parameters", 'Parameters', STRING_VALUE)
-        self.put_attribute("start_time", 'StartTime', STRING_VALUE)
-        self.put_attribute("script_pid", 'PID', STRING_VALUE)
-        self.put_attribute("script_name", 'ScriptName', STRING_VALUE)
-        self.put_attribute("response_time", 'ResponseTime', STRING_VALUE)
-        self.put_attribute("response_code", 'ResponseCode', STRING_VALUE)
+        """
+        the metadata attributes are read from the metadata when they are asked
+        for, so there is nothing to migrate. returns this instance
+        """
         return self
 
+    def fetch_body(self):
+        """ deprecated, body is the content without being fetched """
+        warnings.warn('fetch_body is deprecated, body is always available', DeprecationWarning, stacklevel=2)
+
     def put(self, name, value):
+        """ deprecated, sets name to value in place of whatever it would be read from """
+        warnings.warn('put is deprecated, attributes are read from the metadata', DeprecationWarning, stacklevel=2)
         self.__dict__[name] = value
 
     def put_attribute(self, name, in_name, attrs, value=STRING_VALUE):
+        """ deprecated, the attributes are read from the metadata when they are asked for """
+        warnings.warn('put_attribute is deprecated, attributes are read from the metadata', DeprecationWarning,
+                      stacklevel=2)
         try:
-            attrs = self.metadata
-            self.put(name, attrs.get(in_name).get(value))
+            self.__dict__[name] = self.metadata.get(in_name).get(value)
         except (ValueError, AttributeError):
-            self.put(name, "")
+            self.__dict__[name] = ""
+
+
+class CapturedMetadata(CapturedData):
+    """
+        the metadata of a captured data record read from the leading bytes of
+        its S3 object, without the content. metadata is None when it was not
+        found within those bytes.
+    """
+    __slots__ = ('object_size', 'bytes_read')
+
+    def _load(self):
+        data, self.object_size = self.s3.get_head(self._bucket_name, self._object_key,
+                                                  CONFIG['load']['prevalidate_bytes'])
+        self.bytes_read = len(data)
+        encoding = object_encoding(self._object_key, head=data[:HEAD_SIZE])
+        if encoding is not None:
+            data = decompress_head(data, encoding, decompression_limit(len(data)))
+        self.metadata = leading_metadata(data)
+
+
+class StreamedCapturedData(CapturedData):
+    """
+        a captured data record whose S3 object is read in chunks while the
+        content is consumed, so the content is never held in memory as a whole.
+        the metadata attributes are only available once iter_content is exhausted.
+    """
+    __slots__ = ('_reader',)
+
+    def _load(self):
+        chunks = self.s3.iter_file(self._bucket_name, self._object_key, CONFIG['load']['stream_chunk_size'],
+                                   self._digest)
+        self._reader = CaptureReader(chunks)
+        self.metadata = None
+
+    @property
+    def bytes_read(self):
+        return self._reader.bytes_read
+
+    def iter_content(self):
+        """ generator handing back the decoded content in pieces """
+        yield from self._reader.iter_content()
+        self.metadata = self._reader.metadata
+
+
+class BufferedCapturedData(StreamedCapturedData):
+    """
+        a captured data record whose S3 object is held as the bytes it was
+        downloaded as. the content is decoded in pieces for validation and its
+        string literal is located in the buffer so it can be sent on undecoded.
+        the metadata attributes and content_span are only available once
+        iter_content is exhausted.
+    """
+    __slots__ = ('buffer',)
+
+    def _load(self):
+        size = self.event['s3']['object'].get('size')
+        self.buffer = self._fetch(None if size is None else int(size))
+        self._reader = CaptureReader(_chunks(self.buffer, CONFIG['load']['stream_chunk_size']))
+        self.metadata = None
+
+    def _fetch(self, size):
+        return self.s3.get_bytes(self._bucket_name, self._object_key, size, self._digest)
+
+    @property
+    def content_span(self):
+        """ the start and end offsets of the content string literal in buffer, quotes included """
+        return self._reader.content_span
+
+
+class SpilledCapturedData(BufferedCapturedData):
+    """
+        a buffered captured data record whose S3 object is downloaded to a
+        temporary file mapped into memory, so the object need not fit in memory.
+        close removes the file.
+    """
+    __slots__ = ('_spill',)
+
+    def _fetch(self, size):
+        self._spill = self.s3.spill(self._bucket_name, self._object_key, size, self._digest)
+        return self._spill.buffer
+
+    def close(self):
+        self._spill.close()
+
+
+def _chunks(buffer, size):
+    # slices copy out of the buffer, so nothing holds on to a mapped buffer once they are read
+    for start in range(0, len(buffer), size):
+        yield buffer[start:start + size]
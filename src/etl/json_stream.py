@@ -0,0 +1,359 @@
+"""
+This module reads captured documents incrementally so that the content of a
+capture never has to be held in memory as a whole.
+
+"""
+import codecs
+import json
+import re
+
+CONTENT = 'content'
+METADATA = 'metadata'
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_NUMBER_CHARS = re.compile(r'[-+.0-9eE]*')
+# the body of a JSON string literal up to its closing quote, escapes included
+_STRING_BODY = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+# how much of a piece may hold an incomplete number or literal
+_SCALAR_LOOKAHEAD = 64
+
+_decoder = json.JSONDecoder()
+
+# what the validator expects next
+_VALUE = 'value'
+_VALUE_OR_CLOSE = 'value or ]'
+_KEY = 'key'
+_KEY_OR_CLOSE = 'key or }'
+_COLON = ':'
+_COMMA_OR_CLOSE = ', or close'
+_END = 'end'
+
+_CLOSE = {'[': ']', '{': '}'}
+
+
+class JsonStreamError(ValueError):
+    """
+    raised when a streamed document is not well formed
+    """
+
+    def __init__(self, message, offset):
+        super().__init__(f'{message}: character {offset}')
+        self.offset = offset
+
+
+class JsonValidator:
+    """
+    Checks that JSON text is well formed while it is fed in pieces.
+
+    Values that are complete within the buffered text are handed to the C
+    decoder, only the containers that straddle a piece boundary are walked
+    here, which keeps the Python work per piece small.
+    """
+
+    def __init__(self):
+        self._buffer = ''
+        self._offset = 0
+        self._stack = []
+        self._state = _VALUE
+
+    def feed(self, text):
+        self._buffer = self._buffer + text if self._buffer else text
+        self._consume(final=False)
+
+    def close(self):
+        self._consume(final=True)
+        if self._state != _END:
+            raise JsonStreamError(f'Expecting {self._state}', self._offset + len(self._buffer))
+
+    def _error(self, message, pos):
+        return JsonStreamError(message, self._offset + pos)
+
+    def _after_value(self):
+        self._state = _COMMA_OR_CLOSE if self._stack else _END
+
+    def _scalar(self, buf, pos, final):
+        """
+        decodes the value at pos, returning where it ends or None when more text is needed
+        """
+        try:
+            _, end = _decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError as e:
+            if not final and (e.msg.startswith('Unterminated string') or len(buf) - e.pos < _SCALAR_LOOKAHEAD):
+                return None
+            raise self._error(e.msg, e.pos)
+        if not final and buf[pos] not in '"[{' and _NUMBER_CHARS.match(buf, end).end() == len(buf):
+            # a number or literal may carry on in the next piece
+            return None
+        return end
+
+    def _consume(self, final):
+        buf = self._buffer
+        size = len(buf)
+        pos = 0
+        while True:
+            pos = _WHITESPACE.match(buf, pos).end()
+            if pos == size:
+                break
+            char = buf[pos]
+            state = self._state
+            if state == _END:
+                raise self._error('Extra data', pos)
+            if state == _COLON:
+                if char != ':':
+                    raise self._error("Expecting ':' delimiter", pos)
+                pos += 1
+                self._state = _VALUE
+                continue
+            if state == _COMMA_OR_CLOSE:
+                if char == ',':
+                    pos += 1
+                    self._state = _KEY if self._stack[-1] == '{' else _VALUE
+                elif char == _CLOSE[self._stack[-1]]:
+                    pos += 1
+                    self._stack.pop()
+                    self._after_value()
+                else:
+                    raise self._error("Expecting ',' delimiter", pos)
+                continue
+            if (state == _VALUE_OR_CLOSE and char == ']') or (state == _KEY_OR_CLOSE and char == '}'):
+                pos += 1
+                self._stack.pop()
+                self._after_value()
+                continue
+            if state in (_KEY, _KEY_OR_CLOSE):
+                if char != '"':
+                    raise self._error('Expecting property name enclosed in double quotes', pos)
+                end = self._scalar(buf, pos, final)
+                if end is None:
+                    break
+                pos = end
+                self._state = _COLON
+                continue
+            if char in '[{' and not final:
+                try:
+                    _, pos = _decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    # most likely cut short by the end of the piece, step into it
+                    self._stack.append(char)
+                    self._state = _VALUE_OR_CLOSE if char == '[' else _KEY_OR_CLOSE
+                    pos += 1
+                    continue
+                self._after_value()
+                continue
+            end = self._scalar(buf, pos, final)
+            if end is None:
+                break
+            pos = end
+            self._after_value()
+        self._offset += pos
+        self._buffer = buf[pos:]
+
+
+def validate(text, piece_size=1048576):
+    """
+    checks that text is well formed JSON without building the whole document,
+    raising JsonStreamError when it is not
+    """
+    validator = JsonValidator()
+    for start in range(0, len(text), piece_size):
+        validator.feed(text[start:start + piece_size])
+    validator.close()
+
+
+class CaptureReader:
+    """
+    Splits a captured document, read as a sequence of byte chunks, into its
+    metadata and its content.
+
+    The content string is decoded and handed back in pieces as it is read,
+    the metadata and the byte offsets of the content string literal are
+    available once the content has been exhausted.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._pos = 0
+        self._offset = 0
+        self._eof = False
+        self.metadata = None
+        self.content_span = None
+        self.bytes_read = 0
+
+    def _error(self, message):
+        return JsonStreamError(message, self._offset + self._pos)
+
+    def _fill(self):
+        """ appends the next chunk to the buffer, returns False once the document is exhausted """
+        if self._eof:
+            return False
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self._eof = True
+            text = self._utf8.decode(b'', final=True)
+        else:
+            self.bytes_read += len(chunk)
+            text = self._utf8.decode(chunk)
+        self._offset += self._pos
+        self._buffer = self._buffer[self._pos:] + text
+        self._pos = 0
+        return chunk is not None
+
+    def _byte_offset(self):
+        """ the offset in the encoded document of the current position """
+        pending = self._utf8.getstate()[0]
+        return self.bytes_read - len(pending) - len(self._buffer[self._pos:].encode('utf-8'))
+
+    def _peek(self):
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise self._error('Unexpected end of capture document')
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char not in chars:
+            raise self._error(f'Expecting one of {chars!r}')
+        self._pos += 1
+        return char
+
+    def _read_value(self):
+        """ decodes a small value, reading chunks until it is complete """
+        self._peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError as e:
+                if self._fill():
+                    continue
+                raise self._error(e.msg)
+            if end == len(self._buffer) and self._buffer[self._pos] not in '"[{' and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def _content_pieces(self):
+        while True:
+            buf = self._buffer
+            end = _STRING_BODY.match(buf, self._pos).end()
+            if end < len(buf) and buf[end] == '"':
+                yield _decode_string(buf[self._pos:end])
+                self._pos = end + 1
+                return
+            cut = _safe_cut(buf, self._pos, end)
+            if cut > self._pos:
+                yield _decode_string(buf[self._pos:cut])
+                self._pos = cut
+            if not self._fill():
+                raise self._error('Unterminated content string')
+
+    def leading_metadata(self):
+        """
+        reads the members of the document up to its metadata, returning None
+        when the content comes first
+        """
+        self._expect('{')
+        while self._peek() == '"':
+            key = self._read_value()
+            self._expect(':')
+            if key == CONTENT:
+                return None
+            value = self._read_value()
+            if key == METADATA:
+                return value
+            self._expect(',')
+        return None
+
+    def iter_content(self):
+        """
+        generator handing back the decoded content in pieces
+        """
+        found = False
+        self._expect('{')
+        if self._peek() != '}':
+            while True:
+                if self._peek() != '"':
+                    raise self._error('Expecting property name enclosed in double quotes')
+                key = self._read_value()
+                self._expect(':')
+                if key == CONTENT:
+                    if self._peek() != '"':
+                        raise self._error('Expecting content to be a string')
+                    start = self._byte_offset()
+                    self._pos += 1
+                    yield from self._content_pieces()
+                    self.content_span = (start, self._byte_offset())
+                    found = True
+                elif key == METADATA:
+                    self.metadata = self._read_value()
+                else:
+                    self._read_value()
+                if self._expect(',}') == '}':
+                    break
+        else:
+            self._pos += 1
+        while self._fill():
+            pass
+        if _WHITESPACE.match(self._buffer, self._pos).end() != len(self._buffer):
+            raise self._error('Extra data')
+        if not found or self.metadata is None:
+            raise self._error('Capture document must have both metadata and content')
+
+
+def leading_metadata(data):
+    """
+    the metadata of a capture document from its leading bytes, or None when
+    the metadata is not complete within them
+    """
+    try:
+        return CaptureReader([data]).leading_metadata()
+    except (JsonStreamError, UnicodeDecodeError):
+        return None
+
+
+def _decode_string(piece):
+    if '\\' not in piece and piece.isprintable():
+        return piece
+    return json.loads(f'"{piece}"')
+
+
+def _safe_cut(buf, start, end):
+    """
+    the last position before end where a string body can be split without
+    breaking an escape sequence or a surrogate pair
+    """
+    i = buf.rfind('\\u', max(start, end - 12), end)
+    while i != -1:
+        if _unescaped(buf, start, i):
+            digits = buf[i + 2:i + 6]
+            if len(digits) < 4:
+                # the escape before an incomplete one may be the high half of a pair
+                if _high_surrogate(buf, start, i - 6):
+                    return i - 6
+                return i
+            if _high_surrogate(buf, start, i):
+                return i
+            break
+        i = buf.rfind('\\u', max(start, end - 12), i)
+    return end
+
+
+def _unescaped(buf, start, i):
+    """ whether the backslash at i starts an escape rather than ending one """
+    k = i
+    while k > start and buf[k - 1] == '\\':
+        k -= 1
+    return (i - k) % 2 == 0
+
+
+def _high_surrogate(buf, start, i):
+    """ whether a complete escape of the high half of a surrogate pair starts at i """
+    if i < start or buf[i:i + 2] != '\\u' or not _unescaped(buf, start, i):
+        return False
+    try:
+        return 0xD800 <= int(buf[i + 2:i + 6], 16) <= 0xDBFF
+    except ValueError:
+        return False
@@ -0,0 +1,117 @@
+"""
+A filesystem backed stand-in for the parts of the boto3 S3 client this
+project uses, so loads can be run end to end locally for benchmarks and tests.
+
+Objects live at <root>/<bucket>/<key>. Select it by setting S3_LOCAL_ROOT.
+"""
+import os
+import shutil
+
+from botocore.exceptions import ClientError
+
+
+class LocalBody:
+    """ the streaming body of a local object """
+
+    def __init__(self, path, start, length):
+        self._file = open(path, 'rb')
+        self._file.seek(start)
+        self._remaining = length
+        if not length:
+            self.close()
+
+    def read(self, amt=None):
+        if not self._remaining:
+            return b''
+        if amt is None or amt > self._remaining:
+            amt = self._remaining
+        data = self._file.read(amt)
+        self._remaining -= len(data)
+        if not self._remaining:
+            self.close()
+        return data
+
+    def iter_chunks(self, chunk_size=1024):
+        while True:
+            data = self.read(chunk_size)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        self._file.close()
+
+
+class LocalS3Client:
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def _missing(self, operation, bucket, key):
+        return ClientError({'Error': {'Code': 'NoSuchKey', 'Message': f'{bucket}/{key} does not exist'}}, operation)
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(Body.encode('utf-8') if isinstance(Body, str) else Body)
+        return {}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        path = self._path(Bucket, Key)
+        if not os.path.isfile(path):
+            raise self._missing('HeadObject', Bucket, Key)
+        return {'ContentLength': os.path.getsize(path)}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        path = self._path(Bucket, Key)
+        if not os.path.isfile(path):
+            raise self._missing('GetObject', Bucket, Key)
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        if Range:
+            first, _, last = Range[len('bytes='):].partition('-')
+            if first:
+                start, end = int(first), min(int(last), size - 1) if last else size - 1
+            else:
+                start = max(size - int(last), 0)
+        length = max(end - start + 1, 0)
+        response = {'Body': LocalBody(path, start, length), 'ContentLength': length}
+        if Range:
+            response['ContentRange'] = f'bytes {start}-{end}/{size}'
+        return response
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        for item in Delete['Objects']:
+            path = self._path(Bucket, item['Key'])
+            if os.path.isfile(path):
+                os.remove(path)
+        return {}
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        path = self._path(Bucket, Key)
+        if not os.path.isfile(path):
+            raise self._missing('GetObject', Bucket, Key)
+        shutil.copyfile(path, Filename)
+
+    def list_objects_v2(self, Bucket, Prefix='', StartAfter='', ContinuationToken=None, MaxKeys=1000, **kwargs):
+        bucket_root = os.path.join(self.root, Bucket)
+        keys = []
+        for directory, _, files in os.walk(bucket_root):
+            for name in files:
+                key = os.path.relpath(os.path.join(directory, name), bucket_root).replace(os.sep, '/')
+                if key.startswith(Prefix) and key > (ContinuationToken or StartAfter):
+                    keys.append(key)
+        keys.sort()
+        page = keys[:MaxKeys]
+        response = {
+            'Contents': [{'Key': key, 'Size': os.path.getsize(self._path(Bucket, key))} for key in page],
+            'KeyCount': len(page),
+            'IsTruncated': len(keys) > MaxKeys,
+        }
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = page[-1]
+        return response
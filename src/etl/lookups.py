@@ -0,0 +1,119 @@
+"""
+This module interns the url, api, script_name and parameters of captures in
+capture.json_data_lookup, so that a row can store the id of each value rather
+than repeating the value itself.
+
+The retriever makes the same few hundred calls over and over, so the ids of
+the values are kept in a least recently used cache for the life of the
+container and most loads look none of them up in the database.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+from .config import CONFIG
+
+# allows for logging information
+import logging
+
+log_level = os.getenv('LOG_LEVEL', logging.ERROR)
+logger = logging.getLogger(__name__)
+logger.setLevel(log_level)
+
+# the attributes of a capture stored by id, with their position in the parameters of its insert
+LOOKUP_ATTRIBUTES = (('url', 3), ('api', 4), ('script_name', 5), ('parameters', 7))
+
+# the table, the id columns of capture.json_data and the view reading them are created by this migration rather
+# than by the loader, whose role may not create tables in the schema. values are unique by a hash of each
+JSON_DATA_LOOKUP_MIGRATION = 'migrations/003_json_data_lookup.sql'
+
+# the id of each of the given values, adding those not there yet. added is true for the ids of values added by it,
+# which are not committed until its transaction is
+SELECT_JSON_DATA_LOOKUPS = """
+    WITH given (attribute, value) AS (SELECT * FROM unnest(%s::text[], %s::text[])),
+    added AS (
+        INSERT INTO capture.json_data_lookup (attribute, value)
+        SELECT attribute, value FROM given
+        ON CONFLICT (attribute, md5(value)) DO NOTHING
+        RETURNING lookup_id, attribute, value)
+    SELECT l.lookup_id, l.attribute, l.value, false FROM given g
+    JOIN capture.json_data_lookup l
+    ON l.attribute = g.attribute AND md5(l.value) = md5(g.value) AND l.value = g.value
+    UNION ALL
+    SELECT lookup_id, attribute, value, true FROM added;"""
+
+# a value added by a load that has not committed yet is neither found nor added, it is looked up again
+LOOKUP_ATTEMPTS = 3
+
+# values found in the cache, values looked up in the database, and values added to it
+LOOKUP_STATS = {'hits': 0, 'misses': 0, 'added': 0}
+
+
+class LookupCache:
+    """
+    the ids of (attribute, value) pairs, forgetting the least recently used once it holds more than size.
+    only ids of committed values are kept, so that an id never outlives a rolled back transaction
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def get(self, key):
+        with self._lock:
+            lookup_id = self._ids.get(key)
+            if lookup_id is not None:
+                self._ids.move_to_end(key)
+            return lookup_id
+
+    def put(self, key, lookup_id):
+        with self._lock:
+            self._ids[key] = lookup_id
+            self._ids.move_to_end(key)
+            while len(self._ids) > self.size:
+                self._ids.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+
+
+# shared by every connection of the container, the ids are those of the one database they connect to
+LOOKUP_CACHE = LookupCache(CONFIG['load']['lookup_cache_size'])
+
+
+def lookup_ids(cursor, keys, cache=LOOKUP_CACHE, committed=False):
+    """
+    the id of each of the (attribute, value) pairs of keys, by pair, from the cache or else from
+    capture.json_data_lookup, adding the values it does not have yet. committed is whether the
+    statement is committed as soon as it is run, so that the ids of values it adds can be cached
+    """
+    ids = {}
+    missing = []
+    for key in dict.fromkeys(keys):
+        lookup_id = cache.get(key)
+        if lookup_id is None:
+            missing.append(key)
+        else:
+            ids[key] = lookup_id
+    LOOKUP_STATS['hits'] += len(ids)
+    LOOKUP_STATS['misses'] += len(missing)
+    for _ in range(LOOKUP_ATTEMPTS):
+        if not missing:
+            return ids
+        cursor.execute(SELECT_JSON_DATA_LOOKUPS, ([attribute for attribute, _ in missing],
+                                                  [value for _, value in missing]))
+        for lookup_id, attribute, value, added in cursor.fetchall():
+            ids[(attribute, value)] = lookup_id
+            if added:
+                LOOKUP_STATS['added'] += 1
+            if committed or not added:
+                cache.put((attribute, value), lookup_id)
+        missing = [key for key in missing if key not in ids]
+    if missing:
+        raise RuntimeError(f'Could not look up {len(missing)} values added by loads that did not finish, try again')
+    return ids
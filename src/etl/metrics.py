@@ -0,0 +1,178 @@
+"""
+This module records the wall time, bytes handled and peak memory growth of
+each stage of a load, and writes them out as a single CloudWatch Embedded
+Metric Format log line per invocation.
+
+Set PROFILE_ETL to cprofile or tracemalloc to also print a profile of the invocation.
+"""
+import io
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+log_level = os.getenv('LOG_LEVEL', logging.ERROR)
+logger = logging.getLogger(__name__)
+logger.setLevel(log_level)
+
+NAMESPACE = 'aqts-capture-raw-load'
+PROFILE_TOP = 25
+
+# the invocation being recorded, stages outside of one are not recorded
+_active = None
+_lock = threading.Lock()
+
+
+def max_rss():
+    """ the peak resident set size of the process so far, in bytes """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Stage:
+    """ what is known about one run of a stage, bytes can be set once they are known """
+
+    def __init__(self, name, size=0):
+        self.name = name
+        self.bytes = size
+
+
+class Invocation:
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = {}
+        self.properties = {}
+        self.start_rss = max_rss()
+        self.seconds = 0.0
+        # the innermost stage an error was raised from
+        self.failed_stage = None
+
+    def record(self, stage, seconds, memory_delta):
+        with _lock:
+            totals = self.stages.setdefault(stage.name, {'ms': 0.0, 'bytes': 0, 'peak_memory_delta': 0, 'count': 0})
+            totals['ms'] += seconds * 1000
+            totals['bytes'] += stage.bytes
+            totals['peak_memory_delta'] = max(totals['peak_memory_delta'], memory_delta)
+            totals['count'] += 1
+
+    def emf(self):
+        """ the invocation as a CloudWatch Embedded Metric Format document """
+        values = {'total_ms': self.seconds * 1000, 'peak_memory': max_rss(),
+                  'peak_memory_delta': max_rss() - self.start_rss}
+        for name, totals in self.stages.items():
+            values[f'{name}_ms'] = totals['ms']
+            values[f'{name}_bytes'] = totals['bytes']
+            values[f'{name}_peak_memory_delta'] = totals['peak_memory_delta']
+        units = {'ms': 'Milliseconds', 'bytes': 'Bytes', 'memory': 'Bytes', 'delta': 'Bytes'}
+        document = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': NAMESPACE,
+                    'Dimensions': [['FunctionName', 'Operation']],
+                    'Metrics': [{'Name': name, 'Unit': units[name.rsplit('_', 1)[-1]]} for name in values]
+                }]
+            },
+            'FunctionName': os.getenv('AWS_LAMBDA_FUNCTION_NAME', 'local'),
+            'Operation': self.name,
+        }
+        document.update(self.properties)
+        document.update(values)
+        return document
+
+
+@contextmanager
+def stage(name, size=0):
+    """
+    records the wall time and peak memory growth of the enclosed block
+    """
+    current = Stage(name, size)
+    invocation = _active
+    if invocation is None:
+        yield current
+        return
+    start_rss = max_rss()
+    start = time.perf_counter()
+    try:
+        yield current
+    except Exception:
+        if invocation.failed_stage is None:
+            invocation.failed_stage = name
+        raise
+    finally:
+        invocation.record(current, time.perf_counter() - start, max_rss() - start_rss)
+
+
+def failed_stage():
+    """ the stage of the invocation being recorded that an error was raised from, if any """
+    return _active.failed_stage if _active is not None else None
+
+
+def put_property(name, value):
+    """ adds a value to the log line of the invocation being recorded """
+    if _active is not None:
+        _active.properties[name] = value
+
+
+@contextmanager
+def invocation(name):
+    """
+    records the stages run in the enclosed block and writes them out as one log line
+    """
+    global _active
+    recorded = _active = Invocation(name)
+    profile = os.getenv('PROFILE_ETL', '').lower()
+    # the profilers are only imported when asked for, to keep them out of a cold start
+    profiler = None
+    if profile == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+    if profile == 'tracemalloc':
+        import tracemalloc
+        tracemalloc.start()
+    start = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    try:
+        yield recorded
+    except Exception as e:
+        recorded.properties['error'] = type(e).__name__
+        if recorded.failed_stage is not None:
+            recorded.properties['failedStage'] = recorded.failed_stage
+        raise
+    finally:
+        recorded.seconds = time.perf_counter() - start
+        if profiler:
+            profiler.disable()
+            _write(_cprofile_report(profiler))
+        if profile == 'tracemalloc':
+            _write(_tracemalloc_report())
+            tracemalloc.stop()
+        _active = None
+        _write(json.dumps(recorded.emf()))
+
+
+def _write(text):
+    # written as is rather than logged so that CloudWatch sees a bare JSON document
+    sys.stdout.write(text + '\n')
+    sys.stdout.flush()
+
+
+def _cprofile_report(profiler):
+    import pstats
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(PROFILE_TOP)
+    return out.getvalue()
+
+
+def _tracemalloc_report():
+    import tracemalloc
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [f'tracemalloc current {current} bytes, peak {peak} bytes']
+    for statistic in tracemalloc.take_snapshot().statistics('lineno')[:PROFILE_TOP]:
+        lines.append(str(statistic))
+    return '\n'.join(lines)
@@ -0,0 +1,210 @@
+"""
+This module maps the rows of a partitioned table to the partitions the
+database would route them to, from the partition bounds in its catalog, so
+that rows can be grouped by partition and copied straight into them.
+
+Single column RANGE and LIST partitioning on a column the loader sends is
+understood. Any other partitioning, or a table that is not partitioned,
+leaves every row to be inserted through the table itself.
+"""
+import bisect
+import datetime
+import os
+import re
+import time
+
+# allows for logging information
+import logging
+
+log_level = os.getenv('LOG_LEVEL', logging.ERROR)
+logger = logging.getLogger(__name__)
+logger.setLevel(log_level)
+
+# the row of a capture as persist_rows receives it, by column
+JSON_DATA_COLUMNS = ('start_time', 'response_time', 'response_code', 'url', 'api',
+                     'script_name', 'script_pid', 'parameters', 'json_content')
+
+SELECT_PARTITION_KEY = """
+    SELECT p.partstrat, p.partnatts, a.attname, format_type(a.atttypid, a.atttypmod),
+           pg_get_serial_sequence(%(table)s, 'json_data_id')
+    FROM pg_partitioned_table p
+    LEFT JOIN pg_attribute a ON a.attrelid = p.partrelid AND a.attnum = p.partattrs[0]
+    WHERE p.partrelid = %(table)s::regclass;"""
+
+SELECT_PARTITIONS = """
+    SELECT c.oid::regclass::text, pg_get_expr(c.relpartbound, c.oid)
+    FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = %s::regclass;"""
+
+RANGE = 'r'
+LIST = 'l'
+
+# how the bounds of a key of each type are read, ranges of text are left out as their order depends on collation
+_KEY_TYPES = {
+    'timestamp without time zone': (RANGE, LIST),
+    'integer': (RANGE, LIST),
+    'bigint': (RANGE, LIST),
+    'smallint': (RANGE, LIST),
+    'text': (LIST,),
+    'character varying': (LIST,),
+}
+_BOUND_VALUE = re.compile(r"'((?:[^']|'')*)'|(MINVALUE|MAXVALUE|NULL)|(-?\d+)")
+_RANGE_BOUND = re.compile(r'FOR VALUES FROM \((.*)\) TO \((.*)\)$')
+_LIST_BOUND = re.compile(r'FOR VALUES IN \((.*)\)$')
+_FRACTION = re.compile(r'\.(\d{1,6})$')
+
+# rows copied straight into a partition, rows left to the table to route, catalog reads, and maps found out of date
+PARTITION_STATS = {'routed': 0, 'unrouted': 0, 'refreshes': 0, 'stale': 0}
+
+
+class UnsupportedPartitioning(ValueError):
+    """
+    raised when the partitioning of a table is not one rows can be routed by here
+    """
+
+
+def _timestamp(text):
+    # fromisoformat before Python 3.11 wants a fraction of exactly 3 or 6 digits
+    text = _FRACTION.sub(lambda match: '.' + match.group(1).ljust(6, '0'), text)
+    return datetime.datetime.fromisoformat(text)
+
+
+def _bound_values(text, key_type):
+    """ the values of a bound as the key column holds them, None for NULL, MINVALUE or MAXVALUE """
+    values = []
+    for match in _BOUND_VALUE.finditer(text):
+        quoted, keyword, number = match.groups()
+        if keyword is not None:
+            values.append(None)
+        elif key_type == 'timestamp without time zone':
+            values.append(_timestamp(quoted))
+        elif key_type in ('text', 'character varying'):
+            values.append(quoted.replace("''", "'") if quoted is not None else number)
+        else:
+            values.append(int(number if number is not None else quoted))
+    return values
+
+
+class PartitionMap:
+    """
+    the partitions of table and the bounds of each, read from the catalog and
+    read again once ttl seconds old or when found to be out of date
+    """
+
+    def __init__(self, table, ttl=300):
+        self.table = table
+        self.ttl = ttl
+        self.loaded_at = None
+        self.key_index = None
+        self.sequence = None
+        self.strategy = None
+        self.default = None
+        self._lowers = []
+        self._ranges = []
+        self._values = {}
+
+    @property
+    def routable(self):
+        return self.key_index is not None
+
+    def current(self, cursor):
+        """ the map, read again first when it is older than its ttl """
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl:
+            self.refresh(cursor)
+        return self
+
+    def expire(self):
+        """ marks the map out of date, so that it is read again before it is used next """
+        self.loaded_at = None
+        PARTITION_STATS['stale'] += 1
+
+    def refresh(self, cursor):
+        """ reads the partitioning of the table and the bounds of its partitions from the catalog """
+        self.loaded_at = time.monotonic()
+        PARTITION_STATS['refreshes'] += 1
+        cursor.execute(SELECT_PARTITION_KEY, {'table': self.table})
+        key = cursor.fetchone()
+        cursor.execute(SELECT_PARTITIONS, (self.table,))
+        partitions = cursor.fetchall()
+        try:
+            self._load(key, partitions)
+        except UnsupportedPartitioning as e:
+            logger.info(f'Rows are inserted through {self.table}: {e}')
+            self.key_index = None
+
+    def _load(self, key, partitions):
+        if key is None:
+            raise UnsupportedPartitioning(f'{self.table} is not partitioned')
+        strategy, key_count, column, key_type, sequence = key
+        if key_count != 1 or column not in JSON_DATA_COLUMNS:
+            raise UnsupportedPartitioning(f'{self.table} is not partitioned by a column of its rows')
+        if strategy not in _KEY_TYPES.get(key_type, ()):
+            raise UnsupportedPartitioning(f'{self.table} is partitioned by {strategy} on {key_type}')
+        if sequence is None:
+            raise UnsupportedPartitioning(f'json_data_id of {self.table} is not taken from a sequence')
+        ranges, values, default = [], {}, None
+        for name, bound in partitions:
+            match = (_RANGE_BOUND if strategy == RANGE else _LIST_BOUND).match(bound)
+            if bound == 'DEFAULT':
+                default = name
+            elif match is None:
+                raise UnsupportedPartitioning(f'the bound of {name} is not understood: {bound}')
+            elif strategy == RANGE:
+                lower, upper = (_bound_values(part, key_type) for part in match.groups())
+                ranges.append((lower[0], upper[0], name))
+            else:
+                values.update(dict.fromkeys(_bound_values(match.group(1), key_type), name))
+        # MINVALUE sorts first, so it is the range of keys below every other lower bound
+        ranges.sort(key=lambda bounds: (bounds[0] is not None, bounds[0] or 0))
+        self._ranges, self._values, self.default = ranges, values, default
+        self._lowers = [lower for lower, _, _ in ranges if lower is not None]
+        self.strategy, self.sequence = strategy, sequence
+        self.key_index = JSON_DATA_COLUMNS.index(column)
+
+    def partition_of(self, row):
+        """ the partition a row belongs in, or None when the map has none for it """
+        key = row[self.key_index]
+        if self.strategy == LIST:
+            return self._values.get(key, self.default)
+        if key is None:
+            return self.default
+        unbounded_below = bool(self._ranges) and self._ranges[0][0] is None
+        position = bisect.bisect_right(self._lowers, key) - 1 + unbounded_below
+        if position >= 0:
+            _, upper, name = self._ranges[position]
+            if upper is None or key < upper:
+                return name
+        return self.default
+
+    def group(self, rows):
+        """ the positions of rows by the partition they belong in, those with none under None """
+        groups = {}
+        for position, row in enumerate(rows):
+            groups.setdefault(self.partition_of(row), []).append(position)
+        return groups
+
+
+class RowCopyReader:
+    """
+    file-like adapter feeding rows to cursor.copy_expert in COPY text format,
+    each led by the json_data_id given for it
+    """
+    _escapes = (('\\', '\\\\'), ('\n', '\\n'), ('\r', '\\r'), ('\t', '\\t'))
+
+    def __init__(self, rows, ids):
+        self._lines = (self._line((json_data_id,) + tuple(row)) for json_data_id, row in zip(ids, rows))
+
+    def _line(self, values):
+        fields = []
+        for value in values:
+            if value is None:
+                fields.append('\\N')
+                continue
+            text = value.isoformat(' ') if isinstance(value, datetime.datetime) else str(value)
+            for char, escaped in self._escapes:
+                text = text.replace(char, escaped)
+            fields.append(text)
+        return '\t'.join(fields) + '\n'
+
+    def read(self, size=-1):
+        return next(self._lines, '')
@@ -0,0 +1,110 @@
+"""
+The queues a worker pulls S3 event messages from: an SQS queue, or an
+in-memory stand-in for local runs and tests.
+
+A message received is hidden from other receivers until it is acknowledged,
+which deletes it, or released, which makes it visible again.
+"""
+import collections
+import itertools
+import threading
+import time
+
+from botocore.config import Config
+
+from .config import CONFIG
+from .s3 import new_client
+
+Message = collections.namedtuple('Message', ['id', 'body', 'receipt'])
+
+# the most messages SQS hands back or deletes in one call
+SQS_BATCH = 10
+# the longest SQS long polls for
+SQS_MAX_WAIT = 20
+
+
+class SqsQueue:
+
+    def __init__(self, url, region=None, visibility_timeout=None):
+        self.url = url
+        self.visibility_timeout = visibility_timeout
+        self.sqs = new_client('sqs', region_name=region or CONFIG['aws']['region'],
+                              config=Config(retries={'max_attempts': 5, 'mode': 'standard'}))
+
+    def receive(self, max_messages=SQS_BATCH, wait_seconds=SQS_MAX_WAIT):
+        """ up to max_messages messages, waiting up to wait_seconds for the first """
+        arguments = {'QueueUrl': self.url, 'MaxNumberOfMessages': max(1, min(max_messages, SQS_BATCH)),
+                     'WaitTimeSeconds': max(0, min(int(wait_seconds), SQS_MAX_WAIT))}
+        if self.visibility_timeout is not None:
+            arguments['VisibilityTimeout'] = self.visibility_timeout
+        response = self.sqs.receive_message(**arguments)
+        return [Message(message['MessageId'], message['Body'], message['ReceiptHandle'])
+                for message in response.get('Messages', [])]
+
+    def ack(self, messages):
+        """ deletes messages, returning the ids of those that could not be deleted """
+        failed = []
+        for start in range(0, len(messages), SQS_BATCH):
+            batch = messages[start:start + SQS_BATCH]
+            response = self.sqs.delete_message_batch(QueueUrl=self.url, Entries=[
+                {'Id': str(position), 'ReceiptHandle': message.receipt} for position, message in enumerate(batch)])
+            failed.extend(batch[int(entry['Id'])].id for entry in response.get('Failed', []))
+        return failed
+
+    def release(self, messages):
+        """ makes messages visible to receivers again straight away """
+        for start in range(0, len(messages), SQS_BATCH):
+            batch = messages[start:start + SQS_BATCH]
+            self.sqs.change_message_visibility_batch(QueueUrl=self.url, Entries=[
+                {'Id': str(position), 'ReceiptHandle': message.receipt, 'VisibilityTimeout': 0}
+                for position, message in enumerate(batch)])
+
+
+class LocalQueue:
+    """ an in-memory queue with the same interface, safe to share between threads """
+
+    def __init__(self, bodies=()):
+        self._pending = collections.deque()
+        self._in_flight = {}
+        self._ids = itertools.count(1)
+        self._condition = threading.Condition()
+        self.acked = []
+        for body in bodies:
+            self.put(body)
+
+    def put(self, body):
+        with self._condition:
+            number = next(self._ids)
+            self._pending.append(Message(f'message-{number}', body, f'receipt-{number}'))
+            self._condition.notify()
+
+    def receive(self, max_messages=SQS_BATCH, wait_seconds=0):
+        deadline = time.monotonic() + wait_seconds
+        with self._condition:
+            while not self._pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self._condition.wait(remaining)
+            messages = [self._pending.popleft() for _ in range(min(max_messages, len(self._pending)))]
+            self._in_flight.update((message.receipt, message) for message in messages)
+            return messages
+
+    def ack(self, messages):
+        with self._condition:
+            for message in messages:
+                self.acked.append(self._in_flight.pop(message.receipt))
+        return []
+
+    def release(self, messages):
+        with self._condition:
+            for message in messages:
+                self._pending.append(self._in_flight.pop(message.receipt))
+            self._condition.notify_all()
+
+    @property
+    def in_flight(self):
+        return list(self._in_flight.values())
+
+    def __len__(self):
+        return len(self._pending)
@@ -4,14 +4,34 @@ This module manages persisting data from a message into the RDS Resource.
 
 # the postgresql connection module
 from psycopg2 import connect
-from psycopg2 import OperationalError, DataError, IntegrityError
+from psycopg2 import OperationalError, DataError, IntegrityError, InterfaceError
+from psycopg2.errors import CharacterNotInRepertoire, CheckViolation, InvalidTextRepresentation, UndefinedColumn, \
+    UndefinedTable, UntranslatableCharacter
+from psycopg2.extras import execute_values
 # json allows us to convert between dictionaries and json.
 import json
 import datetime
 import os
+import queue
+import random
+import re
+import struct
+import threading
+import time
+from contextlib import contextmanager
 
 # project specific configuration parameters.
+from . import metrics
+from .compression import CompressedContent, compress, decompress, encodings
 from .config import CONFIG
+from .json_stream import JsonValidator, JsonStreamError, validate
+from .lookups import JSON_DATA_LOOKUP_MIGRATION, LOOKUP_ATTRIBUTES, LOOKUP_CACHE, lookup_ids
+from .partitions import JSON_DATA_COLUMNS, PARTITION_STATS, PartitionMap, RowCopyReader
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # allows for logging information
 import logging
@@ -21,26 +41,447 @@ logger = logging.getLogger(__name__)
 logger.setLevel(log_level)
 
 
+INSERT_JSON_DATA = """
+    INSERT INTO capture.json_data 
+    (start_time, response_time, response_code, url, api,
+     script_name, script_pid,
+     parameters, json_content)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+    RETURNING json_data_id, partition_number;"""
+
+# multi-row form of the insert, the VALUES are filled in by execute_values
+INSERT_JSON_DATA_VALUES = """
+    INSERT INTO capture.json_data 
+    (start_time, response_time, response_code, url, api,
+     script_name, script_pid,
+     parameters, json_content)
+    VALUES %s
+    RETURNING json_data_id, partition_number;"""
+
+# content copied in with COPY is staged in a session scoped table until the row is inserted
+CREATE_CONTENT_STAGE = """
+    CREATE TEMPORARY TABLE IF NOT EXISTS json_content_stage
+    (json_content text) ON COMMIT DELETE ROWS;"""
+
+COPY_CONTENT_STAGE = "COPY json_content_stage (json_content) FROM STDIN"
+
+# the inserts run for every capture are prepared once per connection and run with EXECUTE
+PREPARE_INSERT_JSON_DATA = """
+    PREPARE insert_json_data (timestamp, timestamp, integer, text, text, text, integer, text, text) AS
+    INSERT INTO capture.json_data 
+    (start_time, response_time, response_code, url, api,
+     script_name, script_pid,
+     parameters, json_content)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+    RETURNING json_data_id, partition_number;"""
+
+EXECUTE_INSERT_JSON_DATA = "EXECUTE insert_json_data (%s, %s, %s, %s, %s, %s, %s, %s, %s);"
+
+PREPARE_INSERT_JSON_DATA_FROM_STAGE = """
+    PREPARE insert_json_data_from_stage (timestamp, timestamp, integer, text, text, text, integer, text) AS
+    INSERT INTO capture.json_data 
+    (start_time, response_time, response_code, url, api,
+     script_name, script_pid,
+     parameters, json_content)
+    SELECT $1, $2, $3, $4, $5, $6, $7, $8, json_content
+    FROM json_content_stage
+    RETURNING json_data_id, partition_number;"""
+
+EXECUTE_INSERT_JSON_DATA_FROM_STAGE = "EXECUTE insert_json_data_from_stage (%s, %s, %s, %s, %s, %s, %s, %s);"
+
+# content sent as one CSV field, either as its undecoded JSON string literal or quoted with a
+# character that cannot appear in valid JSON. neither holds a character COPY treats specially
+# so no escaping is needed. the literal is unescaped by the server when it is inserted
+COPY_CSV_STAGE = "COPY json_content_stage (json_content) FROM STDIN WITH (FORMAT csv, DELIMITER E'\\x1f', QUOTE E'\\x1e')"
+CSV_QUOTE = b'\x1e'
+
+PREPARE_INSERT_JSON_DATA_FROM_LITERAL_STAGE = """
+    PREPARE insert_json_data_from_literal_stage (timestamp, timestamp, integer, text, text, text, integer, text) AS
+    INSERT INTO capture.json_data 
+    (start_time, response_time, response_code, url, api,
+     script_name, script_pid,
+     parameters, json_content)
+    SELECT $1, $2, $3, $4, $5, $6, $7, $8, json_content::json #>> '{}'
+    FROM json_content_stage
+    RETURNING json_data_id, partition_number;"""
+
+EXECUTE_INSERT_JSON_DATA_FROM_LITERAL_STAGE = \
+    "EXECUTE insert_json_data_from_literal_stage (%s, %s, %s, %s, %s, %s, %s, %s);"
+
+# compressed content is stored in json_content_compressed, marked with its content_encoding, and
+# json_content is left null. it is copied in as one bytea value in COPY binary format
+CREATE_COMPRESSED_STAGE = """
+    CREATE TEMPORARY TABLE IF NOT EXISTS json_content_compressed_stage
+    (json_content_compressed bytea) ON COMMIT DELETE ROWS;"""
+
+COPY_COMPRESSED_STAGE = \
+    "COPY json_content_compressed_stage (json_content_compressed) FROM STDIN WITH (FORMAT binary)"
+
+PREPARE_INSERT_COMPRESSED_JSON_DATA_FROM_STAGE = """
+    PREPARE insert_compressed_json_data_from_stage
+    (timestamp, timestamp, integer, text, text, text, integer, text, text) AS
+    INSERT INTO capture.json_data 
+    (start_time, response_time, response_code, url, api,
+     script_name, script_pid,
+     parameters, content_encoding, json_content_compressed)
+    SELECT $1, $2, $3, $4, $5, $6, $7, $8, $9, json_content_compressed
+    FROM json_content_compressed_stage
+    RETURNING json_data_id, partition_number;"""
+
+EXECUTE_INSERT_COMPRESSED_JSON_DATA_FROM_STAGE = \
+    "EXECUTE insert_compressed_json_data_from_stage (%s, %s, %s, %s, %s, %s, %s, %s, %s);"
+
+# content and parameters left for the database to check, by casting them to jsonb as the row is inserted.
+# the casts are in a filter that is always true when they succeed, so the text is stored as it was sent
+PREPARE_INSERT_CHECKED_JSON_DATA = """
+    PREPARE insert_checked_json_data (timestamp, timestamp, integer, text, text, text, integer, text, text) AS
+    INSERT INTO capture.json_data 
+    (start_time, response_time, response_code, url, api,
+     script_name, script_pid,
+     parameters, json_content)
+    SELECT $1, $2, $3, $4, $5, $6, $7, $8, $9
+    WHERE $8::jsonb IS NOT NULL AND $9::jsonb IS NOT NULL
+    RETURNING json_data_id, partition_number;"""
+
+EXECUTE_INSERT_CHECKED_JSON_DATA = "EXECUTE insert_checked_json_data (%s, %s, %s, %s, %s, %s, %s, %s, %s);"
+
+PREPARE_INSERT_CHECKED_JSON_DATA_FROM_STAGE = """
+    PREPARE insert_checked_json_data_from_stage (timestamp, timestamp, integer, text, text, text, integer, text) AS
+    INSERT INTO capture.json_data 
+    (start_time, response_time, response_code, url, api,
+     script_name, script_pid,
+     parameters, json_content)
+    SELECT $1, $2, $3, $4, $5, $6, $7, $8, json_content
+    FROM json_content_stage
+    WHERE $8::jsonb IS NOT NULL AND json_content::jsonb IS NOT NULL
+    RETURNING json_data_id, partition_number;"""
+
+EXECUTE_INSERT_CHECKED_JSON_DATA_FROM_STAGE = \
+    "EXECUTE insert_checked_json_data_from_stage (%s, %s, %s, %s, %s, %s, %s, %s);"
+
+# what a failed cast to jsonb raises, untranslatable for a \u0000 escape, and what copying in a NUL character raises
+JSONB_CAST_ERRORS = (InvalidTextRepresentation, UntranslatableCharacter, CharacterNotInRepertoire)
+
+SELECT_JSON_CONTENT = """
+    SELECT json_content, json_content_compressed, content_encoding
+    FROM capture.json_data WHERE json_data_id = %s AND partition_number = %s;"""
+
+# batches copied into the table or straight into its partitions, with ids taken from its sequence ahead of the copy
+JSON_DATA_TABLE = 'capture.json_data'
+SELECT_JSON_DATA_SEQUENCE = "SELECT pg_get_serial_sequence('capture.json_data', 'json_data_id');"
+SELECT_JSON_DATA_IDS = "SELECT nextval(%s) FROM generate_series(1, %s);"
+COPY_JSON_DATA_ROWS = "COPY {table} (json_data_id, " + ', '.join(JSON_DATA_COLUMNS) + ") FROM STDIN"
+SELECT_COPIED_ROWS = "SELECT json_data_id, partition_number FROM {table} WHERE json_data_id = ANY(%s);"
+# a partition that no longer takes the rows the map puts in it, or is gone
+STALE_PARTITION_ERRORS = (CheckViolation, UndefinedTable)
+
+# what is set up on a connection before use, by name, in the order it is set up in
+PREPARED = {
+    'insert_json_data': PREPARE_INSERT_JSON_DATA,
+    'json_content_stage': CREATE_CONTENT_STAGE,
+    'insert_json_data_from_stage': PREPARE_INSERT_JSON_DATA_FROM_STAGE,
+    'insert_json_data_from_literal_stage': PREPARE_INSERT_JSON_DATA_FROM_LITERAL_STAGE,
+    'compressed_content_stage': CREATE_COMPRESSED_STAGE,
+    'insert_compressed_json_data_from_stage': PREPARE_INSERT_COMPRESSED_JSON_DATA_FROM_STAGE,
+    'insert_checked_json_data': PREPARE_INSERT_CHECKED_JSON_DATA,
+    'insert_checked_json_data_from_stage': PREPARE_INSERT_CHECKED_JSON_DATA_FROM_STAGE,
+}
+
+# with ATTRIBUTE_LOOKUPS each insert has a form storing the ids of the url, api, script_name and parameters
+# of a capture in capture.json_data_lookup in place of the values, taking the ids where it took the values.
+# the database no longer sees the parameters, so they are always checked here
+LOOKUPS = '_with_lookups'
+_LOOKUP_REWRITES = (
+    (re.compile(r'PREPARE (\w+)'), r'PREPARE \1' + LOOKUPS),
+    (re.compile(r'\(timestamp, timestamp, integer, text, text, text, integer, text'),
+     '(timestamp, timestamp, integer, integer, integer, integer, integer, integer'),
+    (re.compile(r'url, api,(\s+)script_name, script_pid,(\s+)parameters,'),
+     r'url_id, api_id,\1script_name_id, script_pid,\2parameters_id,'),
+)
+# the cast of the parameters to jsonb, in the inserts that leave checking them to the database
+_CHECKED_PARAMETERS = re.compile(r'\$8::jsonb IS NOT NULL AND ')
+
+
+def _with_lookups(name, prepare):
+    """
+    the form of the prepared insert name taking ids, raising ValueError when the insert
+    is not written the way the rewrites expect, rather than preparing the wrong columns
+    """
+    for pattern, replacement in _LOOKUP_REWRITES:
+        prepare, count = pattern.subn(replacement, prepare)
+        if count != 1:
+            raise ValueError(f'{name} has {count} matches of {pattern.pattern} rather than one')
+    prepare = _CHECKED_PARAMETERS.sub('', prepare)
+    if '$8::jsonb' in prepare:
+        raise ValueError(f'{name} casts the parameters to jsonb other than as {_CHECKED_PARAMETERS.pattern}')
+    return prepare
+
+
+PREPARED.update({name + LOOKUPS: _with_lookups(name, prepare) for name, prepare in list(PREPARED.items())
+                 if name.startswith('insert')})
+# the EXECUTE of the form of each insert taking ids, by the EXECUTE of the insert
+WITH_LOOKUPS = {execute: execute.replace(' (', LOOKUPS + ' (', 1) for execute in (
+    EXECUTE_INSERT_JSON_DATA, EXECUTE_INSERT_JSON_DATA_FROM_STAGE, EXECUTE_INSERT_JSON_DATA_FROM_LITERAL_STAGE,
+    EXECUTE_INSERT_COMPRESSED_JSON_DATA_FROM_STAGE, EXECUTE_INSERT_CHECKED_JSON_DATA,
+    EXECUTE_INSERT_CHECKED_JSON_DATA_FROM_STAGE)}
+
+
+# the captures already loaded, by the uuid of their S3 object, so that redelivered events load nothing.
+# the table is created by its migration rather than by the loader, whose role may not create tables in the schema
+JSON_DATA_LOAD_MIGRATION = 'migrations/001_json_data_load.sql'
+
+SELECT_JSON_DATA_LOAD = """
+    SELECT json_data_id, partition_number FROM capture.json_data_load WHERE uuid = %s;"""
+
+SELECT_JSON_DATA_LOADS = """
+    SELECT uuid, json_data_id, partition_number FROM capture.json_data_load WHERE uuid = ANY(%s);"""
+
+# a claim blocks concurrent loads of the same capture until the loading transaction ends
+CLAIM_JSON_DATA_LOAD = """
+    INSERT INTO capture.json_data_load (uuid) VALUES (%s)
+    ON CONFLICT (uuid) DO NOTHING
+    RETURNING uuid;"""
+
+RECORD_JSON_DATA_LOAD = """
+    UPDATE capture.json_data_load SET content_hash = %s, json_data_id = %s, partition_number = %s
+    WHERE uuid = %s;"""
+
+# batches claim their uuids in one statement, in order so that batches sharing captures do not deadlock
+CLAIM_JSON_DATA_LOADS = """
+    INSERT INTO capture.json_data_load (uuid)
+    SELECT unnest(%s::text[])
+    ON CONFLICT (uuid) DO NOTHING
+    RETURNING uuid;"""
+
+# records the rows the captures a batch claimed were loaded as
+INSERT_JSON_DATA_LOADS = """
+    INSERT INTO capture.json_data_load (uuid, content_hash, json_data_id, partition_number)
+    VALUES %s
+    ON CONFLICT (uuid) DO UPDATE SET content_hash = EXCLUDED.content_hash, json_data_id = EXCLUDED.json_data_id,
+    partition_number = EXCLUDED.partition_number;"""
+
+# gives up the claims of captures of a batch that failed to load
+RELEASE_JSON_DATA_LOADS = "DELETE FROM capture.json_data_load WHERE uuid = ANY(%s);"
+
+
+# ways of checking a value is well formed JSON, the scan does not build the parsed document
+JSON_VALIDATORS = {
+    'scan': validate,
+    'json': json.loads,
+}
+if orjson is not None:
+    JSON_VALIDATORS['orjson'] = orjson.loads
+# leaves the content and parameters of captures loaded in memory for the database to check,
+# other loads scan them as they are read
+JSONB = 'jsonb'
+
+# loads hold one of the advisory locks of this class, keyed by slot number, while they use the database
+# when the number of active loads is capped. the locks belong to the session, so a lost connection frees its slot
+ADMISSION_LOCK_CLASS = 0x41515453
+TRY_ADMISSION_LOCK = "SELECT pg_try_advisory_lock(%s, %s);"
+RELEASE_ADMISSION_LOCK = "SELECT pg_advisory_unlock(%s, %s);"
+
+# libpq waits at least this many seconds for a connection, an attempt is not started with less of the budget left
+MIN_CONNECT_TIMEOUT = 2
+# connection failures that waiting will not fix, they are not retried
+PERMANENT_CONNECT_ERRORS = ('password authentication failed', 'does not exist', 'no pg_hba.conf entry')
+
+# the RDS instance kept for the life of the container so warm invocations reuse its connection
+_shared = None
+CONNECTION_STATS = {'connects': 0, 'reconnects': 0, 'reused': 0, 'retries': 0, 'failures': 0, 'rejected': 0}
+# loads let through by the cap on active loads, those that had to wait for a slot, and those that gave up
+ADMISSION_STATS = {'admitted': 0, 'waited': 0, 'timeouts': 0}
+# captures found to be loaded already, and captures loaded for the first time, when deduplicating
+DEDUP_STATS = {'hits': 0, 'misses': 0}
+
+
 def convert_total_seconds_to_datetime(total_seconds):
     dt = datetime.datetime.utcfromtimestamp(float(total_seconds))
     return dt
 
 
+def backoff(attempt):
+    """ the jittered delay before retrying after attempt failures, so that failed loaders do not return together """
+    ceiling = CONFIG['connect']['retry_base_delay'] * 2 ** (attempt - 1)
+    return random.uniform(0, min(ceiling, CONFIG['connect']['retry_max_delay']))
+
+
+def is_transient(e):
+    """ whether a failure to connect may pass, such as a timeout or a database with no connections to spare """
+    return isinstance(e, OperationalError) and not any(text in str(e) for text in PERMANENT_CONNECT_ERRORS)
+
+
+class CircuitBreaker:
+    """
+    counts the failed connection attempts in a row and, once there have been breaker_failures of them,
+    fails every attempt straight away for breaker_cooldown seconds rather than adding to the load on a
+    saturated database. the first attempt after the cooldown is let through, and closes the breaker
+    when it connects or opens it for another cooldown when it fails
+    """
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def check(self):
+        """ raises CircuitOpen while the breaker is open """
+        with self._lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + CONFIG['connect']['breaker_cooldown'] - time.monotonic()
+            if remaining <= 0:
+                self.opened_at = None
+                return
+        CONNECTION_STATS['rejected'] += 1
+        raise CircuitOpen(f'Not connecting for another {remaining:.1f} seconds after '
+                          f'{self.failures} failed connection attempts in a row')
+
+    def succeeded(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failed(self):
+        """ counts a failed attempt, returning whether the breaker is open """
+        with self._lock:
+            self.failures += 1
+            if self.opened_at is None and self.failures >= CONFIG['connect']['breaker_failures']:
+                self.opened_at = time.monotonic()
+                logger.warning(f'Opened the circuit breaker after {self.failures} failed connection attempts.')
+            return self.opened_at is not None
+
+
+# shared by every connection of the container
+BREAKER = CircuitBreaker()
+
+
+def shared_rds():
+    """
+    returns the RDS instance for this container, connecting on first use and
+    reconnecting when the connection has gone stale or broken since the last invocation
+    """
+    global _shared
+    if _shared is None:
+        _shared = RDS()
+    elif _shared.is_healthy():
+        CONNECTION_STATS['reused'] += 1
+    else:
+        _shared.reconnect()
+    return _shared
+
+
+def discard_shared_rds():
+    """ closes and forgets the shared instance, e.g. after a failure that left it unusable """
+    global _shared
+    if _shared is not None:
+        _shared.close_quietly()
+        _shared = None
+
+
+class RdsPool:
+    """
+    a small pool of RDS instances shared by worker threads, each thread
+    borrows an instance for as long as it needs a connection
+    """
+
+    def __init__(self, size, **rds_options):
+        self.size = size
+        self.rds_options = rds_options
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _take(self):
+        """ an idle instance, a new one while the pool is not full, else waits for one to be returned """
+        while True:
+            try:
+                return self._idle.get_nowait(), False
+            except queue.Empty:
+                pass
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            if create:
+                try:
+                    return RDS(**self.rds_options), True
+                except Exception:
+                    self._forget()
+                    raise
+            try:
+                # wake up now and then in case an instance was lost rather than returned
+                return self._idle.get(timeout=1), False
+            except queue.Empty:
+                continue
+
+    def _forget(self):
+        with self._lock:
+            self._created -= 1
+
+    @contextmanager
+    def connection(self):
+        rds, created = self._take()
+        if not created and rds.is_healthy():
+            CONNECTION_STATS['reused'] += 1
+        elif not created:
+            try:
+                rds.reconnect()
+            except Exception:
+                self._forget()
+                raise
+        try:
+            yield rds
+        finally:
+            self._idle.put(rds)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close_quietly()
+            except queue.Empty:
+                return
+
+
 class RDS:
 
-    def __init__(self, connect_timeout=65):
+    def __init__(self, connect_timeout=None, json_validator=None, dedup=None, compression=None,
+                 partition_routing=None, attribute_lookups=None):
         """
         connect to the database resource.
 
-        wait for 50 seconds before giving up on getting a connection
+        each attempt waits connect_timeout seconds, DB_CONNECT_TIMEOUT by default, and attempts
+        stop once DB_CONNECT_BUDGET seconds have been spent, well within the timeout of the function
 
         """
+        self.dedup = CONFIG['load']['dedup'] if dedup is None else dedup
+        json_validator = json_validator or CONFIG['load']['json_validator']
+        self.jsonb_validation = json_validator == JSONB
+        if self.jsonb_validation:
+            json_validator = 'scan'
+        elif json_validator not in JSON_VALIDATORS:
+            logger.warning(f'JSON validator {json_validator} is not available, scanning instead.')
+            json_validator = 'scan'
+        self.json_validator = JSON_VALIDATORS[json_validator]
+        compression = CONFIG['load']['content_compression'] if compression is None else compression
+        if compression and compression not in encodings():
+            logger.warning(f'Content encoding {compression} is not available, using gzip instead.')
+            compression = 'gzip'
+        self.compression = compression or None
+        if partition_routing is None:
+            partition_routing = CONFIG['load']['partition_routing']
+        self.partitions = PartitionMap(JSON_DATA_TABLE, CONFIG['load']['partition_map_ttl']) \
+            if partition_routing else None
+        self._sequence = None
+        if attribute_lookups is None:
+            attribute_lookups = CONFIG['load']['attribute_lookups']
+        self.attribute_lookups = attribute_lookups
         self.connection_parameters = {
             'host': CONFIG['rds']['host'],
             'database': CONFIG['rds']['database'],
             'user': CONFIG['rds']['user'],
             'password': CONFIG['rds']['password'],
-            'connect_timeout': connect_timeout
+            'connect_timeout': connect_timeout or CONFIG['connect']['timeout']
             # keyword argument from https://www.postgresql.org/docs/current/libpq-connect.html#LIBPQ-PARAMKEYWORDS
 
         }
@@ -48,12 +489,68 @@ class RDS:
         self.conn, self.cursor = self._connect()
 
     def _connect(self):
-        conn = connect(**self.connection_parameters)  # should raise a OperationalError if it can't get a connection
+        """
+        connects, retrying transient failures after a backoff until the connect budget is spent.
+        raises DatabaseUnavailable when no connection could be made, or CircuitOpen without
+        trying while the circuit breaker is open
+        """
+        deadline = time.monotonic() + CONFIG['connect']['budget']
+        attempt = 0
+        while True:
+            BREAKER.check()
+            attempt += 1
+            # the last attempt only waits for what is left of the budget
+            remaining = int(deadline - time.monotonic())
+            timeout = max(MIN_CONNECT_TIMEOUT, min(self.connection_parameters['connect_timeout'], remaining))
+            try:
+                # should raise a OperationalError if it can't get a connection
+                conn = connect(**dict(self.connection_parameters, connect_timeout=timeout))
+            except OperationalError as e:
+                opened = BREAKER.failed()
+                delay = backoff(attempt)
+                if opened or not is_transient(e) or time.monotonic() + delay + MIN_CONNECT_TIMEOUT > deadline:
+                    CONNECTION_STATS['failures'] += 1
+                    raise DatabaseUnavailable(f'Could not connect to the database in {attempt} attempts: {e}') from e
+                logger.info(f'Connection attempt {attempt} failed, retrying in {delay:.2f} seconds: {repr(e)}')
+                CONNECTION_STATS['retries'] += 1
+                time.sleep(delay)
+            else:
+                BREAKER.succeeded()
+                break
+        CONNECTION_STATS['connects'] += 1
         # Interestingly, autocommit seemed necessary for create table too.
         conn.autocommit = True
         cursor = conn.cursor()
+        # prepared statements and temporary tables belong to the connection
+        self._prepared = set()
         return conn, cursor
 
+    def is_healthy(self):
+        """
+        checks that the connection is open and still answers a trivial query
+        """
+        if self.conn.closed:
+            return False
+        try:
+            self.cursor.execute('SELECT 1')
+            self.cursor.fetchone()
+        except (OperationalError, InterfaceError) as e:
+            logger.debug(f'Connection failed its health check: {repr(e)}', exc_info=True)
+            return False
+        return True
+
+    def reconnect(self):
+        self.close_quietly()
+        self.conn, self.cursor = self._connect()
+        CONNECTION_STATS['reconnects'] += 1
+        logger.debug(f'Reconnected to database: {self.conn}.')
+
+    def close_quietly(self):
+        try:
+            self.conn.close()
+        except (OperationalError, InterfaceError) as e:
+            logger.debug(f'Error closing connection: {repr(e)}', exc_info=True)
+
     def disconnect(self):
         try:
             self.conn.close()
@@ -69,7 +566,10 @@ class RDS:
         shared method to connect and run an SQL statement.
         note that this is not efficient for most uses but this script has limited statements
         """
-        logger.debug(f'SQL: {self.cursor.mogrify(sql, params)}.')
+        sql = self._statement(sql)
+        if logger.isEnabledFor(logging.DEBUG):
+            # mogrify copies the whole payload, so only when it will be logged
+            logger.debug(f'SQL: {self.cursor.mogrify(sql, params)}.')
         try:
             if len(params):
                 self.cursor.execute(sql, params)
@@ -78,16 +578,68 @@ class RDS:
         except (OperationalError, DataError, IntegrityError) as e:
             logger.debug(f'Error during SQL execution: {repr(e)}', exc_info=True)
             logger.debug('Transaction will be rolled back.')
-            self.conn.rollback()
+            if not self.conn.closed:
+                self.conn.rollback()
+            raise
         else:
             id_and_partition_number = self.cursor.fetchone()
             logger.debug(f'New record ID and partition number: {id_and_partition_number}')
             return id_and_partition_number
 
-    def persist_data(self, datum):
+    @contextmanager
+    def admitted(self):
         """
-        validates each value and
-        persists the message to RDS.
+        holds one of the DB_MAX_ACTIVE slots shared by every loader while the enclosed block runs,
+        waiting for one to be freed while they are all taken. raises AdmissionTimeout when none is
+        freed within DB_ADMISSION_TIMEOUT seconds. does nothing when the active loads are not capped
+        """
+        max_active = CONFIG['connect']['max_active']
+        if not max_active:
+            yield
+            return
+        slot = self._acquire_slot(max_active)
+        try:
+            yield
+        finally:
+            self._release_slot(slot)
+
+    def _acquire_slot(self, max_active):
+        deadline = time.monotonic() + CONFIG['connect']['admission_timeout']
+        attempt = 0
+        while True:
+            # trying the slots from a random one on keeps loaders from all contending for the first
+            first = random.randrange(max_active)
+            for slot in range(first, first + max_active):
+                slot %= max_active
+                self.cursor.execute(TRY_ADMISSION_LOCK, (ADMISSION_LOCK_CLASS, slot))
+                if self.cursor.fetchone()[0]:
+                    ADMISSION_STATS['admitted'] += 1
+                    if attempt:
+                        ADMISSION_STATS['waited'] += 1
+                    return slot
+            attempt += 1
+            delay = backoff(attempt)
+            if time.monotonic() + delay >= deadline:
+                ADMISSION_STATS['timeouts'] += 1
+                raise AdmissionTimeout(f'All {max_active} database slots stayed taken for '
+                                       f'{CONFIG["connect"]["admission_timeout"]} seconds')
+            time.sleep(delay)
+
+    def _release_slot(self, slot):
+        if self.conn.closed:
+            # the server let go of the lock with the session
+            return
+        try:
+            self.cursor.execute(RELEASE_ADMISSION_LOCK, (ADMISSION_LOCK_CLASS, slot))
+            self.cursor.fetchone()
+        except (OperationalError, InterfaceError) as e:
+            logger.debug(f'Error releasing database slot {slot}: {repr(e)}', exc_info=True)
+
+    def validate_attributes(self, datum, check_json=True):
+        """
+        validates the metadata attributes of a message, the parameters are only
+        checked to be present when check_json is False.
+        returns the API call to persist
         """
         # ensure time is well formatted
         self.validate_time("Start Time", datum.start_time)
@@ -103,27 +655,570 @@ class RDS:
         api = self.validate_api(datum.api, datum.url)
 
         # ensure valid json using json module testing
-        self.validate_json("Parameters", datum.parameters)
-        self.validate_json("JSON Data", datum.content)
+        if check_json:
+            self.validate_json("Parameters", datum.parameters)
+        else:
+            self.validate_contains("Parameters", datum.parameters)
+        return api
 
-        insert_json_data = """
-            INSERT INTO capture.json_data 
-            (start_time, response_time, response_code, url, api,
-             script_name, script_pid,
-             parameters, json_content)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING json_data_id, partition_number;"""
-        logger.debug('Inserting data in the database.')
-        db_resp = self._execute_sql(
-            insert_json_data, (
-                convert_total_seconds_to_datetime(datum.start_time),
-                convert_total_seconds_to_datetime(datum.response_time), int(datum.response_code),
-                datum.url, api, datum.script_name, int(datum.script_pid),
-                datum.parameters, datum.content
-            )
+    @staticmethod
+    def _attribute_params(datum, api):
+        return (
+            convert_total_seconds_to_datetime(datum.start_time),
+            convert_total_seconds_to_datetime(datum.response_time), int(datum.response_code),
+            datum.url, api, datum.script_name, int(datum.script_pid),
+            datum.parameters
         )
+
+    def _insert_params(self, datum, api):
+        """
+        the parameters of the insert of a capture, with the ids of its url, api, script_name and
+        parameters in place of the values when storing them by id
+        """
+        params = self._attribute_params(datum, api)
+        if not self.attribute_lookups:
+            return params
+        keys = [(attribute, params[position]) for attribute, position in LOOKUP_ATTRIBUTES
+                if params[position] is not None]
+        with metrics.stage('lookup'):
+            # values added outside of a transaction are committed as they are added, their ids can be cached
+            try:
+                ids = lookup_ids(self.cursor, keys, LOOKUP_CACHE, committed=self.conn.autocommit)
+            except UndefinedTable as e:
+                raise RuntimeError(f'capture.json_data_lookup does not exist, create it with '
+                                   f'{JSON_DATA_LOOKUP_MIGRATION} before setting ATTRIBUTE_LOOKUPS') from e
+        params = list(params)
+        for attribute, position in LOOKUP_ATTRIBUTES:
+            if params[position] is not None:
+                params[position] = ids[(attribute, params[position])]
+        return tuple(params)
+
+    def persist_data(self, datum):
+        """
+        validates each value and
+        persists the message to RDS.
+        """
+        # compressed content cannot be checked by the database, nor parameters stored by id
+        in_database = self.jsonb_validation and not self.compression
+        with metrics.stage('validate', len(datum.content)):
+            api = self.validate_attributes(datum, check_json=not in_database or self.attribute_lookups)
+            if in_database:
+                self.validate_contains("JSON Data", datum.content)
+            else:
+                self.validate_json("JSON Data", datum.content)
+
+        logger.debug('Inserting data in the database.')
+        params = self._insert_params(datum, api)
+        if in_database:
+            return self._insert_checked(datum, params)
+        if self.compression:
+            with metrics.stage('compress', len(datum.content)):
+                compressed = compress(datum.content, self.compression, CONFIG['load']['compression_level'],
+                                      CONFIG['load']['stream_chunk_size'])
+            self._prepare('compressed_content_stage', 'insert_compressed_json_data_from_stage')
+            return self._insert_once(datum, lambda: self._insert_compressed(compressed, params))
+        with metrics.stage('insert', len(datum.content)):
+            if len(datum.content) >= CONFIG['load']['copy_content_min_size']:
+                # copied in rather than interpolated into the statement, which would escape it
+                self._prepare('json_content_stage', 'insert_json_data_from_stage')
+                db_resp = self._insert_once(datum, lambda: self._insert_copied(datum.content, params))
+            elif self.dedup:
+                self._prepare('insert_json_data')
+                db_resp = self._insert_once(datum, lambda: self._fetch(EXECUTE_INSERT_JSON_DATA,
+                                                                       params + (datum.content,)))
+            else:
+                self._prepare('insert_json_data')
+                db_resp = self._execute_sql(EXECUTE_INSERT_JSON_DATA, params + (datum.content,))
         return db_resp
 
+    def _prepare(self, *names):
+        """ prepares statements and tables on the connection the first time they are needed """
+        for name in names:
+            if self.attribute_lookups and name + LOOKUPS in PREPARED:
+                name += LOOKUPS
+            if name not in self._prepared:
+                try:
+                    self.cursor.execute(PREPARED[name])
+                except UndefinedColumn as e:
+                    if not name.endswith(LOOKUPS):
+                        raise
+                    raise RuntimeError(f'capture.json_data has no id columns, add them with '
+                                       f'{JSON_DATA_LOOKUP_MIGRATION} before setting ATTRIBUTE_LOOKUPS') from e
+                self._prepared.add(name)
+
+    def _statement(self, sql):
+        """ the form of an insert taking the ids of looked up values when storing them by id """
+        return WITH_LOOKUPS.get(sql, sql) if self.attribute_lookups else sql
+
+    def _fetch(self, sql, params):
+        self.cursor.execute(self._statement(sql), params)
+        return self.cursor.fetchone()
+
+    def _insert_copied(self, content, params):
+        encoded = content.encode('utf-8')
+        self.cursor.copy_expert(COPY_CSV_STAGE, LiteralCopyReader(encoded, 0, len(encoded), quote=CSV_QUOTE),
+                                CONFIG['load']['stream_chunk_size'])
+        return self._fetch(EXECUTE_INSERT_JSON_DATA_FROM_STAGE, params)
+
+    def _insert_escaped(self, content, params):
+        """
+        copies content not known to be JSON in as one row in COPY text format, escaped a piece at a time,
+        as the CSV framing of _insert_copied only holds for valid JSON
+        """
+        chunk_size = CONFIG['load']['stream_chunk_size']
+        reader = ContentCopyReader((content[i:i + chunk_size] for i in range(0, len(content), chunk_size)),
+                                   check_json=False)
+        self.cursor.copy_expert(COPY_CONTENT_STAGE, reader)
+        reader.check()
+        return self._fetch(EXECUTE_INSERT_CHECKED_JSON_DATA_FROM_STAGE, params)
+
+    def _insert_checked(self, datum, params):
+        """
+        inserts a capture whose content and parameters the database checks by casting them to jsonb,
+        raising the ValidationException checking them here would have when either is not JSON
+        """
+        with metrics.stage('insert', len(datum.content)):
+            try:
+                if len(datum.content) >= CONFIG['load']['copy_content_min_size']:
+                    self._prepare('json_content_stage', 'insert_checked_json_data_from_stage')
+                    return self._insert_once(datum, lambda: self._insert_escaped(datum.content, params))
+                self._prepare('insert_checked_json_data')
+                return self._insert_once(datum, lambda: self._fetch(EXECUTE_INSERT_CHECKED_JSON_DATA,
+                                                                    params + (datum.content,)))
+            except JSONB_CAST_ERRORS as e:
+                logger.debug(f'Rejected by the database: {repr(e)}', exc_info=True)
+        # the error does not say which value failed, the parameters are small enough to check here
+        self.validate_json("Parameters", datum.parameters)
+        raise ValidationException("Must be JSON", "JSON Data", "expected valid JSON", datum.content)
+
+    def _compress_content(self, pieces):
+        """ validates and compresses content as it is fed in pieces """
+        validator = JsonValidator()
+        compressed = CompressedContent(self.compression, CONFIG['load']['compression_level'])
+        try:
+            for piece in pieces:
+                validator.feed(piece)
+                compressed.feed(piece)
+            validator.close()
+        except JsonStreamError as e:
+            raise ValidationException("Must be JSON", "JSON Data", "expected valid JSON", repr(e))
+        return compressed.close()
+
+    def _insert_compressed(self, compressed, params):
+        """ copies compressed content in and inserts the row from it, within a transaction """
+        logger.debug(f'Inserting {compressed.raw_size} bytes of content compressed with '
+                     f'{compressed.encoding} to {compressed.size} bytes.')
+        with metrics.stage('insert', compressed.size):
+            self.cursor.copy_expert(COPY_COMPRESSED_STAGE, BinaryCopyReader(compressed.chunks, compressed.size))
+            return self._fetch(EXECUTE_INSERT_COMPRESSED_JSON_DATA_FROM_STAGE, params + (compressed.encoding,))
+
+    def read_content(self, json_data_id, partition_number):
+        """
+        the content of a loaded capture as text, decompressed when it was stored compressed
+        """
+        self.cursor.execute(SELECT_JSON_CONTENT, (json_data_id, partition_number))
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        content, compressed, encoding = row
+        return content if encoding is None else decompress(compressed, encoding)
+
+    @contextmanager
+    def _load_table(self):
+        """ raises a RuntimeError saying how to create capture.json_data_load when it is missing """
+        try:
+            yield
+        except UndefinedTable as e:
+            raise RuntimeError(f'capture.json_data_load does not exist, create it with {JSON_DATA_LOAD_MIGRATION} '
+                               f'before setting DEDUP_LOADS') from e
+
+    def find_loaded(self, uuid):
+        """
+        the json_data_id and partition_number a capture was loaded as, None when it has not been loaded
+        """
+        with self._load_table():
+            self.cursor.execute(SELECT_JSON_DATA_LOAD, (uuid,))
+        found = self.cursor.fetchone()
+        if found is not None:
+            DEDUP_STATS['hits'] += 1
+            logger.debug(f'{uuid} has already been loaded as {found}')
+        return found
+
+    def find_loaded_many(self, uuids):
+        """ the json_data_id and partition_number of each of the captures that have been loaded, by uuid """
+        with self._load_table():
+            self.cursor.execute(SELECT_JSON_DATA_LOADS, (list(uuids),))
+        found = {uuid: (json_data_id, partition_number) for uuid, json_data_id, partition_number in self.cursor}
+        DEDUP_STATS['hits'] += len(found)
+        return found
+
+    def _claim(self, datum):
+        """
+        claims the uuid of a capture within the current transaction, returning the json_data_id and
+        partition_number it has already been loaded as when another load claimed it first, else None
+        """
+        with self._load_table():
+            self.cursor.execute(CLAIM_JSON_DATA_LOAD, (datum.uuid,))
+        if self.cursor.fetchone() is not None:
+            return None
+        # the other load has committed by now, or rolled back leaving the uuid unclaimed
+        self.cursor.execute(SELECT_JSON_DATA_LOAD, (datum.uuid,))
+        found = self.cursor.fetchone()
+        if found is None:
+            raise RuntimeError(f'{datum.uuid} was claimed by a load that did not finish, try again')
+        DEDUP_STATS['hits'] += 1
+        logger.debug(f'{datum.uuid} was loaded as {found} while this load was under way')
+        return found
+
+    def _record(self, datum, id_and_partition_number):
+        """ records the row a claimed capture was loaded as within the current transaction """
+        self.cursor.execute(RECORD_JSON_DATA_LOAD, (datum.content_hash,) + tuple(id_and_partition_number)
+                            + (datum.uuid,))
+        DEDUP_STATS['misses'] += 1
+
+    def _insert_once(self, datum, insert):
+        """
+        runs insert, which inserts a capture and returns its json_data_id and partition_number, in
+        one transaction. when deduplicating the capture is claimed first, and not inserted when
+        it has already been loaded
+        """
+        self.conn.autocommit = False
+        try:
+            id_and_partition_number = self._claim(datum) if self.dedup else None
+            if id_and_partition_number is None:
+                id_and_partition_number = insert()
+                if self.dedup:
+                    self._record(datum, id_and_partition_number)
+            self.conn.commit()
+        except Exception:
+            logger.debug('Transaction will be rolled back.')
+            self.conn.rollback()
+            raise
+        finally:
+            self.conn.autocommit = True
+        logger.debug(f'New record ID and partition number: {id_and_partition_number}')
+        return id_and_partition_number
+
+    def persist_batch(self, data):
+        """
+        validates each message and persists all of the valid ones to RDS in one
+        transaction with multi-row inserts.
+        returns, in order, either the (json_data_id, partition_number) or the
+        exception raised for each message so that one bad message does not fail the batch.
+        """
+        outcomes = [None] * len(data)
+        with metrics.stage('validate') as stage:
+            rows, positions = self._validate_batch(data, outcomes)
+            stage.bytes = sum(len(row[-1]) for row in rows)
+        if rows:
+            loads = [(data[position].uuid, data[position].content_hash) for position in positions] \
+                if self.dedup else None
+            for position, outcome in zip(positions, self.persist_rows(rows, loads)):
+                outcomes[position] = outcome
+        return outcomes
+
+    def batch_row(self, datum):
+        """ validates a message, returning the row it is inserted as by persist_rows """
+        api = self.validate_attributes(datum)
+        self.validate_json("JSON Data", datum.content)
+        return self._attribute_params(datum, api) + (datum.content,)
+
+    def persist_rows(self, rows, loads=None):
+        """
+        persists rows of validated messages in one transaction, loads are the
+        (uuid, content_hash) of each row when deduplicating.
+        returns, in order, either the (json_data_id, partition_number) or the
+        exception raised for each row
+        """
+        logger.debug(f'Inserting {len(rows)} rows in the database.')
+        with metrics.stage('insert', sum(len(row[-1]) for row in rows)):
+            return self._insert_rows(rows, loads=loads)
+
+    def copy_rows(self, rows, loads=None, page_size=100):
+        """
+        persists rows of validated messages with one COPY in one transaction, or one for each partition
+        when routing them to partitions. when a row fails the COPY the rows are persisted by persist_rows,
+        which isolates the bad ones. returns what persist_rows does
+        """
+        logger.debug(f'Copying {len(rows)} rows into the database.')
+        with metrics.stage('copy', sum(len(row[-1]) for row in rows)):
+            self.conn.autocommit = False
+            try:
+                ids = self._insert_claimed(rows, loads, lambda claimed: self._copy_values(claimed, page_size),
+                                           page_size)
+                if ids is not None:
+                    self.conn.commit()
+                    return ids
+                self.conn.rollback()
+            except (DataError, IntegrityError) as e:
+                logger.debug(f'Copying the rows failed, inserting them instead: {repr(e)}', exc_info=True)
+                self.conn.rollback()
+            except Exception:
+                logger.debug('Transaction will be rolled back.')
+                self.conn.rollback()
+                raise
+            finally:
+                self.conn.autocommit = True
+        return self.persist_rows(rows, loads)
+
+    def _copy_values(self, rows, page_size):
+        if self.partitions is not None:
+            return self._copy_to_partitions(rows, page_size)
+        return self._copy_rows(JSON_DATA_TABLE, rows)
+
+    def _copy_rows(self, table, rows):
+        """
+        copies rows into table, returning the json_data_id and partition_number of each,
+        or None when json_data_id is not taken from a sequence the ids can be taken from first
+        """
+        if self._sequence is None:
+            self.cursor.execute(SELECT_JSON_DATA_SEQUENCE)
+            self._sequence = self.cursor.fetchone()[0] or ''
+        if not self._sequence:
+            return None
+        return self._copy_with_ids(table, rows, self._sequence)
+
+    def _copy_with_ids(self, table, rows, sequence):
+        self.cursor.execute(SELECT_JSON_DATA_IDS, (sequence, len(rows)))
+        ids = [row[0] for row in self.cursor.fetchall()]
+        self.cursor.copy_expert(COPY_JSON_DATA_ROWS.format(table=table), RowCopyReader(rows, ids))
+        self.cursor.execute(SELECT_COPIED_ROWS.format(table=table), (ids,))
+        found = {row[0]: row for row in self.cursor.fetchall()}
+        return [found[json_data_id] for json_data_id in ids]
+
+    def _validate_batch(self, data, outcomes):
+        rows = []
+        positions = []
+        for position, datum in enumerate(data):
+            try:
+                rows.append(self.batch_row(datum))
+                positions.append(position)
+            except Exception as e:
+                logger.debug(f'Message {position} of the batch is invalid: {repr(e)}')
+                outcomes[position] = e
+        return rows, positions
+
+    def _insert_rows(self, rows, page_size=100, loads=None):
+        """
+        inserts rows in one transaction, claiming the captures of loads, the (uuid, content_hash)
+        of the capture of each row, first and recording the row each was loaded as when given
+        """
+        self.conn.autocommit = False
+        try:
+            try:
+                ids = self._insert_claimed(rows, loads, lambda claimed: self._insert_values(claimed, page_size),
+                                           page_size)
+                self.conn.commit()
+                return ids
+            except (DataError, IntegrityError) as e:
+                logger.debug(f'Batch insert failed, isolating the bad rows: {repr(e)}', exc_info=True)
+                self.conn.rollback()
+            outcomes = self._insert_claimed(rows, loads, self._insert_each, page_size)
+            self.conn.commit()
+            return outcomes
+        except Exception:
+            logger.debug('Transaction will be rolled back.')
+            self.conn.rollback()
+            raise
+        finally:
+            self.conn.autocommit = True
+
+    def _insert_values(self, rows, page_size):
+        if self.partitions is not None:
+            return self._copy_to_partitions(rows, page_size)
+        return execute_values(self.cursor, INSERT_JSON_DATA_VALUES, rows, page_size=page_size, fetch=True)
+
+    def _insert_each(self, rows):
+        """ a bad row fails the whole statement, so insert row by row behind savepoints to isolate it """
+        outcomes = []
+        for row in rows:
+            self.cursor.execute('SAVEPOINT json_data_row')
+            try:
+                self.cursor.execute(INSERT_JSON_DATA, row)
+                outcomes.append(self.cursor.fetchone())
+            except (DataError, IntegrityError) as e:
+                self.cursor.execute('ROLLBACK TO SAVEPOINT json_data_row')
+                outcomes.append(e)
+            else:
+                self.cursor.execute('RELEASE SAVEPOINT json_data_row')
+        return outcomes
+
+    def _insert_claimed(self, rows, loads, insert, page_size):
+        """
+        runs insert, which inserts rows and returns the outcome of each, or None when it could not, within
+        the current transaction. with loads the captures are claimed first and only those claimed are inserted,
+        those another load claimed first taking the json_data_id and partition_number it loaded them as
+        """
+        if loads is None:
+            return insert(rows)
+        positions, outcomes = self._claim_many(loads)
+        if positions:
+            inserted = insert([rows[position] for position in positions])
+            if inserted is None:
+                return None
+            self._record_many([loads[position] for position in positions], inserted, page_size)
+            for position, outcome in zip(positions, inserted):
+                outcomes[position] = outcome
+        # a capture given more than once is loaded once, each of its rows taking the outcome of the first
+        first = {}
+        for position, (uuid, _) in enumerate(loads):
+            first.setdefault(uuid, position)
+            if outcomes[position] is None:
+                outcomes[position] = outcomes[first[uuid]]
+        return outcomes
+
+    def _claim_many(self, loads):
+        """
+        claims the uuids of loads within the current transaction, returning the positions of the first
+        of each claimed, and by position the json_data_id and partition_number of those another load
+        claimed first, None for the rest
+        """
+        with self._load_table():
+            self.cursor.execute(CLAIM_JSON_DATA_LOADS, (sorted({uuid for uuid, _ in loads}),))
+            claimed = {row[0] for row in self.cursor.fetchall()}
+        # the other loads have committed by now, or rolled back leaving their uuids unclaimed
+        others = {uuid for uuid, _ in loads if uuid not in claimed}
+        found = self.find_loaded_many(others) if others else {}
+        positions = []
+        outcomes = [None] * len(loads)
+        for position, (uuid, _) in enumerate(loads):
+            if uuid in claimed:
+                claimed.discard(uuid)
+                positions.append(position)
+            elif uuid in others:
+                outcomes[position] = found.get(uuid) or RuntimeError(
+                    f'{uuid} was claimed by a load that did not finish, try again')
+        if found:
+            logger.debug(f'{len(found)} captures of the batch were loaded while it was under way')
+        return positions, outcomes
+
+    def _copy_to_partitions(self, rows, page_size):
+        """
+        copies rows straight into the partitions they belong in, one COPY for each, and inserts those
+        the partition map has no partition for through the table. when a partition turns out not to
+        match the map, the map is read again next time and the rows are all inserted through the table
+        """
+        read_at = self.partitions.loaded_at
+        partitions = self.partitions.current(self.cursor)
+        groups = partitions.group(rows) if partitions.routable else None
+        if groups is not None and None in groups and partitions.loaded_at == read_at:
+            # a partition may have been added since the map was read
+            partitions.refresh(self.cursor)
+            groups = partitions.group(rows) if partitions.routable else None
+        if groups is None:
+            return execute_values(self.cursor, INSERT_JSON_DATA_VALUES, rows, page_size=page_size, fetch=True)
+        ids = [None] * len(rows)
+        self.cursor.execute('SAVEPOINT json_data_partitions')
+        try:
+            routed = [position for name, positions in groups.items() if name is not None for position in positions]
+            for name, positions in groups.items():
+                if name is None:
+                    continue
+                copied = self._copy_with_ids(name, [rows[position] for position in positions], partitions.sequence)
+                for position, id_and_partition_number in zip(positions, copied):
+                    ids[position] = id_and_partition_number
+            unrouted = groups.get(None, [])
+            if unrouted:
+                returned = execute_values(self.cursor, INSERT_JSON_DATA_VALUES,
+                                          [rows[position] for position in unrouted], page_size=page_size, fetch=True)
+                for position, id_and_partition_number in zip(unrouted, returned):
+                    ids[position] = id_and_partition_number
+        except STALE_PARTITION_ERRORS as e:
+            logger.debug(f'Partition map is out of date, inserting through the table: {repr(e)}')
+            self.cursor.execute('ROLLBACK TO SAVEPOINT json_data_partitions')
+            partitions.expire()
+            return execute_values(self.cursor, INSERT_JSON_DATA_VALUES, rows, page_size=page_size, fetch=True)
+        self.cursor.execute('RELEASE SAVEPOINT json_data_partitions')
+        PARTITION_STATS['routed'] += len(routed)
+        PARTITION_STATS['unrouted'] += len(unrouted)
+        return ids
+
+    def _record_many(self, loads, outcomes, page_size):
+        """ records the rows claimed captures were loaded as, and gives up the claims of those that failed """
+        records = [load + tuple(outcome) for load, outcome in zip(loads, outcomes)
+                   if not isinstance(outcome, Exception)]
+        if records:
+            execute_values(self.cursor, INSERT_JSON_DATA_LOADS, records, page_size=page_size)
+            DEDUP_STATS['misses'] += len(records)
+        failed = [uuid for (uuid, _), outcome in zip(loads, outcomes) if isinstance(outcome, Exception)]
+        if failed:
+            self.cursor.execute(RELEASE_JSON_DATA_LOADS, (failed,))
+
+    def persist_stream(self, datum):
+        """
+        validates and persists a streamed message to RDS.
+
+        The content is copied into a staging table as it is read from S3, so it
+        is never held in memory as a whole. The metadata follows from reading the
+        whole object, so the row is inserted from the staging table afterwards,
+        all in one transaction.
+        """
+        if self.compression:
+            def insert():
+                with metrics.stage('compress') as stage:
+                    compressed = self._compress_content(datum.iter_content())
+                    stage.bytes = datum.bytes_read
+                with metrics.stage('validate'):
+                    api = self.validate_attributes(datum)
+                return self._insert_compressed(compressed, self._insert_params(datum, api))
+
+            self._prepare('compressed_content_stage', 'insert_compressed_json_data_from_stage')
+            return self._insert_once(datum, insert)
+
+        content = ContentCopyReader(datum.iter_content())
+        self._prepare('json_content_stage', 'insert_json_data_from_stage')
+
+        def insert():
+            with metrics.stage('copy') as stage:
+                self.cursor.copy_expert(COPY_CONTENT_STAGE, content)
+                stage.bytes = datum.bytes_read
+            content.check()
+            with metrics.stage('validate'):
+                api = self.validate_attributes(datum)
+            logger.debug(f'Inserting {content.length} characters of streamed content in the database.')
+            with metrics.stage('insert', content.length):
+                return self._fetch(EXECUTE_INSERT_JSON_DATA_FROM_STAGE, self._insert_params(datum, api))
+
+        return self._insert_once(datum, insert)
+
+    def persist_buffer(self, datum):
+        """
+        validates and persists a message held as the bytes of its S3 object.
+
+        The content is validated as it is decoded in pieces, then its string
+        literal is copied to a staging table straight from the buffer and
+        unescaped by the database, so no decoded copy of the whole content is made.
+        """
+        if self.compression:
+            with metrics.stage('compress', len(datum.buffer)):
+                compressed = self._compress_content(datum.iter_content())
+                api = self.validate_attributes(datum)
+            params = self._insert_params(datum, api)
+            self._prepare('compressed_content_stage', 'insert_compressed_json_data_from_stage')
+            return self._insert_once(datum, lambda: self._insert_compressed(compressed, params))
+
+        validator = JsonValidator()
+        with metrics.stage('validate', len(datum.buffer)):
+            try:
+                for piece in datum.iter_content():
+                    validator.feed(piece)
+                validator.close()
+            except JsonStreamError as e:
+                raise ValidationException("Must be JSON", "JSON Data", "expected valid JSON", repr(e))
+            api = self.validate_attributes(datum)
+        start, end = datum.content_span
+        self._prepare('json_content_stage', 'insert_json_data_from_literal_stage')
+
+        def insert():
+            with metrics.stage('copy', end - start):
+                self.cursor.copy_expert(COPY_CSV_STAGE, LiteralCopyReader(datum.buffer, start, end),
+                                        CONFIG['load']['stream_chunk_size'])
+            logger.debug(f'Inserting {end - start} bytes of content in the database.')
+            with metrics.stage('insert', end - start):
+                return self._fetch(EXECUTE_INSERT_JSON_DATA_FROM_LITERAL_STAGE, self._insert_params(datum, api))
+
+        return self._insert_once(datum, insert)
+
     @classmethod
     def validate_contains(cls, variable_name, actual):
         """
@@ -201,12 +1296,119 @@ class RDS:
         """
         self.validate_contains(variable_name, actual)
         try:
-            # attempt to convert JSON string to dictionary
-            json.loads(actual)
+            # check the JSON string is well formed with the configured validator
+            self.json_validator(actual)
         except Exception:
             raise ValidationException("Must be JSON", variable_name, "expected valid JSON", actual)
 
 
+class ContentCopyReader:
+    """
+    file-like adapter feeding streamed content to cursor.copy_expert as a
+    single row in COPY text format, validating it as JSON on the way unless
+    check_json is False.
+
+    errors cannot be raised through copy_expert cleanly so reading stops and
+    they are raised from check once the copy is done.
+    """
+    _escapes = (('\\', '\\\\'), ('\n', '\\n'), ('\r', '\\r'), ('\t', '\\t'))
+
+    def __init__(self, pieces, check_json=True):
+        self._pieces = pieces
+        self._validator = JsonValidator() if check_json else None
+        self._done = False
+        self.error = None
+        self.length = 0
+
+    def read(self, size=-1):
+        if self._done:
+            return ''
+        try:
+            for piece in self._pieces:
+                if piece:
+                    if self._validator is not None:
+                        self._validator.feed(piece)
+                    self.length += len(piece)
+                    for char, escaped in self._escapes:
+                        piece = piece.replace(char, escaped)
+                    return piece
+            if self._validator is not None:
+                self._validator.close()
+        except JsonStreamError as e:
+            self.error = ValidationException("Must be JSON", "JSON Data", "expected valid JSON", repr(e))
+        except Exception as e:
+            self.error = e
+        self._done = True
+        return '' if self.error else '\n'
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+
+class BinaryCopyReader:
+    """
+    file-like adapter feeding a single bytea value, held as chunks, to
+    cursor.copy_expert as one row in COPY binary format
+    """
+    _header = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+
+    def __init__(self, chunks, size):
+        self._pieces = iter([self._header + struct.pack('!hi', 1, size)] + list(chunks) + [struct.pack('!h', -1)])
+
+    def read(self, size=-1):
+        return next(self._pieces, b'')
+
+
+class LiteralCopyReader:
+    """
+    file-like adapter feeding a span of a buffer to cursor.copy_expert as a
+    single row, a piece at a time so that only one piece is ever copied out of it.
+    the span is surrounded by quote when one is given
+    """
+
+    def __init__(self, buffer, start, end, quote=b''):
+        self._buffer = buffer
+        self._pos = start
+        self._end = end
+        self._quote = quote
+        self._started = False
+        self._done = False
+
+    def read(self, size=-1):
+        if not self._started:
+            self._started = True
+            if self._quote:
+                return self._quote
+        if self._pos < self._end:
+            end = self._end if size is None or size < 0 else min(self._pos + size, self._end)
+            piece = self._buffer[self._pos:end]
+            self._pos = end
+            return piece if isinstance(piece, bytes) else bytes(piece)
+        if self._done:
+            return b''
+        self._done = True
+        return self._quote + b'\n'
+
+
+class DatabaseUnavailable(RuntimeError):
+    """
+    no connection to the database could be made within the connect budget
+    """
+
+
+class CircuitOpen(DatabaseUnavailable):
+    """
+    connecting was not tried because recent attempts have failed
+    """
+
+
+class AdmissionTimeout(DatabaseUnavailable):
+    """
+    every slot of the cap on active loads stayed taken
+    """
+
+
 class ValidationException(Exception):
     """
     Validation Exception class
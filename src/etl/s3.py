@@ -1,15 +1,336 @@
-import boto3
+import io
+import itertools
+import mmap
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import BotoCoreError
+
+from . import metrics
+from .compression import GZIP, HEAD_SIZE, DecompressionError, declared_size, iter_decompressed, object_encoding
+from .config import CONFIG
+from .local_s3 import LocalS3Client
+
+# clients are kept per region for the life of the container so warm invocations reuse their connections
+_clients = {}
+# the botocore session clients are created from, made on first use
+_session = None
+CLIENT_STATS = {'created': 0, 'reused': 0}
+# how much of a ranged GET is read at a time into the object buffer
+READ_SIZE = 1048576
+# whole object downloads, to estimate how long a download takes
+DOWNLOAD_STATS = {'bytes': 0, 'seconds': 0.0}
+
+
+def estimated_download_ms(size):
+    """ how long downloading size bytes takes at the throughput seen so far, 0 when nothing has been seen """
+    if not DOWNLOAD_STATS['seconds']:
+        return 0.0
+    return size / DOWNLOAD_STATS['bytes'] * DOWNLOAD_STATS['seconds'] * 1000
+
+
+def decompression_limit(size):
+    """ the most a compressed object of size bytes may decompress to before it is taken for a decompression bomb """
+    return int(size * CONFIG['load']['max_decompression_ratio'])
+
+
+def _slices(buffer, size):
+    # slices rather than views, so nothing holds on to a mapped buffer once it is closed
+    for start in range(0, len(buffer), size):
+        yield buffer[start:start + size]
+
+
+def new_client(service, region_name=None, **kwargs):
+    """
+    a client created the way boto3.client creates one, from a botocore session
+    kept for the container. boto3 itself is not imported, which saves importing
+    s3transfer on a cold start, and the session is only imported here, as it
+    takes most of the time importing the loader would otherwise take
+    """
+    global _session
+    if _session is None:
+        import botocore.session
+        _session = botocore.session.get_session()
+    return _session.create_client(service, region_name=region_name, **kwargs)
+
+
+def get_client(region):
+    client = _clients.get(region)
+    if client is None:
+        if CONFIG['aws']['s3-local-root']:
+            client = LocalS3Client(CONFIG['aws']['s3-local-root'])
+        else:
+            from botocore.config import Config
+            # enough pooled connections for every part of a ranged download
+            config = Config(max_pool_connections=max(10, CONFIG['load']['download_concurrency']))
+            client = new_client('s3', region_name=region, endpoint_url=CONFIG['aws']['s3-endpoint-url'],
+                                config=config)
+        _clients[region] = client
+        CLIENT_STATS['created'] += 1
+    else:
+        CLIENT_STATS['reused'] += 1
+    return client
+
+
+def discard_client(region):
+    """ drops a client that has failed so the next use creates a fresh one """
+    _clients.pop(region, None)
+
+
+class Spill:
+    """
+    a temporary file of a given size mapped into memory as buffer, the file
+    is removed when the spill is closed
+    """
+
+    def __init__(self, directory, size):
+        fd, self.path = tempfile.mkstemp(suffix='.spill', dir=directory)
+        try:
+            os.ftruncate(fd, size)
+            # an empty file cannot be mapped
+            self.buffer = mmap.mmap(fd, size) if size else b''
+        except Exception:
+            os.remove(self.path)
+            raise
+        finally:
+            # the mapping keeps its own handle on the file
+            os.close(fd)
+
+    def resize(self, size):
+        """ shrinks the file, and its mapping, to the size of what was written to it """
+        self.buffer.resize(size)
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
 
 class S3:
 
     def __init__(self, region='us-west-2'):
-        self.s3 = boto3.client('s3', region_name=region)
+        self.region = region
+        self.s3 = get_client(region)
 
     def download(self, bucket, file_name):
         self.s3.download_file(Bucket=bucket, Key=file_name, Filename=file_name)
 
-    def get_file(self, bucket, file_name):
-        s3ref = self.s3.get_object(Bucket=bucket, Key=file_name)
-        data = s3ref['Body'].read().decode('utf-8')
+    def get_file(self, bucket, file_name, size=None, digest=None):
+        """
+        reads a whole object as text, objects known to be at least the ranged
+        download threshold in size are fetched in concurrent parts and
+        compressed objects are decompressed
+        """
+        body = self.get_bytes(bucket, file_name, size, digest)
+        with metrics.stage('decode', len(body)):
+            data = body.decode('utf-8')
         return data
+
+    def get_bytes(self, bucket, file_name, size=None, digest=None):
+        """
+        reads a whole object without decoding it, decompressed when it is compressed.
+        the object as it is stored is added to digest, a hashlib hash, when one is given
+        """
+        try:
+            start = time.perf_counter()
+            with metrics.stage('fetch') as stage:
+                if size is not None and size >= CONFIG['load']['ranged_download_threshold']:
+                    body = self.get_ranges(bucket, file_name, size)
+                else:
+                    s3ref = self.s3.get_object(Bucket=bucket, Key=file_name)
+                    body = s3ref['Body'].read()
+                if digest is not None:
+                    digest.update(body)
+                stage.bytes = len(body)
+            DOWNLOAD_STATS['bytes'] += len(body)
+            DOWNLOAD_STATS['seconds'] += time.perf_counter() - start
+        except BotoCoreError:
+            discard_client(self.region)
+            raise
+        encoding = object_encoding(file_name, head=body[:HEAD_SIZE])
+        if encoding is not None:
+            limit = decompression_limit(len(body))
+            with metrics.stage('decompress') as stage:
+                out = io.BytesIO()
+                for chunk in iter_decompressed([body], encoding, limit, READ_SIZE):
+                    out.write(chunk)
+                stage.bytes = out.tell()
+            del body
+            body = out.getvalue()
+        return body
+
+    def spill(self, bucket, file_name, size=None, digest=None):
+        """
+        downloads a whole object into a temporary file mapped into memory, rather
+        than into memory itself. a compressed object is decompressed into a file of
+        its own. the file is removed when the returned Spill is closed, or straight
+        away when the download fails
+        """
+        if size is None:
+            size = self.s3.head_object(Bucket=bucket, Key=file_name)['ContentLength']
+        spill = Spill(CONFIG['load']['spill_dir'], size)
+        try:
+            start = time.perf_counter()
+            with metrics.stage('fetch', size):
+                if size:
+                    self.get_ranges(bucket, file_name, size, buffer=spill.buffer)
+                if digest is not None:
+                    digest.update(spill.buffer)
+            DOWNLOAD_STATS['bytes'] += size
+            DOWNLOAD_STATS['seconds'] += time.perf_counter() - start
+        except BotoCoreError:
+            spill.close()
+            discard_client(self.region)
+            raise
+        except BaseException:
+            spill.close()
+            raise
+        encoding = object_encoding(file_name, head=spill.buffer[:HEAD_SIZE])
+        if encoding is not None:
+            spill = self._decompress_spill(spill, encoding)
+        return spill
+
+    def _decompress_spill(self, spill, encoding):
+        """ decompresses a spilled object into a spill of its own, closing the compressed one """
+        try:
+            limit = decompression_limit(len(spill.buffer))
+            size = declared_size(encoding, spill.buffer[:HEAD_SIZE], spill.buffer[-4:])
+            if size is not None and size > limit:
+                raise DecompressionError(f'Declares {size} bytes, more than {limit} bytes')
+            # a file of the size declared, or of the most allowed, which is sparse until written
+            target = Spill(CONFIG['load']['spill_dir'], limit if size is None else size)
+            try:
+                position = 0
+                with metrics.stage('decompress') as stage:
+                    for chunk in iter_decompressed(_slices(spill.buffer, READ_SIZE), encoding, len(target.buffer),
+                                                   READ_SIZE):
+                        target.buffer[position:position + len(chunk)] = chunk
+                        position += len(chunk)
+                    stage.bytes = position
+                if 0 < position < len(target.buffer):
+                    target.resize(position)
+            except BaseException:
+                target.close()
+                raise
+        finally:
+            spill.close()
+        return target
+
+    def decompressed_size(self, bucket, file_name, size, encoding):
+        """
+        the size a compressed object of size bytes declares it decompresses to, read
+        from its trailing or leading bytes, None when it does not declare one
+        """
+        try:
+            if encoding == GZIP:
+                if size < 4:
+                    return None
+                s3ref = self.s3.get_object(Bucket=bucket, Key=file_name, Range=f'bytes={size - 4}-{size - 1}')
+                return declared_size(encoding, tail=s3ref['Body'].read())
+        except BotoCoreError:
+            discard_client(self.region)
+            raise
+        head, _ = self.get_head(bucket, file_name, HEAD_SIZE)
+        return declared_size(encoding, head=head)
+
+    def get_head(self, bucket, file_name, length):
+        """
+        reads the leading bytes of an object, returns them with the size of the whole object
+        """
+        try:
+            s3ref = self.s3.get_object(Bucket=bucket, Key=file_name, Range=f'bytes=0-{length - 1}')
+            data = s3ref['Body'].read()
+        except BotoCoreError:
+            discard_client(self.region)
+            raise
+        size = int(s3ref['ContentRange'].rsplit('/', 1)[-1]) if 'ContentRange' in s3ref else len(data)
+        return data, size
+
+    def get_ranges(self, bucket, file_name, size, part_size=None, concurrency=None, buffer=None):
+        """
+        downloads an object of a known size as concurrent ranged GETs, each part
+        written straight into its place in one preallocated buffer, or in the
+        given buffer of at least size bytes
+        """
+        part_size = part_size or CONFIG['load']['download_part_size']
+        concurrency = concurrency or CONFIG['load']['download_concurrency']
+        buffer = bytearray(size) if buffer is None else buffer
+        etags = set()
+
+        def fetch(start):
+            end = min(start + part_size, size)
+            s3ref = self.s3.get_object(Bucket=bucket, Key=file_name, Range=f'bytes={start}-{end - 1}')
+            total = s3ref.get('ContentRange', f'/{size}').rsplit('/', 1)[-1]
+            if int(total) != size:
+                raise IOError(f'{file_name} is {total} bytes, expected {size}')
+            if 'ETag' in s3ref:
+                etags.add(s3ref['ETag'])
+            position = start
+            for chunk in s3ref['Body'].iter_chunks(READ_SIZE):
+                view[position:position + len(chunk)] = chunk
+                position += len(chunk)
+            if position != end:
+                raise IOError(f'Read {position - start} bytes of {file_name} from {start}, expected {end - start}')
+
+        # released on the way out so that a mapped buffer can be closed
+        with memoryview(buffer) as view, ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(fetch, range(0, size, part_size)))
+        if len(etags) > 1:
+            raise IOError(f'{file_name} changed while it was being downloaded')
+        return buffer
+
+    def iter_objects(self, bucket, prefix='', start_after=''):
+        """
+        generator of the (key, size) of the objects under a prefix in key order,
+        starting after a key when given
+        """
+        arguments = {'Bucket': bucket, 'Prefix': prefix, 'StartAfter': start_after}
+        while True:
+            response = self.s3.list_objects_v2(**arguments)
+            for item in response.get('Contents', []):
+                yield item['Key'], item['Size']
+            if not response.get('IsTruncated'):
+                return
+            arguments['ContinuationToken'] = response['NextContinuationToken']
+
+    def iter_file(self, bucket, file_name, chunk_size=1048576, digest=None):
+        """
+        generator of the chunks of an object, decompressed as they are read when the
+        object is compressed. the object as it is stored is added to digest when one is given
+        """
+        try:
+            s3ref = self.s3.get_object(Bucket=bucket, Key=file_name)
+        except BotoCoreError:
+            discard_client(self.region)
+            raise
+        chunks = self._iter_body(s3ref, chunk_size, digest)
+        first = next(chunks, b'')
+        encoding = object_encoding(file_name, s3ref.get('ContentEncoding'), first[:HEAD_SIZE])
+        if encoding is None:
+            if first:
+                yield first
+            yield from chunks
+            return
+        limit = decompression_limit(s3ref.get('ContentLength', len(first)))
+        yield from iter_decompressed(itertools.chain([first], chunks), encoding, limit, chunk_size)
+
+    def _iter_body(self, s3ref, chunk_size, digest):
+        try:
+            for chunk in s3ref['Body'].iter_chunks(chunk_size):
+                if digest is not None:
+                    digest.update(chunk)
+                yield chunk
+        except BotoCoreError:
+            discard_client(self.region)
+            raise
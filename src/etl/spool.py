@@ -0,0 +1,200 @@
+"""
+This module keeps the S3 records of captures that failed to load, with the
+class of the error, the stage it was raised from and when, so that they can
+be replayed together later rather than re-triggered one at a time.
+
+The spool, chosen by DEAD_LETTER_SPOOL, is a JSON lines file, an object per
+failure under an S3 prefix, or a table in the capture database.
+"""
+import datetime
+import json
+import os
+import threading
+import uuid
+from collections import namedtuple
+from contextlib import contextmanager
+
+from psycopg2.errors import UndefinedTable
+
+from .config import CONFIG
+from .rds import shared_rds
+from .s3 import S3
+
+# allows for logging information
+import logging
+
+log_level = os.getenv('LOG_LEVEL', logging.ERROR)
+logger = logging.getLogger(__name__)
+logger.setLevel(log_level)
+
+TABLE = 'table'
+S3_SCHEME = 's3://'
+# the longest error message kept
+MESSAGE_LIMIT = 1000
+
+# the table is created by its migration rather than by the function, whose role may not create tables in the schema
+JSON_DATA_FAILURE_MIGRATION = 'migrations/002_json_data_failure.sql'
+
+INSERT_JSON_DATA_FAILURE = """
+    INSERT INTO capture.json_data_failure (failed_at, stage, error, message, record)
+    VALUES (%s, %s, %s, %s, %s);"""
+
+SELECT_JSON_DATA_FAILURES = """
+    SELECT json_data_failure_id, record, error, message, stage, failed_at
+    FROM capture.json_data_failure ORDER BY json_data_failure_id;"""
+
+DELETE_JSON_DATA_FAILURES = "DELETE FROM capture.json_data_failure WHERE json_data_failure_id = ANY(%s);"
+
+# a spooled failure, the handle is what the spool removes it by
+SpooledFailure = namedtuple('SpooledFailure', ['handle', 'record', 'error', 'message', 'stage', 'failed_at'])
+
+
+def failure_entry(record, error, stage=None):
+    """
+    the spooled form of the failure of a record. the error a load wrapped is the one recorded
+    """
+    error = error.__cause__ or error
+    return {
+        'record': record,
+        'error': type(error).__name__,
+        'message': repr(error)[:MESSAGE_LIMIT],
+        'stage': stage or 'load',
+        'failed_at': datetime.datetime.utcnow().isoformat(timespec='milliseconds'),
+    }
+
+
+def _spooled(handle, entry):
+    return SpooledFailure(handle, entry['record'], entry['error'], entry['message'], entry['stage'],
+                          entry['failed_at'])
+
+
+class FileSpool:
+    """
+    failures as JSON lines appended to a file, each with an id it is removed by. removing
+    rewrites the file, so failures should not be spooled to it by another process meanwhile
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def put(self, record, error, stage=None):
+        entry = dict(failure_entry(record, error, stage), id=uuid.uuid4().hex)
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        with self._lock, open(self.path, 'a') as f:
+            f.write(line)
+
+    def entries(self):
+        if not os.path.exists(self.path):
+            return
+        # the file is read as it was when opened, even when it is replaced meanwhile
+        with open(self.path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    yield _spooled(entry['id'], entry)
+
+    def remove(self, handles):
+        handles = set(handles)
+        if not handles:
+            return
+        temporary = f'{self.path}.tmp'
+        with self._lock:
+            with open(self.path) as f, open(temporary, 'w') as kept:
+                for line in f:
+                    if line.strip() and json.loads(line)['id'] not in handles:
+                        kept.write(line)
+            os.replace(temporary, self.path)
+
+
+class S3Spool:
+    """
+    a failure per object under an S3 prefix, keyed by when it failed, removed by key
+    """
+
+    def __init__(self, bucket, prefix, region=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3 = S3(region or CONFIG['aws']['region'])
+
+    def put(self, record, error, stage=None):
+        entry = failure_entry(record, error, stage)
+        key = f'{self.prefix}{entry["failed_at"]}-{uuid.uuid4().hex}.json'
+        self.s3.s3.put_object(Bucket=self.bucket, Key=key, Body=json.dumps(entry, separators=(',', ':')))
+
+    def entries(self):
+        for key, _ in self.s3.iter_objects(self.bucket, self.prefix):
+            body = self.s3.s3.get_object(Bucket=self.bucket, Key=key)['Body']
+            try:
+                entry = json.loads(body.read())
+            finally:
+                body.close()
+            yield _spooled(key, entry)
+
+    def remove(self, handles):
+        handles = list(handles)
+        # as many keys as one request deletes
+        for start in range(0, len(handles), 1000):
+            objects = [{'Key': key} for key in handles[start:start + 1000]]
+            self.s3.s3.delete_objects(Bucket=self.bucket, Delete={'Objects': objects, 'Quiet': True})
+
+
+class TableSpool:
+    """
+    failures as rows of capture.json_data_failure, removed by id. rds is the shared
+    instance when not given, looked up when the spool is used
+    """
+
+    def __init__(self, rds=None):
+        self._rds = rds
+
+    @property
+    def rds(self):
+        if self._rds is None:
+            return shared_rds()
+        return self._rds
+
+    @contextmanager
+    def _table(self):
+        """ raises a RuntimeError saying how to create capture.json_data_failure when it is missing """
+        try:
+            yield
+        except UndefinedTable as e:
+            raise RuntimeError(f'capture.json_data_failure does not exist, create it with '
+                               f'{JSON_DATA_FAILURE_MIGRATION}') from e
+
+    def put(self, record, error, stage=None):
+        entry = failure_entry(record, error, stage)
+        with self._table():
+            self.rds.cursor.execute(INSERT_JSON_DATA_FAILURE, (entry['failed_at'], entry['stage'], entry['error'],
+                                                               entry['message'], json.dumps(record)))
+
+    def entries(self):
+        # a cursor of its own, so that the rows are not lost to statements run while they are replayed
+        with self.rds.conn.cursor() as cursor:
+            with self._table():
+                cursor.execute(SELECT_JSON_DATA_FAILURES)
+            for failure_id, record, error, message, stage, failed_at in cursor:
+                yield SpooledFailure(failure_id, json.loads(record), error, message, stage, failed_at.isoformat())
+
+    def remove(self, handles):
+        handles = list(handles)
+        if handles:
+            with self._table():
+                self.rds.cursor.execute(DELETE_JSON_DATA_FAILURES, (handles,))
+
+
+def open_spool(spec=None):
+    """
+    the spool spec, or DEAD_LETTER_SPOOL, names: a JSON lines file, s3://bucket/prefix, or table.
+    None when there is no spool
+    """
+    spec = spec or CONFIG['load']['dead_letter_spool']
+    if not spec:
+        return None
+    if spec.startswith(S3_SCHEME):
+        bucket, _, prefix = spec[len(S3_SCHEME):].partition('/')
+        return S3Spool(bucket, prefix)
+    if spec == TABLE:
+        return TableSpool()
+    return FileSpool(spec)
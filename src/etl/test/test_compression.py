@@ -0,0 +1,91 @@
+import gzip
+import json
+import unittest
+from unittest import TestCase
+
+from src.etl import compression
+from src.etl.compression import CompressedContent, compress, decompress, encodings
+from src.etl.compression import DecompressionError, declared_size, decompress_head, iter_decompressed
+from src.etl.compression import object_encoding, strip_suffix
+
+
+class TestCompression(TestCase):
+
+    def setUp(self):
+        self.content = json.dumps({'Points': [{'v': i, 's': 'é 😀 \\ "'} for i in range(2000)]}, ensure_ascii=False)
+
+    def test_gzip_in_pieces(self):
+        compressed = compress(self.content, 'gzip', piece_size=1000)
+        data = b''.join(compressed.chunks)
+        self.assertEqual(len(data), compressed.size)
+        self.assertEqual(len(self.content.encode('utf-8')), compressed.raw_size)
+        self.assertEqual(len(self.content), compressed.length)
+        self.assertLess(compressed.size, compressed.raw_size / 4)
+        self.assertEqual(self.content, gzip.decompress(data).decode('utf-8'))
+        self.assertEqual(self.content, decompress(data, 'gzip'))
+
+    def test_levels(self):
+        for level in (1, 9):
+            compressed = compress(self.content, 'gzip', level)
+            self.assertEqual(self.content, decompress(b''.join(compressed.chunks), 'gzip'))
+
+    @unittest.skipIf(compression.zstandard is None, 'zstandard is not installed')
+    def test_zstd_in_pieces(self):
+        compressed = compress(self.content, 'zstd', piece_size=1000)
+        self.assertEqual(self.content, decompress(b''.join(compressed.chunks), 'zstd'))
+
+    def test_unavailable(self):
+        if 'zstd' not in encodings():
+            with self.assertRaises(ValueError):
+                CompressedContent('zstd')
+        with self.assertRaises(ValueError):
+            CompressedContent('lz4')
+        with self.assertRaises(ValueError):
+            decompress(b'', 'lz4')
+
+
+class TestCompressedObjects(TestCase):
+
+    def setUp(self):
+        self.data = json.dumps({'metadata': {'URL': 'u'}, 'content': 'x' * 100000}).encode('utf-8')
+        self.stored = gzip.compress(self.data)
+
+    def test_object_encoding(self):
+        self.assertEqual('gzip', object_encoding(head=self.stored[:18]))
+        self.assertIsNone(object_encoding('capture.json.gz', 'gzip', head=self.data[:18]))
+        self.assertEqual('gzip', object_encoding('capture.json', 'gzip'))
+        self.assertEqual('zstd', object_encoding('capture.json', ' ZSTD'))
+        self.assertEqual('gzip', object_encoding('capture.json.gz'))
+        self.assertEqual('zstd', object_encoding('capture.json.zst'))
+        self.assertIsNone(object_encoding('capture.json'))
+        self.assertEqual('zstd', object_encoding(head=b'\x28\xb5\x2f\xfd\x00'))
+        self.assertEqual('dir/capture.json', strip_suffix('dir/capture.json.gz'))
+        self.assertEqual('dir/capture.json', strip_suffix('dir/capture.json'))
+
+    def test_declared_size(self):
+        self.assertEqual(len(self.data), declared_size('gzip', tail=self.stored[-4:]))
+        self.assertIsNone(declared_size('gzip'))
+
+    def test_iter_decompressed(self):
+        pieces = [self.stored[i:i + 100] for i in range(0, len(self.stored), 100)]
+        chunks = list(iter_decompressed(pieces, 'gzip', len(self.data), 4096))
+        self.assertEqual(self.data, b''.join(chunks))
+        self.assertLessEqual(max(len(chunk) for chunk in chunks), 4096)
+        with self.assertRaises(DecompressionError):
+            list(iter_decompressed(pieces, 'gzip', len(self.data) - 1))
+        with self.assertRaises(DecompressionError):
+            list(iter_decompressed(pieces[:-1], 'gzip', len(self.data)))
+        with self.assertRaises(DecompressionError):
+            list(iter_decompressed([self.data], 'gzip', len(self.data)))
+
+    def test_decompress_head(self):
+        head = decompress_head(self.stored[:40], 'gzip', 1000)
+        self.assertTrue(self.data.startswith(head))
+        self.assertEqual(self.data[:10], decompress_head(self.stored, 'gzip', 10))
+
+    @unittest.skipIf(compression.zstandard is None, 'zstandard is not installed')
+    def test_decompress_head_zstd(self):
+        stored = b''.join(compress(self.data.decode('utf-8'), 'zstd').chunks)
+        self.assertTrue(self.data.startswith(decompress_head(stored[:60], 'zstd', 1000)))
+        self.assertEqual(self.data[:10], decompress_head(stored, 'zstd', 10))
+        self.assertEqual(self.data, decompress_head(stored, 'zstd', 10 * len(self.data)))
@@ -1,12 +1,18 @@
+import gzip
 import json
+import os
+import tempfile
 from unittest import TestCase, mock
 
 import src.etl.event_processor as sqs
-from src.etl.event_processor import TriggerEvent, CapturedData
+from src.etl.event_processor import BatchTriggerEvent, TriggerEvent, CapturedData, StreamedCapturedData, \
+    BufferedCapturedData, BUFFER, STREAM
+from src.etl.local_s3 import LocalS3Client
+from src.etl.rds import RDS, ValidationException
 from src.etl.s3 import S3
 
 
-@mock.patch('src.etl.s3.boto3.client')
+@mock.patch('src.etl.s3.new_client')
 class TestCaptureData(TestCase):
 
     def setUp(self):
@@ -36,6 +42,29 @@ class TestCaptureData(TestCase):
         message = CapturedData(self.record, self.region).extract_attributes()
         self.assertEqual(the_value, message.url)
 
+    @mock.patch.object(S3, 'get_file')
+    def test_attributes_read_from_metadata(self, m_method, _):
+        fake_data = {'content': 'this is the body', 'metadata': {'API': {sqs.STRING_VALUE: 'the api'}}}
+        m_method.return_value = json.dumps(fake_data)
+        message = CapturedData(self.record, self.region)
+        self.assertEqual('the api', message.api)
+        self.assertEqual('', message.url)
+        self.assertEqual(message.content, message.body)
+        self.assertEqual({}, vars(message))
+
+    @mock.patch.object(S3, 'get_file')
+    def test_deprecated_put(self, m_method, _):
+        fake_data = {'content': 'this is the body', 'metadata': {'API': {sqs.STRING_VALUE: 'the api'}}}
+        m_method.return_value = json.dumps(fake_data)
+        message = CapturedData(self.record, self.region)
+        with self.assertWarns(DeprecationWarning):
+            message.fetch_body()
+        with self.assertWarns(DeprecationWarning):
+            message.put_attribute('script_name', 'API', None)
+        with self.assertWarns(DeprecationWarning):
+            message.put('url', 'the url')
+        self.assertEqual(('the api', 'the url', 'this is the body'), (message.script_name, message.url, message.body))
+
     @mock.patch.object(S3, 'get_file')
     def test_attribute_uuid(self, m_method, _):
         the_value = "444abb55-afe0-40f7-9791-c824ac396a75"
@@ -45,8 +74,15 @@ class TestCaptureData(TestCase):
         self.assertEqual(the_value, message.uuid)
         self.assertTrue(isinstance(message.uuid, str))
 
+    @mock.patch.object(S3, 'get_file')
+    def test_attribute_uuid_compressed(self, m_method, _):
+        m_method.return_value = json.dumps({'content': 'this is the body', 'metadata': {}})
+        self.record['s3']['object']['key'] += '.gz'
+        message = CapturedData(self.record, self.region)
+        self.assertEqual("444abb55-afe0-40f7-9791-c824ac396a75", message.uuid)
 
-@mock.patch('src.etl.s3.boto3.client')
+
+@mock.patch('src.etl.s3.new_client')
 class TestTriggerEvent(TestCase):
 
     def setUp(self):
@@ -105,3 +141,187 @@ class TestTriggerEvent(TestCase):
         datum = te.data
         self.assertEqual('some content', datum.content)
         self.assertEqual("the URL", datum.url)
+
+
+@mock.patch('src.etl.s3.new_client')
+class TestStreamedCapturedData(TestCase):
+
+    def setUp(self):
+        self.record = {
+            's3': {
+                'bucket': {'name': 'some-s3-name'},
+                'object': {'key': 'body_getTSData_24640_mod_444abb55-afe0-40f7-9791-c824ac396a75.json'}
+            }
+        }
+        self.region = 'us-south-1'
+
+    @mock.patch.object(S3, 'iter_file')
+    def test_attributes_after_content(self, m_method, _):
+        fake_data = {'content': '{"a": "this is the body"}', 'metadata': {'URL': {sqs.STRING_VALUE: 'the url'}}}
+        data = json.dumps(fake_data).encode('utf-8')
+        m_method.return_value = iter([data[:10], data[10:]])
+        te = TriggerEvent(self.region)
+        te.extract({'Record': self.record}, STREAM)
+        datum = te.data
+        self.assertIsInstance(datum, StreamedCapturedData)
+        self.assertFalse(hasattr(datum, 'url'))
+        self.assertEqual(fake_data['content'], ''.join(datum.iter_content()))
+        self.assertEqual('the url', datum.url)
+        self.assertEqual("444abb55-afe0-40f7-9791-c824ac396a75", datum.uuid)
+        self.assertEqual(len(data), datum.bytes_read)
+
+    @mock.patch.object(S3, 'get_bytes')
+    def test_buffered_content_span(self, m_method, _):
+        fake_data = {'metadata': {'URL': {sqs.STRING_VALUE: 'the url'}}, 'content': '{"a": "ü \\"body\\""}'}
+        data = json.dumps(fake_data, ensure_ascii=False).encode('utf-8')
+        m_method.return_value = data
+        with mock.patch.dict(sqs.CONFIG['load'], {'stream_chunk_size': 7}):
+            te = TriggerEvent(self.region)
+            te.extract({'Record': self.record}, BUFFER)
+            datum = te.data
+            self.assertIsInstance(datum, BufferedCapturedData)
+            self.assertEqual(fake_data['content'], ''.join(datum.iter_content()))
+        start, end = datum.content_span
+        self.assertEqual(fake_data['content'], json.loads(data[start:end]))
+        self.assertEqual('the url', datum.url)
+
+
+@mock.patch('src.etl.s3.new_client')
+class TestBatchTriggerEvent(TestCase):
+
+    def setUp(self):
+        self.region = 'us-south-10'
+        self.keys = [f'body_getTSData_24640_mod_444abb55-afe0-40f7-9791-c824ac39600{i}.json' for i in range(3)]
+        self.records = [
+            {'s3': {'bucket': {'name': 'example-bucket'}, 'object': {'key': key, 'size': 1024}}}
+            for key in self.keys
+        ]
+
+    def fake_get_file(self, bucket, key, size=None, digest=None):
+        if key == self.keys[1]:
+            raise RuntimeError('no such key')
+        return json.dumps({'content': key, 'metadata': {'URL': {sqs.STRING_VALUE: 'the URL'}}})
+
+    @mock.patch.object(S3, 'get_file')
+    def test_s3_batch(self, m_method, _):
+        m_method.side_effect = self.fake_get_file
+        te = BatchTriggerEvent(self.region, max_workers=2)
+        te.extract({'Records': self.records})
+        self.assertEqual([self.keys[0], self.keys[2]], [item_id for item_id, _ in te.data])
+        self.assertEqual([self.keys[0], self.keys[2]], [datum.content for _, datum in te.data])
+        self.assertEqual('the URL', te.data[0][1].url)
+        self.assertEqual([self.keys[1]], [item_id for item_id, _ in te.failures])
+
+    @mock.patch.object(S3, 'get_file')
+    def test_sqs_batch(self, m_method, _):
+        m_method.side_effect = self.fake_get_file
+        messages = [
+            {'messageId': 'one', 'body': json.dumps({'Records': [self.records[0], self.records[2]]})},
+            {'messageId': 'two', 'body': json.dumps({'Record': self.records[1]})},
+            {'messageId': 'three', 'body': 'not json'},
+        ]
+        te = BatchTriggerEvent(self.region)
+        te.extract({'Records': messages})
+        self.assertEqual(['one', 'one'], [item_id for item_id, _ in te.data])
+        self.assertEqual(['three', 'two'], sorted(item_id for item_id, _ in te.failures))
+
+    @mock.patch.object(S3, 'get_file')
+    def test_sqs_batch_malformed_messages(self, m_method, _):
+        m_method.side_effect = self.fake_get_file
+        messages = [
+            {'messageId': 'one', 'body': json.dumps({'Records': [self.records[0]]})},
+            {'messageId': 'test', 'body': json.dumps({'Service': 'Amazon S3', 'Event': 's3:TestEvent'})},
+            {'messageId': 'not s3', 'body': json.dumps({'Records': [{'eventSource': 'aws:sns'}]})},
+            {'messageId': 'no key', 'body': json.dumps({'Record': {'s3': {'object': {'size': 5}}}})},
+            {'messageId': 'not an object', 'body': json.dumps(['a list'])},
+            {'messageId': 'bad size', 'body': json.dumps({'Record': {'s3': {'object': {'key': 'k', 'size': 'x'}}}})},
+            {'messageId': 'three', 'body': json.dumps({'Record': self.records[2]})},
+        ]
+        te = BatchTriggerEvent(self.region)
+        te.extract({'Records': messages})
+        self.assertEqual(['one', 'three'], [item_id for item_id, _ in te.data])
+        self.assertEqual(['bad size', 'no key', 'not an object', 'not s3'],
+                         sorted(item_id for item_id, _ in te.failures))
+
+    @mock.patch.object(S3, 'get_file')
+    def test_size_limit(self, m_method, _):
+        m_method.side_effect = self.fake_get_file
+        self.records[2]['s3']['object']['size'] = 5000
+        te = BatchTriggerEvent(self.region)
+        te.extract({'Records': [self.records[0], self.records[2]]}, size_limit=2048)
+        self.assertEqual([self.keys[0]], [item_id for item_id, _ in te.data])
+        self.assertEqual([self.keys[2]], [item_id for item_id, _ in te.failures])
+        m_method.assert_called_once()
+
+    @mock.patch.object(S3, 'get_file')
+    def test_loaded_not_fetched(self, m_method, _):
+        m_method.side_effect = self.fake_get_file
+        find_loaded = mock.Mock(return_value={'444abb55-afe0-40f7-9791-c824ac396000': (7, 1)})
+        te = BatchTriggerEvent(self.region)
+        te.extract({'Records': [self.records[0], self.records[2]]}, find_loaded=find_loaded)
+        self.assertEqual({'444abb55-afe0-40f7-9791-c824ac396000', '444abb55-afe0-40f7-9791-c824ac396002'},
+                         find_loaded.call_args[0][0])
+        self.assertEqual([(self.keys[0], (7, 1))], te.duplicates)
+        self.assertEqual([self.keys[2]], [item_id for item_id, _ in te.data])
+        m_method.assert_called_once()
+
+
+class TestPrevalidation(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.client = mock.Mock(wraps=LocalS3Client(self.root.name))
+        self.metadata = {
+            'URL': {sqs.STRING_VALUE: 'https://some.net/api/call'}, 'API': {sqs.STRING_VALUE: 'api'},
+            'Parameters': {sqs.STRING_VALUE: '{}'}, 'StartTime': {sqs.STRING_VALUE: '1580000000'},
+            'ResponseTime': {sqs.STRING_VALUE: '1580000001'}, 'PID': {sqs.STRING_VALUE: '1234'},
+            'ScriptName': {sqs.STRING_VALUE: 'script'}, 'ResponseCode': {sqs.STRING_VALUE: '200'},
+        }
+        self.key = 'body_getTSData_24640_mod_444abb55-afe0-40f7-9791-c824ac396a75.json'
+        self.event = {'Record': {'s3': {'bucket': {'name': 'bucket'}, 'object': {'key': self.key}}}}
+        self.stats = mock.patch.dict('src.etl.event_processor.PREVALIDATION_STATS',
+                                     {'checked': 0, 'rejected': 0, 'not_found': 0, 'bytes_saved': 0, 'ms_saved': 0.0})
+        self.stats.start()
+        self.client_patch = mock.patch('src.etl.s3.get_client', return_value=self.client)
+        self.client_patch.start()
+        with mock.patch('src.etl.rds.connect'):
+            self.rds = RDS()
+
+    def tearDown(self):
+        self.client_patch.stop()
+        self.stats.stop()
+        self.root.cleanup()
+
+    def put(self, document):
+        body = json.dumps(document).encode('utf-8')
+        self.client.put_object(Bucket='bucket', Key=self.key, Body=body)
+        return len(body)
+
+    def test_rejected_from_leading_bytes(self):
+        self.metadata['ResponseCode'][sqs.STRING_VALUE] = '999'
+        size = self.put({'metadata': self.metadata, 'content': 'x' * 200000})
+        with self.assertRaises(ValidationException):
+            TriggerEvent('us-south-1').prevalidate(self.event, self.rds.validate_attributes)
+        self.client.get_object.assert_called_once_with(Bucket='bucket', Key=self.key, Range='bytes=0-65535')
+        self.assertEqual(1, sqs.PREVALIDATION_STATS['rejected'])
+        self.assertEqual(size - 65536, sqs.PREVALIDATION_STATS['bytes_saved'])
+
+    def test_valid_metadata(self):
+        self.put({'metadata': self.metadata, 'content': 'x' * 200000})
+        self.assertTrue(TriggerEvent('us-south-1').prevalidate(self.event, self.rds.validate_attributes))
+        self.assertEqual(1, sqs.PREVALIDATION_STATS['checked'])
+        self.assertEqual(0, sqs.PREVALIDATION_STATS['rejected'])
+
+    def test_metadata_after_content(self):
+        self.metadata['ResponseCode'][sqs.STRING_VALUE] = '999'
+        self.put({'content': 'x' * 200000, 'metadata': self.metadata})
+        self.assertFalse(TriggerEvent('us-south-1').prevalidate(self.event, self.rds.validate_attributes))
+        self.assertEqual(1, sqs.PREVALIDATION_STATS['not_found'])
+
+    def test_compressed_rejected_from_leading_bytes(self):
+        self.metadata['ResponseCode'][sqs.STRING_VALUE] = '999'
+        body = json.dumps({'metadata': self.metadata, 'content': os.urandom(200000).hex()}).encode('utf-8')
+        self.client.put_object(Bucket='bucket', Key=self.key, Body=gzip.compress(body))
+        with self.assertRaises(ValidationException):
+            TriggerEvent('us-south-1').prevalidate(self.event, self.rds.validate_attributes)
+        self.assertEqual(1, sqs.PREVALIDATION_STATS['rejected'])
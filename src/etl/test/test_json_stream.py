@@ -0,0 +1,120 @@
+import json
+from unittest import TestCase
+
+from src.etl.json_stream import CaptureReader, JsonStreamError, JsonValidator, leading_metadata
+
+
+def pieces(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class TestJsonValidator(TestCase):
+
+    def setUp(self):
+        self.valid = [
+            '{"a": [1, 2.5e3, -0, true, false, null, "x\\"y"], "b": {"c": {}}}',
+            '[]',
+            ' 12 ',
+            '"\\ud83d\\ude00"',
+            '{"k": [{"x": 1}, {"y": [2, 3, {"z": "w"}]}]}',
+        ]
+        self.invalid = [
+            '[1 2]', '{"a" 1}', '[1,]', '{"a": 1,}', 'nul', '[', '', '  ', '[1]]',
+            '{"a": "\x01"}', '123abc', '[-]', '{"a": tru}', '[1.]', 'not json'
+        ]
+
+    def validate(self, text, size):
+        validator = JsonValidator()
+        for piece in pieces(text, size):
+            validator.feed(piece)
+        validator.close()
+
+    def test_valid(self):
+        for text in self.valid:
+            for size in (1, 2, 3, 7, 1000):
+                self.validate(text, size)
+                json.loads(text)
+
+    def test_invalid(self):
+        for text in self.invalid:
+            for size in (1, 2, 3, 7, 1000):
+                with self.assertRaises(JsonStreamError, msg=f'{text!r} in pieces of {size}'):
+                    self.validate(text, size)
+                with self.assertRaises(ValueError):
+                    json.loads(text)
+
+
+class TestCaptureReader(TestCase):
+
+    def setUp(self):
+        self.metadata = {'URL': {'StringValue': 'the url'}}
+        self.content = json.dumps({'Points': [{'v': i, 's': 'é 😀 \\ "\t'} for i in range(20)]})
+
+    def read(self, document, size):
+        data = document.encode('utf-8')
+        reader = CaptureReader(data[i:i + size] for i in range(0, len(data), size))
+        content = ''.join(reader.iter_content())
+        return reader, content
+
+    def test_metadata_before_content(self):
+        document = json.dumps({'metadata': self.metadata, 'content': self.content})
+        for size in range(1, 40):
+            reader, content = self.read(document, size)
+            self.assertEqual(self.content, content)
+            self.assertEqual(self.metadata, reader.metadata)
+            self.assertEqual(len(document.encode('utf-8')), reader.bytes_read)
+
+    def test_content_span(self):
+        document = json.dumps({'other': 'é', 'content': self.content, 'metadata': self.metadata},
+                              ensure_ascii=False)
+        data = document.encode('utf-8')
+        for size in range(1, 40):
+            reader, _ = self.read(document, size)
+            start, end = reader.content_span
+            self.assertEqual(self.content, json.loads(data[start:end]))
+
+    def test_content_before_metadata(self):
+        document = json.dumps({'content': self.content, 'other': [1, 2], 'metadata': self.metadata},
+                              ensure_ascii=False)
+        for size in range(1, 40):
+            reader, content = self.read(document, size)
+            self.assertEqual(self.content, content)
+            self.assertEqual(self.metadata, reader.metadata)
+
+    def test_escaped_surrogate_pairs(self):
+        document = '{"metadata": {}, "content": "\\ud83d\\ude00\\ud83d\\ude00 a \\\\ud83d"}'
+        for size in range(1, len(document)):
+            _, content = self.read(document, size)
+            self.assertEqual(json.loads(document)['content'], content, f'in pieces of {size}')
+            content.encode('utf-8')
+
+    def test_missing_content(self):
+        with self.assertRaises(JsonStreamError):
+            self.read(json.dumps({'metadata': self.metadata}), 5)
+
+    def test_content_not_a_string(self):
+        with self.assertRaises(JsonStreamError):
+            self.read(json.dumps({'metadata': self.metadata, 'content': {'a': 1}}), 5)
+
+    def test_truncated(self):
+        document = json.dumps({'metadata': self.metadata, 'content': self.content})
+        with self.assertRaises(JsonStreamError):
+            self.read(document[:-10], 5)
+
+
+class TestLeadingMetadata(TestCase):
+
+    def setUp(self):
+        self.metadata = {'URL': {'StringValue': 'the url'}, 'ResponseCode': {'StringValue': '500'}}
+
+    def test_metadata_first(self):
+        document = json.dumps({'other': 1, 'metadata': self.metadata, 'content': 'x' * 1000}).encode('utf-8')
+        self.assertEqual(self.metadata, leading_metadata(document[:200]))
+
+    def test_content_first(self):
+        document = json.dumps({'content': 'x' * 10, 'metadata': self.metadata}).encode('utf-8')
+        self.assertIsNone(leading_metadata(document))
+
+    def test_metadata_cut_short(self):
+        document = json.dumps({'metadata': self.metadata, 'content': 'x'}).encode('utf-8')
+        self.assertIsNone(leading_metadata(document[:30]))
@@ -0,0 +1,60 @@
+import tempfile
+from unittest import TestCase, mock
+
+from botocore.exceptions import ClientError
+
+import src.etl.s3 as s3_module
+from src.etl.local_s3 import LocalS3Client
+from src.etl.s3 import S3
+
+
+class TestLocalS3Client(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.client = LocalS3Client(self.root.name)
+        self.data = bytes(range(256)) * 10
+        self.client.put_object(Bucket='bucket', Key='prefix/one.json', Body=self.data)
+        self.client.put_object(Bucket='bucket', Key='prefix/two.json', Body='two')
+        self.client.put_object(Bucket='bucket', Key='other/three.json', Body='three')
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def test_get_object(self):
+        response = self.client.get_object(Bucket='bucket', Key='prefix/one.json')
+        self.assertEqual(len(self.data), response['ContentLength'])
+        self.assertEqual(self.data, b''.join(response['Body'].iter_chunks(100)))
+
+    def test_get_object_range(self):
+        response = self.client.get_object(Bucket='bucket', Key='prefix/one.json', Range='bytes=10-19')
+        self.assertEqual(self.data[10:20], response['Body'].read())
+        self.assertEqual(f'bytes 10-19/{len(self.data)}', response['ContentRange'])
+        response = self.client.get_object(Bucket='bucket', Key='prefix/one.json', Range='bytes=2500-9999')
+        self.assertEqual(self.data[2500:], response['Body'].read())
+
+    def test_missing(self):
+        with self.assertRaises(ClientError):
+            self.client.get_object(Bucket='bucket', Key='missing.json')
+        with self.assertRaises(ClientError):
+            self.client.head_object(Bucket='bucket', Key='missing.json')
+
+    def test_list_objects(self):
+        response = self.client.list_objects_v2(Bucket='bucket', Prefix='prefix/', MaxKeys=1)
+        self.assertEqual(['prefix/one.json'], [item['Key'] for item in response['Contents']])
+        self.assertTrue(response['IsTruncated'])
+        response = self.client.list_objects_v2(Bucket='bucket', Prefix='prefix/',
+                                               ContinuationToken=response['NextContinuationToken'])
+        self.assertEqual(['prefix/two.json'], [item['Key'] for item in response['Contents']])
+        self.assertEqual(3, response['Contents'][0]['Size'])
+        self.assertFalse(response['IsTruncated'])
+
+    def test_selected_by_config(self):
+        s3_module._clients.clear()
+        try:
+            with mock.patch.dict('src.etl.s3.CONFIG', {'aws': {'s3-local-root': self.root.name}}):
+                s3 = S3('us-south-1')
+            self.assertIsInstance(s3.s3, LocalS3Client)
+            self.assertEqual('two', s3.get_file('bucket', 'prefix/two.json'))
+        finally:
+            s3_module._clients.clear()
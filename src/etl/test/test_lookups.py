@@ -0,0 +1,83 @@
+from unittest import TestCase, mock
+
+from src.etl import lookups
+from src.etl.lookups import SELECT_JSON_DATA_LOOKUPS, LookupCache, lookup_ids
+
+
+class FakeLookupCursor:
+    """ a cursor over capture.json_data_lookup, values in pending are added by a load yet to commit """
+
+    def __init__(self):
+        self.values = {('api', 'getTimeSeries'): 1}
+        self.pending = {}
+        self.statements = 0
+        self.rows = []
+
+    def execute(self, sql, params=None):
+        assert sql == SELECT_JSON_DATA_LOOKUPS
+        self.statements += 1
+        self.rows = []
+        for key in zip(*params):
+            if key in self.values:
+                self.rows.append((self.values[key],) + key + (False,))
+            elif key in self.pending:
+                # committed once the statement has waited for it, but not visible to it
+                self.values[key] = self.pending.pop(key)
+            else:
+                self.values[key] = len(self.values) + len(self.pending) + 1
+                self.rows.append((self.values[key],) + key + (True,))
+
+    def fetchall(self):
+        return self.rows
+
+
+@mock.patch.dict(lookups.LOOKUP_STATS, dict.fromkeys(lookups.LOOKUP_STATS, 0))
+class TestLookupIds(TestCase):
+
+    def setUp(self):
+        self.cache = LookupCache(10)
+        self.cursor = FakeLookupCursor()
+
+    def test_found_and_added(self):
+        keys = [('api', 'getTimeSeries'), ('url', 'https://example.com/getTimeSeries'), ('api', 'getTimeSeries')]
+        ids = lookup_ids(self.cursor, keys, self.cache)
+        self.assertEqual({('api', 'getTimeSeries'): 1, ('url', 'https://example.com/getTimeSeries'): 2}, ids)
+        # an added value is not cached until it is known to be committed
+        self.assertEqual(1, self.cache.get(('api', 'getTimeSeries')))
+        self.assertIsNone(self.cache.get(('url', 'https://example.com/getTimeSeries')))
+        self.assertEqual(ids, lookup_ids(self.cursor, keys, self.cache))
+        self.assertEqual(2, self.cursor.statements)
+        self.assertEqual(ids, lookup_ids(self.cursor, keys, self.cache))
+        self.assertEqual(2, self.cursor.statements)
+        self.assertEqual({'hits': 3, 'misses': 3, 'added': 1}, lookups.LOOKUP_STATS)
+
+    def test_added_committed_cached(self):
+        lookup_ids(self.cursor, [('script_name', 'script')], self.cache, committed=True)
+        self.assertEqual(2, self.cache.get(('script_name', 'script')))
+
+    def test_added_by_another_load(self):
+        self.cursor.pending[('parameters', '{}')] = 7
+        self.assertEqual({('parameters', '{}'): 7}, lookup_ids(self.cursor, [('parameters', '{}')], self.cache))
+        self.assertEqual(2, self.cursor.statements)
+
+    def test_gives_up(self):
+        cursor = mock.Mock()
+        cursor.fetchall.return_value = []
+        with self.assertRaises(RuntimeError):
+            lookup_ids(cursor, [('parameters', '{}')], self.cache)
+        self.assertEqual(lookups.LOOKUP_ATTEMPTS, cursor.execute.call_count)
+
+
+class TestLookupCache(TestCase):
+
+    def test_least_recently_used_forgotten(self):
+        cache = LookupCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.put('c', 3)
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((1, 3), (cache.get('a'), cache.get('c')))
+        cache.clear()
+        self.assertIsNone(cache.get('a'))
@@ -0,0 +1,82 @@
+import io
+import json
+from unittest import TestCase, mock
+
+from src.etl import metrics
+
+
+class TestMetrics(TestCase):
+
+    def run_invocation(self, env=None):
+        out = io.StringIO()
+        with mock.patch('sys.stdout', out), mock.patch.dict('os.environ', env or {}):
+            with metrics.invocation('etl'):
+                metrics.put_property('objectKey', 'some-key')
+                with metrics.stage('fetch') as stage:
+                    stage.bytes = 100
+                with metrics.stage('parse', 100):
+                    pass
+                with metrics.stage('parse', 50):
+                    pass
+        return out.getvalue().splitlines()
+
+    def test_embedded_metric_format(self):
+        lines = self.run_invocation()
+        self.assertEqual(1, len(lines))
+        document = json.loads(lines[0])
+        definition = document['_aws']['CloudWatchMetrics'][0]
+        self.assertEqual(metrics.NAMESPACE, definition['Namespace'])
+        self.assertEqual('etl', document['Operation'])
+        self.assertEqual('some-key', document['objectKey'])
+        self.assertEqual(100, document['fetch_bytes'])
+        self.assertEqual(150, document['parse_bytes'])
+        for name in ('fetch_ms', 'parse_ms', 'total_ms', 'fetch_peak_memory_delta', 'peak_memory'):
+            self.assertIn(name, document)
+        # every metric value in the document is declared with its unit
+        units = {metric['Name']: metric['Unit'] for metric in definition['Metrics']}
+        self.assertEqual('Milliseconds', units['fetch_ms'])
+        self.assertEqual('Bytes', units['parse_bytes'])
+        self.assertEqual('Bytes', units['fetch_peak_memory_delta'])
+        for name in units:
+            self.assertIn(name, document)
+
+    def test_stage_outside_invocation(self):
+        out = io.StringIO()
+        with mock.patch('sys.stdout', out):
+            with metrics.stage('fetch', 10) as stage:
+                pass
+        self.assertEqual(10, stage.bytes)
+        self.assertEqual('', out.getvalue())
+
+    def test_error_recorded(self):
+        out = io.StringIO()
+        with mock.patch('sys.stdout', out):
+            with self.assertRaises(ValueError):
+                with metrics.invocation('etl'):
+                    raise ValueError('bad')
+        self.assertEqual('ValueError', json.loads(out.getvalue())['error'])
+
+    def test_failed_stage_recorded(self):
+        out = io.StringIO()
+        with mock.patch('sys.stdout', out):
+            with self.assertRaises(ValueError):
+                with metrics.invocation('etl'):
+                    with metrics.stage('fetch'):
+                        pass
+                    try:
+                        with metrics.stage('persist'), metrics.stage('validate'):
+                            raise ValueError('bad')
+                    finally:
+                        self.assertEqual('validate', metrics.failed_stage())
+        self.assertEqual('validate', json.loads(out.getvalue())['failedStage'])
+        self.assertIsNone(metrics.failed_stage())
+
+    def test_cprofile(self):
+        lines = self.run_invocation({'PROFILE_ETL': 'cprofile'})
+        self.assertTrue(any('cumulative' in line for line in lines))
+        json.loads(lines[-1])
+
+    def test_tracemalloc(self):
+        lines = self.run_invocation({'PROFILE_ETL': 'tracemalloc'})
+        self.assertTrue(lines[0].startswith('tracemalloc'))
+        json.loads(lines[-1])
@@ -0,0 +1,129 @@
+import datetime
+from unittest import TestCase, mock
+
+from src.etl.partitions import PartitionMap, RowCopyReader, SELECT_PARTITION_KEY, SELECT_PARTITIONS
+
+SEQUENCE = 'capture.json_data_json_data_id_seq'
+
+
+def catalog(key, partitions):
+    """ a cursor answering the catalog queries of a partition map """
+    cursor = mock.Mock()
+    cursor.fetchone.return_value = key
+    cursor.fetchall.return_value = partitions
+    return cursor
+
+
+def row(start_time=datetime.datetime(2020, 2, 3), response_code=200, api='getTimeSeriesData'):
+    return (start_time, start_time, response_code, 'https://example.com', api, 'script', 1, '{}', '{"a": 1}')
+
+
+class TestPartitionMap(TestCase):
+
+    def setUp(self):
+        self.range_key = ('r', 1, 'start_time', 'timestamp without time zone', SEQUENCE)
+        self.months = [
+            ('capture.json_data_2020_01', "FOR VALUES FROM ('2020-01-01 00:00:00') TO ('2020-02-01 00:00:00')"),
+            ('capture.json_data_2020_02', "FOR VALUES FROM ('2020-02-01 00:00:00') TO ('2020-03-01 00:00:00')"),
+            ('capture.json_data_old', "FOR VALUES FROM (MINVALUE) TO ('2020-01-01 00:00:00')"),
+        ]
+
+    def test_range(self):
+        cursor = catalog(self.range_key, self.months)
+        partitions = PartitionMap('capture.json_data').current(cursor)
+        cursor.execute.assert_any_call(SELECT_PARTITION_KEY, {'table': 'capture.json_data'})
+        cursor.execute.assert_any_call(SELECT_PARTITIONS, ('capture.json_data',))
+        self.assertTrue(partitions.routable)
+        self.assertEqual(SEQUENCE, partitions.sequence)
+        self.assertEqual('capture.json_data_2020_02', partitions.partition_of(row()))
+        self.assertEqual('capture.json_data_2020_02', partitions.partition_of(row(datetime.datetime(2020, 2, 1))))
+        self.assertEqual('capture.json_data_2020_01', partitions.partition_of(row(datetime.datetime(2020, 1, 31))))
+        self.assertEqual('capture.json_data_old', partitions.partition_of(row(datetime.datetime(1999, 1, 1))))
+        self.assertIsNone(partitions.partition_of(row(datetime.datetime(2020, 3, 1))))
+
+    def test_range_default(self):
+        partitions = PartitionMap('capture.json_data')
+        partitions.refresh(catalog(self.range_key, self.months[:2] + [('capture.json_data_rest', 'DEFAULT')]))
+        self.assertEqual('capture.json_data_rest', partitions.partition_of(row(datetime.datetime(1999, 1, 1))))
+        self.assertEqual('capture.json_data_rest', partitions.partition_of(row(datetime.datetime(2021, 1, 1))))
+        self.assertEqual('capture.json_data_2020_01', partitions.partition_of(row(datetime.datetime(2020, 1, 1))))
+
+    def test_range_fraction(self):
+        partitions = PartitionMap('capture.json_data')
+        partitions.refresh(catalog(self.range_key, [
+            ('capture.json_data_a', "FOR VALUES FROM (MINVALUE) TO ('2020-01-01 00:00:00.5')"),
+            ('capture.json_data_b', "FOR VALUES FROM ('2020-01-01 00:00:00.5') TO (MAXVALUE)"),
+        ]))
+        self.assertEqual('capture.json_data_a', partitions.partition_of(row(datetime.datetime(2020, 1, 1))))
+        self.assertEqual('capture.json_data_b',
+                         partitions.partition_of(row(datetime.datetime(2020, 1, 1, 0, 0, 0, 500000))))
+        self.assertEqual('capture.json_data_b', partitions.partition_of(row(datetime.datetime(2999, 1, 1))))
+
+    def test_list(self):
+        partitions = PartitionMap('capture.json_data')
+        partitions.refresh(catalog(('l', 1, 'api', 'text', SEQUENCE), [
+            ('capture.json_data_ts', "FOR VALUES IN ('getTimeSeriesData', 'getTimeSeries''s')"),
+            ('capture.json_data_other', 'DEFAULT'),
+        ]))
+        groups = partitions.group([row(api='getTimeSeriesData'), row(api='getFieldVisits'), row(api="getTimeSeries's")])
+        self.assertEqual({'capture.json_data_ts': [0, 2], 'capture.json_data_other': [1]}, groups)
+
+    def test_list_integers(self):
+        partitions = PartitionMap('capture.json_data')
+        partitions.refresh(catalog(('l', 1, 'response_code', 'integer', SEQUENCE), [
+            ('capture.json_data_ok', 'FOR VALUES IN (200, 204)'),
+        ]))
+        groups = partitions.group([row(response_code=200), row(response_code=500), row(response_code=204)])
+        self.assertEqual({'capture.json_data_ok': [0, 2], None: [1]}, groups)
+
+    def test_unsupported(self):
+        for key in [None,
+                    ('r', 1, 'partition_number', 'integer', SEQUENCE),
+                    ('r', 2, 'start_time', 'timestamp without time zone', SEQUENCE),
+                    ('h', 1, 'start_time', 'timestamp without time zone', SEQUENCE),
+                    ('r', 1, 'api', 'text', SEQUENCE),
+                    ('r', 1, 'start_time', 'timestamp with time zone', SEQUENCE),
+                    ('r', 1, 'start_time', 'timestamp without time zone', None)]:
+            partitions = PartitionMap('capture.json_data')
+            partitions.refresh(catalog(key, self.months))
+            self.assertFalse(partitions.routable, key)
+
+    def test_bound_not_understood(self):
+        partitions = PartitionMap('capture.json_data')
+        partitions.refresh(catalog(self.range_key, [('capture.json_data_x', 'FOR VALUES WITH (modulus 4, remainder 0)')]))
+        self.assertFalse(partitions.routable)
+
+    def test_refresh_after_ttl(self):
+        cursor = catalog(self.range_key, self.months)
+        partitions = PartitionMap('capture.json_data', ttl=60)
+        with mock.patch('src.etl.partitions.time.monotonic', return_value=100.0):
+            partitions.current(cursor)
+            partitions.current(cursor)
+        self.assertEqual(2, cursor.execute.call_count)
+        with mock.patch('src.etl.partitions.time.monotonic', return_value=161.0):
+            partitions.current(cursor)
+        self.assertEqual(4, cursor.execute.call_count)
+        partitions.expire()
+        with mock.patch('src.etl.partitions.time.monotonic', return_value=162.0):
+            partitions.current(cursor)
+        self.assertEqual(6, cursor.execute.call_count)
+
+
+class TestRowCopyReader(TestCase):
+
+    def test_text_format(self):
+        rows = [row(), (datetime.datetime(2020, 1, 1, 0, 0, 0, 250), datetime.datetime(2020, 1, 1), 500,
+                        'u', 'a', None, 2, '{}', '{"s": "tab\\t \\\\ \r\n"}')]
+        reader = RowCopyReader(rows, [7, 8])
+        lines = []
+        while True:
+            line = reader.read(8192)
+            if not line:
+                break
+            lines.append(line)
+        self.assertEqual([
+            '7\t2020-02-03 00:00:00\t2020-02-03 00:00:00\t200\thttps://example.com\tgetTimeSeriesData\tscript\t1\t'
+            '{}\t{"a": 1}\n',
+            '8\t2020-01-01 00:00:00.000250\t2020-01-01 00:00:00\t500\tu\ta\t\\N\t2\t{}\t'
+            '{"s": "tab\\\\t \\\\\\\\ \\r\\n"}\n',
+        ], lines)
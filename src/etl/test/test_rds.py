@@ -1,8 +1,33 @@
+import gzip
+import hashlib
+import json
+import struct
+import tempfile
+import tracemalloc
 import unittest
 from unittest import TestCase, mock
 
-from src.etl.rds import RDS
-from src.etl.rds import ValidationException
+from psycopg2 import DataError, OperationalError, errors
+
+import src.etl.rds as rds_module
+import src.etl.s3 as s3_module
+from src.etl.config import CONFIG
+from src.etl.event_processor import BufferedCapturedData
+from src.etl.local_s3 import LocalS3Client
+from src.etl.rds import RDS, INSERT_JSON_DATA, INSERT_JSON_DATA_VALUES, COPY_CSV_STAGE
+from src.etl.rds import PREPARE_INSERT_JSON_DATA, EXECUTE_INSERT_JSON_DATA, EXECUTE_INSERT_JSON_DATA_FROM_STAGE
+from src.etl.rds import CREATE_CONTENT_STAGE, COPY_CONTENT_STAGE, EXECUTE_INSERT_JSON_DATA_FROM_LITERAL_STAGE
+from src.etl.rds import COPY_COMPRESSED_STAGE, EXECUTE_INSERT_COMPRESSED_JSON_DATA_FROM_STAGE
+from src.etl.rds import CLAIM_JSON_DATA_LOAD, RECORD_JSON_DATA_LOAD, INSERT_JSON_DATA_LOADS
+from src.etl.rds import CLAIM_JSON_DATA_LOADS, SELECT_JSON_DATA_LOADS, RELEASE_JSON_DATA_LOADS
+from src.etl.rds import shared_rds, discard_shared_rds, JSON_VALIDATORS, RdsPool
+from src.etl.rds import ValidationException, DatabaseUnavailable, CircuitOpen, AdmissionTimeout
+from src.etl.rds import TRY_ADMISSION_LOCK, RELEASE_ADMISSION_LOCK
+from src.etl.rds import SELECT_JSON_DATA_IDS, SELECT_JSON_DATA_SEQUENCE, COPY_JSON_DATA_ROWS
+from src.etl.partitions import SELECT_PARTITION_KEY, SELECT_PARTITIONS
+from src.etl.lookups import SELECT_JSON_DATA_LOOKUPS, LookupCache
+from src.etl.rds import EXECUTE_INSERT_CHECKED_JSON_DATA, EXECUTE_INSERT_CHECKED_JSON_DATA_FROM_STAGE, \
+    PREPARE_INSERT_CHECKED_JSON_DATA
 
 
 class TestRDS(TestCase):
@@ -31,7 +56,7 @@ class TestRDS(TestCase):
                 database='some-database',
                 user='some-user',
                 password='some-password',
-                connect_timeout=65
+                connect_timeout=10
             )
 
 
@@ -121,6 +146,1190 @@ class RdsValidationTests(TestCase):
             with self.assertRaises(ValidationException, msg="Should throw an exception on invalid JSON."):
                 rds.validate_json("Json Var", 'not json')
 
+    def test_validate_json_validators(self, mock_conn):
+        for name in JSON_VALIDATORS:
+            rds = RDS(json_validator=name)
+            rds.validate_json("Json Var", '{"json": ["value", 1, null]}')
+            for invalid in ('not json', '{"json": }', '["value" 1]', '{"json": "value"} extra'):
+                with self.assertRaises(ValidationException, msg=f"{name} should reject {invalid!r}."):
+                    rds.validate_json("Json Var", invalid)
+
+    def test_validate_json_unknown_validator(self, mock_conn):
+        rds = RDS(json_validator='unknown')
+        self.assertIs(JSON_VALIDATORS['scan'], rds.json_validator)
+
+
+@mock.patch('src.etl.rds.connect')
+class SharedRdsTests(TestCase):
+
+    def setUp(self):
+        discard_shared_rds()
+        self.stats = mock.patch.dict('src.etl.rds.CONNECTION_STATS', {'connects': 0, 'reconnects': 0, 'reused': 0,
+                                                                      'retries': 0, 'failures': 0, 'rejected': 0})
+        self.stats.start()
+
+    def tearDown(self):
+        self.stats.stop()
+        discard_shared_rds()
+
+    def test_reused_when_healthy(self, mock_conn):
+        mock_conn.return_value.closed = 0
+        first = shared_rds()
+        second = shared_rds()
+        self.assertIs(first, second)
+        mock_conn.assert_called_once()
+        mock_conn.return_value.cursor.return_value.execute.assert_called_with('SELECT 1')
+        self.assertEqual({'connects': 1, 'reconnects': 0, 'reused': 1, 'retries': 0, 'failures': 0, 'rejected': 0},
+                         rds_module.CONNECTION_STATS)
+
+    def test_reconnect_when_closed(self, mock_conn):
+        stale, fresh = mock.Mock(closed=0), mock.Mock(closed=0)
+        mock_conn.side_effect = [stale, fresh]
+        rds = shared_rds()
+        # the server closed the connection while the container was frozen
+        stale.closed = 2
+        self.assertIs(rds, shared_rds())
+        self.assertIs(fresh, rds.conn)
+        stale.close.assert_called_once()
+        self.assertEqual({'connects': 2, 'reconnects': 1, 'reused': 0, 'retries': 0, 'failures': 0, 'rejected': 0},
+                         rds_module.CONNECTION_STATS)
+
+    def test_reconnect_when_broken(self, mock_conn):
+        broken, fresh = mock.Mock(closed=0), mock.Mock(closed=0)
+        broken.cursor.return_value.execute.side_effect = OperationalError('server closed the connection unexpectedly')
+        broken.close.side_effect = OperationalError('already gone')
+        mock_conn.side_effect = [broken, fresh]
+        rds = shared_rds()
+        self.assertIs(rds, shared_rds())
+        self.assertIs(fresh, rds.conn)
+        self.assertEqual({'connects': 2, 'reconnects': 1, 'reused': 0, 'retries': 0, 'failures': 0, 'rejected': 0},
+                         rds_module.CONNECTION_STATS)
+
+    def test_discard(self, mock_conn):
+        mock_conn.return_value.closed = 0
+        first = shared_rds()
+        discard_shared_rds()
+        self.assertIsNot(first, shared_rds())
+        self.assertEqual(2, mock_conn.call_count)
+
+
+@mock.patch('src.etl.rds.connect')
+class RdsExecuteTests(TestCase):
+
+    def test_no_mogrify_without_debug(self, mock_conn):
+        cursor = mock_conn.return_value.cursor.return_value
+        rds = RDS()
+        with mock.patch.object(rds_module.logger, 'isEnabledFor', return_value=False):
+            rds._execute_sql('SELECT %s', ('value',))
+        cursor.mogrify.assert_not_called()
+        cursor.execute.assert_called_once_with('SELECT %s', ('value',))
+
+    def test_mogrify_with_debug(self, mock_conn):
+        cursor = mock_conn.return_value.cursor.return_value
+        rds = RDS()
+        with mock.patch.object(rds_module.logger, 'isEnabledFor', return_value=True):
+            rds._execute_sql('SELECT %s', ('value',))
+        cursor.mogrify.assert_called_once_with('SELECT %s', ('value',))
+
+
+@mock.patch('src.etl.rds.connect')
+class RdsPreparedTests(TestCase):
+
+    def setUp(self):
+        self.attributes = {
+            'start_time': '1580000000', 'response_time': '1580000001', 'response_code': '200',
+            'script_pid': '1234', 'url': 'https://some.net/api/call', 'api': 'api',
+            'script_name': 'script', 'parameters': '{"a": 1}'
+        }
+        self.copied = []
+
+    def copy_expert(self, sql, file, size=8192):
+        while True:
+            data = file.read(size)
+            if not data:
+                break
+            self.copied.append(data)
+
+    def statements(self, cursor):
+        return [call[0][0] for call in cursor.execute.call_args_list]
+
+    def test_prepared_once_per_connection(self, mock_conn):
+        cursor = mock_conn.return_value.cursor.return_value
+        cursor.fetchone.return_value = (1, 2)
+        datum = FakeData(content='{"a": 1}', **self.attributes)
+
+        rds = RDS(dedup=False)
+        rds.persist_data(datum)
+        rds.persist_data(datum)
+        self.assertEqual(1, self.statements(cursor).count(PREPARE_INSERT_JSON_DATA))
+        sql, params = cursor.execute.call_args[0]
+        self.assertEqual(EXECUTE_INSERT_JSON_DATA, sql)
+        self.assertEqual('{"a": 1}', params[-1])
+
+        rds.reconnect()
+        rds.persist_data(datum)
+        self.assertEqual(2, self.statements(cursor).count(PREPARE_INSERT_JSON_DATA))
+
+    def test_large_content_copied(self, mock_conn):
+        cursor = mock_conn.return_value.cursor.return_value
+        cursor.copy_expert.side_effect = self.copy_expert
+        cursor.fetchone.return_value = (1, 2)
+        content = json.dumps({'text': 'é "quoted" \\ 😀\t,', 'list': list(range(1000))}, ensure_ascii=False)
+        datum = FakeData(content=content, **self.attributes)
+
+        with mock.patch.dict(CONFIG['load'], {'copy_content_min_size': 1000, 'stream_chunk_size': 512}):
+            self.assertEqual((1, 2), RDS(dedup=False).persist_data(datum))
+
+        self.assertEqual(COPY_CSV_STAGE, cursor.copy_expert.call_args[0][0])
+        self.assertEqual(b'\x1e' + content.encode('utf-8') + b'\x1e\n', b''.join(self.copied))
+        statements = self.statements(cursor)
+        self.assertLess(statements.index(CREATE_CONTENT_STAGE), len(statements) - 1)
+        sql, params = cursor.execute.call_args[0]
+        self.assertEqual(EXECUTE_INSERT_JSON_DATA_FROM_STAGE, sql)
+        self.assertNotIn(content, params)
+        mock_conn.return_value.commit.assert_called_once()
+        self.assertTrue(mock_conn.return_value.autocommit)
+
+
+@mock.patch('src.etl.rds.connect')
+class RdsJsonbValidationTests(TestCase):
+
+    def setUp(self):
+        self.attributes = {
+            'start_time': '1580000000', 'response_time': '1580000001', 'response_code': '200',
+            'script_pid': '1234', 'url': 'https://some.net/api/call', 'api': 'api',
+            'script_name': 'script', 'parameters': '{"a": 1}'
+        }
+
+    def persist(self, mock_conn, datum, error=None):
+        cursor = mock_conn.return_value.cursor.return_value
+        cursor.fetchone.return_value = (1, 2)
+        if error is not None:
+            cursor.execute.side_effect = lambda sql, *args: self.raise_on_execute(sql, error)
+        return RDS(dedup=False, json_validator='jsonb').persist_data(datum)
+
+    @staticmethod
+    def raise_on_execute(sql, error):
+        if sql.startswith('EXECUTE'):
+            raise error
+
+    def test_not_parsed_here(self, mock_conn):
+        cursor = mock_conn.return_value.cursor.return_value
+        cursor.fetchone.return_value = (1, 2)
+        rds = RDS(dedup=False, json_validator='jsonb')
+        rds.json_validator = mock.Mock()
+        self.assertEqual((1, 2), rds.persist_data(FakeData(content='{"a": 1}', **self.attributes)))
+        rds.json_validator.assert_not_called()
+        self.assertIn(PREPARE_INSERT_CHECKED_JSON_DATA, [call[0][0] for call in cursor.execute.call_args_list])
+        sql, params = cursor.execute.call_args[0]
+        self.assertEqual(EXECUTE_INSERT_CHECKED_JSON_DATA, sql)
+        self.assertEqual(('{"a": 1}', '{"a": 1}'), params[-2:])
+        mock_conn.return_value.commit.assert_called_once()
+
+    def test_large_content_checked_from_stage(self, mock_conn):
+        datum = FakeData(content='{"a": 1}', **self.attributes)
+        with mock.patch.dict(CONFIG['load'], {'copy_content_min_size': 1}):
+            self.assertEqual((1, 2), self.persist(mock_conn, datum))
+        cursor = mock_conn.return_value.cursor.return_value
+        self.assertEqual(EXECUTE_INSERT_CHECKED_JSON_DATA_FROM_STAGE, cursor.execute.call_args[0][0])
+
+    def test_large_content_escaped(self, mock_conn):
+        # a quote and newline of the CSV framing would otherwise stage two rows, a quote and delimiter break the copy
+        datum = FakeData(content='{}\x1e\n\x1e[]\x1e\x1f\t\\', **self.attributes)
+        cursor = mock_conn.return_value.cursor.return_value
+        copied = []
+        cursor.copy_expert.side_effect = lambda sql, file: copied.extend(iter(lambda: file.read(8192), ''))
+        with mock.patch.dict(CONFIG['load'], {'copy_content_min_size': 1, 'stream_chunk_size': 3}):
+            self.persist(mock_conn, datum)
+        self.assertEqual(COPY_CONTENT_STAGE, cursor.copy_expert.call_args[0][0])
+        self.assertEqual('{}\x1e\\n\x1e[]\x1e\x1f\\t\\\\\n', ''.join(copied))
+        self.assertEqual(EXECUTE_INSERT_CHECKED_JSON_DATA_FROM_STAGE, cursor.execute.call_args[0][0])
+
+    def test_content_rejected_by_database(self, mock_conn):
+        datum = FakeData(content='{"a": ', **self.attributes)
+        error = errors.InvalidTextRepresentation('invalid input syntax for type json')
+        with self.assertRaises(ValidationException) as context:
+            self.persist(mock_conn, datum, error)
+        self.assertEqual(('Must be JSON', 'JSON Data', 'expected valid JSON', '{"a": '), context.exception.args)
+        mock_conn.return_value.rollback.assert_called_once()
+
+    def test_parameters_rejected_by_database(self, mock_conn):
+        self.attributes['parameters'] = '{"a": 1'
+        datum = FakeData(content='{"a": 1}', **self.attributes)
+        error = errors.UntranslatableCharacter('unsupported Unicode escape sequence')
+        with self.assertRaises(ValidationException) as context:
+            self.persist(mock_conn, datum, error)
+        self.assertEqual('Parameters', context.exception.args[1])
+
+    def test_other_data_errors_raised(self, mock_conn):
+        datum = FakeData(content='{"a": 1}', **self.attributes)
+        with self.assertRaises(DataError):
+            self.persist(mock_conn, datum, errors.NumericValueOutOfRange('integer out of range'))
+
+    def test_compressed_content_checked_here(self, mock_conn):
+        datum = FakeData(content='{"a": ', **self.attributes)
+        with self.assertRaises(ValidationException):
+            RDS(dedup=False, json_validator='jsonb', compression='gzip').persist_data(datum)
+        mock_conn.return_value.cursor.return_value.copy_expert.assert_not_called()
+
+
+@mock.patch('src.etl.rds.connect')
+class RdsCompressionTests(TestCase):
+
+    def setUp(self):
+        self.attributes = {
+            'start_time': '1580000000', 'response_time': '1580000001', 'response_code': '200',
+            'script_pid': '1234', 'url': 'https://some.net/api/call', 'api': 'api',
+            'script_name': 'script', 'parameters': '{"a": 1}'
+        }
+        self.content = json.dumps({'Points': [{'v': i, 's': 'é 😀'} for i in range(1000)]}, ensure_ascii=False)
+        self.copied = []
+
+    def copy_expert(self, sql, file, size=8192):
+        while True:
+            data = file.read(size)
+            if not data:
+                break
+            self.copied.append(data)
+
+    def copied_value(self):
+        """ the one bytea value of the COPY binary data copied """
+        data = b''.join(self.copied)
+        self.assertEqual(b'PGCOPY\n\xff\r\n\x00', data[:11])
+        fields, length = struct.unpack('!hi', data[19:25])
+        self.assertEqual(1, fields)
+        self.assertEqual(struct.pack('!h', -1), data[25 + length:])
+        return data[25:25 + length]
+
+    def persist(self, mock_conn, method, datum):
+        cursor = mock_conn.return_value.cursor.return_value
+        cursor.copy_expert.side_effect = self.copy_expert
+        cursor.fetchone.return_value = (1, 2)
+        with mock.patch.dict(CONFIG['load'], {'stream_chunk_size': 1000}):
+            rds = RDS(dedup=False, compression='gzip')
+            self.assertEqual((1, 2), getattr(rds, method)(datum))
+        self.assertEqual(COPY_COMPRESSED_STAGE, cursor.copy_expert.call_args[0][0])
+        sql, params = cursor.execute.call_args[0]
+        self.assertEqual(EXECUTE_INSERT_COMPRESSED_JSON_DATA_FROM_STAGE, sql)
+        self.assertEqual('gzip', params[-1])
+        mock_conn.return_value.commit.assert_called_once()
+
+    def test_persist_data(self, mock_conn):
+        self.persist(mock_conn, 'persist_data', FakeData(content=self.content, **self.attributes))
+        self.assertEqual(self.content, gzip.decompress(self.copied_value()).decode('utf-8'))
+
+    def test_persist_stream(self, mock_conn):
+        pieces = [self.content[i:i + 100] for i in range(0, len(self.content), 100)]
+        self.persist(mock_conn, 'persist_stream', FakeStreamedData(pieces, **self.attributes))
+        self.assertEqual(self.content, gzip.decompress(self.copied_value()).decode('utf-8'))
+
+    def test_persist_stream_invalid_content(self, mock_conn):
+        datum = FakeStreamedData(['{"a": ', 'not json}'], **self.attributes)
+        with self.assertRaises(ValidationException):
+            RDS(dedup=False, compression='gzip').persist_stream(datum)
+        mock_conn.return_value.cursor.return_value.copy_expert.assert_not_called()
+        mock_conn.return_value.rollback.assert_called_once()
+
+    def test_unavailable_falls_back_to_gzip(self, mock_conn):
+        self.assertEqual('gzip', RDS(compression='lz4').compression)
+        self.assertIsNone(RDS(compression='').compression)
+
+    def test_read_content(self, mock_conn):
+        cursor = mock_conn.return_value.cursor.return_value
+        cursor.fetchone.side_effect = [
+            (None, memoryview(gzip.compress(self.content.encode('utf-8'))), 'gzip'),
+            (self.content, None, None),
+            None
+        ]
+        rds = RDS()
+        self.assertEqual(self.content, rds.read_content(1, 2))
+        self.assertEqual(self.content, rds.read_content(3, 2))
+        self.assertIsNone(rds.read_content(4, 2))
+
+
+@mock.patch('src.etl.rds.connect')
+class RdsPoolTests(TestCase):
+
+    def test_bounded_and_reused(self, mock_conn):
+        mock_conn.side_effect = lambda **kwargs: mock.Mock(closed=0)
+        pool = RdsPool(2)
+        with pool.connection() as first:
+            with pool.connection() as second:
+                self.assertIsNot(first, second)
+        with pool.connection() as third:
+            self.assertIn(third, (first, second))
+        self.assertEqual(2, mock_conn.call_count)
+        pool.close()
+        first.conn.close.assert_called_once()
+        second.conn.close.assert_called_once()
+
+    def test_reconnects_stale(self, mock_conn):
+        stale, fresh = mock.Mock(closed=0), mock.Mock(closed=0)
+        mock_conn.side_effect = [stale, fresh]
+        pool = RdsPool(1)
+        with pool.connection() as rds:
+            pass
+        stale.closed = 1
+        with pool.connection() as again:
+            self.assertIs(rds, again)
+            self.assertIs(fresh, again.conn)
+
+
+class FakeStreamedData:
+
+    def __init__(self, pieces, **attributes):
+        self.pieces = pieces
+        self.attributes = attributes
+        self.bytes_read = sum(len(piece) for piece in pieces)
+
+    def iter_content(self):
+        yield from self.pieces
+        self.__dict__.update(self.attributes)
+
+
+@mock.patch('src.etl.rds.connect')
+class RdsStreamTests(TestCase):
+
+    def setUp(self):
+        self.attributes = {
+            'start_time': '1580000000', 'response_time': '1580000001', 'response_code': '200',
+            'script_pid': '1234', 'url': 'https://some.net/api/call', 'api': 'api',
+            'script_name': 'script', 'parameters': '{"a": 1}'
+        }
+        self.copied = []
+
+    def copy_expert(self, sql, file):
+        while True:
+            data = file.read(8192)
+            if not data:
+                break
+            self.copied.append(data)
+
+    def test_persist_stream(self, mock_conn):
+        cursor = mock_conn.return_value.cursor.return_value
+        cursor.copy_expert.side_effect = self.copy_expert
+        cursor.fetchone.return_value = (1, 2)
+        content = json.dumps({'text': 'back \\ slash', 'list': [1, 2]}, indent='\t').replace('\n', '\r\n')
+        datum = FakeStreamedData([content[:7], '', content[7:]], **self.attributes)
+
+        rds = RDS()
+        self.assertEqual((1, 2), rds.persist_stream(datum))
+
+        copied = ''.join(self.copied)
+        escaped = content.replace('\\', '\\\\').replace('\t', '\\t').replace('\r', '\\r').replace('\n', '\\n')
+        self.assertEqual(escaped + '\n', copied)
+        self.assertNotIn('\t', copied)
+        sql, params = cursor.execute.call_args[0]
+        self.assertEqual(EXECUTE_INSERT_JSON_DATA_FROM_STAGE, sql)
+        self.assertEqual('api', params[4])
+        mock_conn.return_value.commit.assert_called_once()
+        mock_conn.return_value.rollback.assert_not_called()
+        self.assertTrue(mock_conn.return_value.autocommit)
+
+    def test_persist_stream_invalid_content(self, mock_conn):
+        cursor = mock_conn.return_value.cursor.return_value
+        cursor.copy_expert.side_effect = self.copy_expert
+        datum = FakeStreamedData(['{"a": ', 'not json}'], **self.attributes)
+
+        rds = RDS()
+        with self.assertRaises(ValidationException):
+            rds.persist_stream(datum)
+        mock_conn.return_value.rollback.assert_called_once()
+        mock_conn.return_value.commit.assert_not_called()
+
+    def test_persist_stream_invalid_attributes(self, mock_conn):
+        cursor = mock_conn.return_value.cursor.return_value
+        cursor.copy_expert.side_effect = self.copy_expert
+        self.attributes['response_code'] = '999'
+        datum = FakeStreamedData(['{}'], **self.attributes)
+
+        rds = RDS()
+        with self.assertRaises(ValidationException):
+            rds.persist_stream(datum)
+        mock_conn.return_value.rollback.assert_called_once()
+
+
+class FakeData:
+
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+@mock.patch('src.etl.rds.connect')
+class RdsBatchTests(TestCase):
+
+    def setUp(self):
+        attributes = {
+            'start_time': '1580000000', 'response_time': '1580000001', 'response_code': '200',
+            'script_pid': '1234', 'url': 'https://some.net/api/call', 'api': 'api',
+            'script_name': 'script', 'parameters': '{"a": 1}'
+        }
+        self.data = [
+            FakeData(content='{"n": 0}', **attributes),
+            FakeData(content='not json', **attributes),
+            FakeData(content='{"n": 2}', **attributes),
+        ]
+
+    @mock.patch('src.etl.rds.execute_values')
+    def test_persist_batch(self, mock_execute_values, mock_conn):
+        mock_execute_values.return_value = [(10, 1), (12, 1)]
+        rds = RDS()
+        outcomes = rds.persist_batch(self.data)
+        self.assertEqual((10, 1), outcomes[0])
+        self.assertIsInstance(outcomes[1], ValidationException)
+        self.assertEqual((12, 1), outcomes[2])
+        _, sql, rows = mock_execute_values.call_args[0]
+        self.assertEqual(INSERT_JSON_DATA_VALUES, sql)
+        self.assertEqual(['{"n": 0}', '{"n": 2}'], [row[-1] for row in rows])
+        mock_conn.return_value.commit.assert_called_once()
+        self.assertTrue(mock_conn.return_value.autocommit)
+
+    @mock.patch('src.etl.rds.execute_values')
+    def test_persist_batch_isolates_bad_row(self, mock_execute_values, mock_conn):
+        mock_execute_values.side_effect = DataError('value too long')
+        cursor = mock_conn.return_value.cursor.return_value
+        bad_row = DataError('value too long')
+
+        def execute(sql, params=None):
+            if sql == INSERT_JSON_DATA and params[-1] == '{"n": 2}':
+                raise bad_row
+        cursor.execute.side_effect = execute
+        cursor.fetchone.return_value = (10, 1)
+
+        rds = RDS()
+        outcomes = rds.persist_batch(self.data)
+        self.assertEqual((10, 1), outcomes[0])
+        self.assertIsInstance(outcomes[1], ValidationException)
+        self.assertIs(bad_row, outcomes[2])
+        cursor.execute.assert_any_call('ROLLBACK TO SAVEPOINT json_data_row')
+        mock_conn.return_value.rollback.assert_called_once()
+        mock_conn.return_value.commit.assert_called_once()
+
+    @mock.patch('src.etl.rds.execute_values')
+    def test_persist_batch_all_invalid(self, mock_execute_values, mock_conn):
+        rds = RDS()
+        outcomes = rds.persist_batch(self.data[1:2])
+        self.assertIsInstance(outcomes[0], ValidationException)
+        mock_execute_values.assert_not_called()
+
 
 if __name__ == '__main__':
     unittest.main()
+
+
+@mock.patch('src.etl.rds.connect')
+class RdsDedupTests(TestCase):
+
+    def setUp(self):
+        self.attributes = {
+            'start_time': '1580000000', 'response_time': '1580000001', 'response_code': '200',
+            'script_pid': '1234', 'url': 'https://some.net/api/call', 'api': 'api',
+            'script_name': 'script', 'parameters': '{"a": 1}', 'content_hash': 'abc123'
+        }
+        self.stats = mock.patch.dict('src.etl.rds.DEDUP_STATS', {'hits': 0, 'misses': 0})
+        self.stats.start()
+
+    def tearDown(self):
+        self.stats.stop()
+
+    def statements(self, cursor):
+        return [call[0][0] for call in cursor.execute.call_args_list]
+
+    def test_find_loaded(self, mock_conn):
+        cursor = mock_conn.return_value.cursor.return_value
+        cursor.fetchone.side_effect = [(4, 1), None]
+        rds = RDS(dedup=True)
+        self.assertEqual((4, 1), rds.find_loaded('uuid-one'))
+        self.assertIsNone(rds.find_loaded('uuid-two'))
+        self.assertEqual({'hits': 1, 'misses': 0}, rds_module.DEDUP_STATS)
+
+    def test_missing_table_not_created(self, mock_conn):
+        cursor = mock_conn.return_value.cursor.return_value
+        cursor.execute.side_effect = errors.UndefinedTable('relation "capture.json_data_load" does not exist')
+        rds = RDS(dedup=True)
+
+        for find in (lambda: rds.find_loaded('uuid-one'), lambda: rds.find_loaded_many(['uuid-one'])):
+            with self.assertRaisesRegex(RuntimeError, 'migrations/001_json_data_load.sql'):
+                find()
+        self.assertFalse([sql for sql in self.statements(cursor) if 'CREATE' in sql])
+
+    def test_first_load_claimed_and_recorded(self, mock_conn):
+        cursor = mock_conn.return_value.cursor.return_value
+        cursor.fetchone.side_effect = [('uuid-one',), (5, 1)]
+        datum = FakeData(uuid='uuid-one', content='{"a": 1}', **self.attributes)
+
+        self.assertEqual((5, 1), RDS(dedup=True).persist_data(datum))
+
+        statements = self.statements(cursor)
+        self.assertLess(statements.index(CLAIM_JSON_DATA_LOAD), statements.index(EXECUTE_INSERT_JSON_DATA))
+        cursor.execute.assert_any_call(RECORD_JSON_DATA_LOAD, ('abc123', 5, 1, 'uuid-one'))
+        mock_conn.return_value.commit.assert_called_once()
+        self.assertTrue(mock_conn.return_value.autocommit)
+        self.assertEqual({'hits': 0, 'misses': 1}, rds_module.DEDUP_STATS)
+
+    def test_concurrent_load_not_inserted(self, mock_conn):
+        cursor = mock_conn.return_value.cursor.return_value
+        cursor.fetchone.side_effect = [None, (4, 1)]
+        datum = FakeData(uuid='uuid-one', content='{"a": 1}', **self.attributes)
+
+        self.assertEqual((4, 1), RDS(dedup=True).persist_data(datum))
+
+        self.assertNotIn(EXECUTE_INSERT_JSON_DATA, self.statements(cursor))
+        self.assertEqual({'hits': 1, 'misses': 0}, rds_module.DEDUP_STATS)
+
+    def test_stream_claimed_before_copy(self, mock_conn):
+        cursor = mock_conn.return_value.cursor.return_value
+        cursor.fetchone.side_effect = [None, (4, 1)]
+        datum = FakeStreamedData(['{}'], **self.attributes)
+        datum.uuid = 'uuid-one'
+
+        self.assertEqual((4, 1), RDS(dedup=True).persist_stream(datum))
+
+        cursor.copy_expert.assert_not_called()
+        self.assertNotIn(EXECUTE_INSERT_JSON_DATA_FROM_STAGE, self.statements(cursor))
+
+    @mock.patch('src.etl.rds.execute_values')
+    def test_batch_recorded(self, mock_execute_values, mock_conn):
+        cursor = mock_conn.return_value.cursor.return_value
+        cursor.fetchall.return_value = [('uuid-0',), ('uuid-1',)]
+        mock_execute_values.side_effect = [[(10, 1), (12, 1)], None]
+        data = [FakeData(uuid=f'uuid-{n}', content='{}', **self.attributes) for n in range(2)]
+
+        RDS(dedup=True).persist_batch(data)
+
+        cursor.execute.assert_any_call(CLAIM_JSON_DATA_LOADS, (['uuid-0', 'uuid-1'],))
+        _, sql, records = mock_execute_values.call_args[0]
+        self.assertEqual(INSERT_JSON_DATA_LOADS, sql)
+        self.assertEqual([('uuid-0', 'abc123', 10, 1), ('uuid-1', 'abc123', 12, 1)], records)
+        mock_conn.return_value.commit.assert_called_once()
+
+    @mock.patch('src.etl.rds.execute_values')
+    def test_batch_claimed_before_insert(self, mock_execute_values, mock_conn):
+        cursor = mock_conn.return_value.cursor.return_value
+        # uuid-1 was claimed by a concurrent load, which loaded it as (4, 1)
+        cursor.fetchall.return_value = [('uuid-0',), ('uuid-2',)]
+        cursor.__iter__ = mock.Mock(return_value=iter([('uuid-1', 4, 1)]))
+        mock_execute_values.side_effect = [[(10, 1), (12, 1)], None]
+        data = [FakeData(uuid=f'uuid-{n}', content=f'{{"n": {n}}}', **self.attributes) for n in (0, 1, 2, 0)]
+
+        outcomes = RDS(dedup=True).persist_batch(data)
+
+        self.assertEqual([(10, 1), (4, 1), (12, 1), (10, 1)], outcomes)
+        statements = self.statements(cursor)
+        self.assertLess(statements.index(CLAIM_JSON_DATA_LOADS), statements.index(SELECT_JSON_DATA_LOADS))
+        (_, _, rows), _ = mock_execute_values.call_args_list[0]
+        self.assertEqual(['{"n": 0}', '{"n": 2}'], [row[-1] for row in rows])
+        _, _, records = mock_execute_values.call_args[0]
+        self.assertEqual([('uuid-0', 'abc123', 10, 1), ('uuid-2', 'abc123', 12, 1)], records)
+        self.assertEqual({'hits': 1, 'misses': 2}, rds_module.DEDUP_STATS)
+
+    @mock.patch('src.etl.rds.execute_values')
+    def test_batch_failed_rows_released(self, mock_execute_values, mock_conn):
+        cursor = mock_conn.return_value.cursor.return_value
+        cursor.fetchall.return_value = [('uuid-0',), ('uuid-1',)]
+        bad_row = DataError('value too long')
+        mock_execute_values.side_effect = [bad_row, None]
+        cursor.fetchone.return_value = (10, 1)
+
+        def execute(sql, params=None):
+            if sql == INSERT_JSON_DATA and params[-1] == '{"n": 1}':
+                raise bad_row
+        cursor.execute.side_effect = execute
+        data = [FakeData(uuid=f'uuid-{n}', content=f'{{"n": {n}}}', **self.attributes) for n in range(2)]
+
+        outcomes = RDS(dedup=True).persist_batch(data)
+
+        self.assertEqual([(10, 1), bad_row], outcomes)
+        self.assertEqual([('uuid-0', 'abc123', 10, 1)], mock_execute_values.call_args[0][2])
+        cursor.execute.assert_any_call(RELEASE_JSON_DATA_LOADS, (['uuid-1'],))
+
+
+@mock.patch('src.etl.rds.connect')
+class RdsBufferTests(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.region = 'local-buffer'
+        s3_module._clients.pop(self.region, None)
+        self.metadata = {name: {'StringValue': value} for name, value in (
+            ('StartTime', '1580000000'), ('ResponseTime', '1580000001'), ('ResponseCode', '200'),
+            ('PID', '1234'), ('URL', 'https://some.net/api/call'), ('API', 'api'),
+            ('ScriptName', 'script'), ('Parameters', '{"a": 1}'))}
+        self.record = {'s3': {'bucket': {'name': 'bucket'}, 'object': {'key': 'capture.json'}}}
+        self.digest = hashlib.sha256()
+
+    def tearDown(self):
+        s3_module._clients.pop(self.region, None)
+        self.root.cleanup()
+
+    def put(self, content):
+        document = json.dumps({'metadata': self.metadata, 'content': content}).encode('utf-8')
+        LocalS3Client(self.root.name).put_object(Bucket='bucket', Key='capture.json', Body=document)
+        self.record['s3']['object']['size'] = len(document)
+        return document
+
+    def copy_expert(self, sql, file, size=8192):
+        while True:
+            data = file.read(size)
+            if not data:
+                break
+            self.digest.update(data)
+
+    def persist(self, mock_conn):
+        cursor = mock_conn.return_value.cursor.return_value
+        cursor.copy_expert.side_effect = self.copy_expert
+        cursor.fetchone.return_value = (1, 2)
+        with mock.patch.dict(CONFIG['aws'], {'s3-local-root': self.root.name}), \
+                mock.patch.dict(CONFIG['load'], {'stream_chunk_size': 32768}):
+            rds = RDS()
+            datum = BufferedCapturedData(self.record, self.region)
+            return rds.persist_buffer(datum), datum
+
+    def test_persist_buffer(self, mock_conn):
+        content = json.dumps({'Points': [{'v': i, 's': 'é "quoted" \\ 😀'} for i in range(100000)]})
+        document = self.put(content)
+
+        tracemalloc.start()
+        try:
+            record_id, datum = self.persist(mock_conn)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual((1, 2), record_id)
+        start, end = datum.content_span
+        self.assertEqual(content, json.loads(document[start:end]))
+        self.assertEqual(hashlib.sha256(document[start:end] + b'\n').hexdigest(), self.digest.hexdigest())
+        cursor = mock_conn.return_value.cursor.return_value
+        self.assertEqual(COPY_CSV_STAGE, cursor.copy_expert.call_args[0][0])
+        sql, params = cursor.execute.call_args[0]
+        self.assertEqual(EXECUTE_INSERT_JSON_DATA_FROM_LITERAL_STAGE, sql)
+        self.assertEqual('api', params[4])
+        mock_conn.return_value.commit.assert_called_once()
+        # the object buffer and a few pieces of it, never a decoded copy of the content
+        self.assertLess(peak, 1.25 * len(document))
+
+    def test_persist_buffer_invalid_content(self, mock_conn):
+        self.put('{"a": not json}')
+        with self.assertRaises(ValidationException):
+            self.persist(mock_conn)
+        mock_conn.return_value.cursor.return_value.copy_expert.assert_not_called()
+
+
+class FakeClock:
+    """ stands in for the time module, sleeping only moves the clock on """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeServer:
+    """
+    hands out fake connections, failing the attempts to connect for which a fault is queued,
+    and keeps the session advisory locks of the connections it handed out
+    """
+
+    def __init__(self):
+        self.faults = []
+        self.down = False
+        self.attempts = []
+        self.locks = {}
+
+    def connect(self, **parameters):
+        self.attempts.append(parameters)
+        if self.faults:
+            raise self.faults.pop(0)
+        if self.down:
+            raise OperationalError('connection to server failed: timeout expired')
+        return FakeConnection(self)
+
+
+class FakeConnection:
+
+    def __init__(self, server):
+        self.server = server
+        self.closed = 0
+        self.autocommit = True
+        self.execute_faults = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        # the server lets go of the advisory locks of a session when it ends
+        self.closed = 1
+        for key in [key for key, owner in self.server.locks.items() if owner is self]:
+            del self.server.locks[key]
+
+
+class FakeCursor:
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.row = None
+
+    def execute(self, sql, params=()):
+        if self.conn.execute_faults:
+            raise self.conn.execute_faults.pop(0)
+        locks = self.conn.server.locks
+        if sql == TRY_ADMISSION_LOCK:
+            taken = locks.setdefault(params, self.conn) is self.conn
+            self.row = (taken,)
+        elif sql == RELEASE_ADMISSION_LOCK:
+            self.row = (locks.pop(params, None) is self.conn,)
+        else:
+            self.row = (1, 2)
+
+    def fetchone(self):
+        return self.row
+
+
+class ConnectionAdmissionTests(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.config = {'timeout': 10, 'budget': 30, 'retry_base_delay': 0.25, 'retry_max_delay': 4,
+                       'breaker_failures': 5, 'breaker_cooldown': 30, 'max_active': 0, 'admission_timeout': 20}
+        self.server = FakeServer()
+        for patcher in [mock.patch.dict(CONFIG['connect'], self.config),
+                        mock.patch.object(rds_module, 'time', self.clock),
+                        mock.patch.object(rds_module, 'connect', self.server.connect),
+                        mock.patch.object(rds_module, 'BREAKER', rds_module.CircuitBreaker()),
+                        mock.patch.dict(rds_module.CONNECTION_STATS, dict.fromkeys(rds_module.CONNECTION_STATS, 0)),
+                        mock.patch.dict(rds_module.ADMISSION_STATS, dict.fromkeys(rds_module.ADMISSION_STATS, 0))]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_connects_with_bounded_timeout(self):
+        RDS()
+        self.assertEqual(10, self.server.attempts[0]['connect_timeout'])
+        self.assertEqual(1, rds_module.CONNECTION_STATS['connects'])
+
+    def test_transient_failures_retried(self):
+        self.server.faults = [OperationalError('timeout expired'),
+                              OperationalError('FATAL: sorry, too many clients already')]
+        rds = RDS()
+        self.assertFalse(rds.conn.closed)
+        self.assertEqual(3, len(self.server.attempts))
+        self.assertEqual(2, rds_module.CONNECTION_STATS['retries'])
+        # the delays are jittered below a ceiling that doubles with each attempt
+        self.assertLessEqual(self.clock.now - 1000.0, 0.25 + 0.5)
+        self.assertEqual(0, rds_module.BREAKER.failures)
+
+    def test_permanent_failure_not_retried(self):
+        self.server.faults = [OperationalError('FATAL: password authentication failed for user "postgres"')]
+        with self.assertRaises(DatabaseUnavailable):
+            RDS()
+        self.assertEqual(1, len(self.server.attempts))
+        self.assertEqual(1, rds_module.CONNECTION_STATS['failures'])
+
+    def test_gives_up_within_budget(self):
+        # every attempt times out
+        self.server.connect = mock.Mock(side_effect=self.time_out)
+        with mock.patch.object(rds_module, 'connect', self.server.connect), \
+                mock.patch.dict(CONFIG['connect'], {'breaker_failures': 100}):
+            with self.assertRaises(DatabaseUnavailable) as raised:
+                RDS()
+        self.assertNotIsInstance(raised.exception, CircuitOpen)
+        self.assertIsInstance(raised.exception.__cause__, OperationalError)
+        self.assertLessEqual(self.clock.now - 1000.0, 30)
+        timeouts = [call.kwargs['connect_timeout'] for call in self.server.connect.call_args_list]
+        self.assertEqual(10, timeouts[0])
+        # the last attempts only wait for what is left of the budget
+        self.assertLess(timeouts[-1], 10)
+
+    def time_out(self, **parameters):
+        self.clock.sleep(parameters['connect_timeout'])
+        raise OperationalError('timeout expired')
+
+    def test_breaker_fails_fast(self):
+        self.server.down = True
+        with mock.patch.dict(CONFIG['connect'], {'breaker_failures': 3}):
+            with self.assertRaises(DatabaseUnavailable):
+                RDS()
+            # gave up as soon as the breaker opened
+            self.assertEqual(3, len(self.server.attempts))
+            with self.assertRaises(CircuitOpen):
+                RDS()
+            self.assertEqual(3, len(self.server.attempts))
+            self.assertEqual(1, rds_module.CONNECTION_STATS['rejected'])
+
+            # one attempt is let through after the cooldown, and opens the breaker again when it fails
+            self.clock.sleep(30)
+            with self.assertRaises(DatabaseUnavailable):
+                RDS()
+            self.assertEqual(4, len(self.server.attempts))
+            with self.assertRaises(CircuitOpen):
+                RDS()
+
+            # and closes it when it connects
+            self.clock.sleep(30)
+            self.server.down = False
+            RDS()
+            self.assertEqual(0, rds_module.BREAKER.failures)
+            RDS()
+            self.assertEqual(6, len(self.server.attempts))
+
+    def test_shared_rds_reconnect_through_breaker(self):
+        try:
+            rds = shared_rds()
+            rds.conn.closed = 2
+            self.server.down = True
+            with mock.patch.dict(CONFIG['connect'], {'breaker_failures': 1}):
+                with self.assertRaises(DatabaseUnavailable):
+                    shared_rds()
+                with self.assertRaises(CircuitOpen):
+                    shared_rds()
+        finally:
+            discard_shared_rds()
+
+    def test_execute_error_raised(self):
+        rds = RDS()
+        rds.conn.execute_faults = [OperationalError('server closed the connection unexpectedly')]
+        rds.conn.rollback = mock.Mock()
+        with self.assertRaises(OperationalError):
+            rds._execute_sql(EXECUTE_INSERT_JSON_DATA, ('value',))
+        rds.conn.rollback.assert_called_once()
+
+    def test_admission_uncapped(self):
+        rds = RDS()
+        with rds.admitted():
+            self.assertEqual({}, self.server.locks)
+        self.assertEqual(0, rds_module.ADMISSION_STATS['admitted'])
+
+    def test_admission_capped(self):
+        CONFIG['connect']['max_active'] = 2
+        loaders = [RDS() for _ in range(3)]
+        with loaders[0].admitted(), loaders[1].admitted():
+            self.assertEqual(2, len(self.server.locks))
+            with self.assertRaises(AdmissionTimeout):
+                with loaders[2].admitted():
+                    pass
+            self.assertLessEqual(self.clock.now - 1000.0, 20)
+        self.assertEqual({}, self.server.locks)
+        with loaders[2].admitted():
+            self.assertEqual({loaders[2].conn}, set(self.server.locks.values()))
+        self.assertEqual({'admitted': 3, 'waited': 0, 'timeouts': 1}, rds_module.ADMISSION_STATS)
+
+    def test_admission_waits_for_slot(self):
+        CONFIG['connect']['max_active'] = 1
+        holder, waiter = RDS(), RDS()
+        holder_slot = holder.admitted()
+        holder_slot.__enter__()
+
+        def release(seconds):
+            self.clock.now += seconds
+            holder_slot.__exit__(None, None, None)
+
+        with mock.patch.object(self.clock, 'sleep', side_effect=release):
+            with waiter.admitted():
+                self.assertEqual({waiter.conn}, set(self.server.locks.values()))
+        self.assertEqual({'admitted': 2, 'waited': 1, 'timeouts': 0}, rds_module.ADMISSION_STATS)
+
+    def test_lost_connection_frees_slot(self):
+        CONFIG['connect']['max_active'] = 1
+        lost, other = RDS(), RDS()
+        with lost.admitted():
+            lost.conn.close()
+        self.assertEqual({}, self.server.locks)
+        with other.admitted():
+            self.assertEqual(1, len(self.server.locks))
+
+
+class FakePartitionedCursor:
+    """ a cursor over a capture.json_data partitioned by month of start_time, copies into stale partitions fail """
+
+    def __init__(self, partitions, key=('r', 1, 'start_time', 'timestamp without time zone', 'json_data_id_seq')):
+        self.key = key
+        self.partitions = partitions
+        self.sequence = 'json_data_id_seq'
+        self.stale = set()
+        self.next_id = 100
+        self.copied = {}
+        self.copies = []
+        self.statements = []
+        self.rows = []
+
+    def execute(self, sql, params=None):
+        self.statements.append(sql)
+        if sql == SELECT_PARTITION_KEY:
+            self.rows = [self.key]
+        elif sql == SELECT_PARTITIONS:
+            self.rows = [(name, bound) for name, bound, _ in self.partitions]
+        elif sql == SELECT_JSON_DATA_SEQUENCE:
+            self.rows = [(self.sequence,)]
+        elif sql == SELECT_JSON_DATA_IDS:
+            self.rows = [(self.next_id + i,) for i in range(params[1])]
+            self.next_id += params[1]
+        elif sql.startswith('SELECT json_data_id, partition_number FROM'):
+            name = sql.split()[4]
+            number = next((number for partition, _, number in self.partitions if partition == name), 1)
+            self.rows = [(json_data_id, number) for json_data_id in params[0]]
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def fetchall(self):
+        return self.rows
+
+    def copy_expert(self, sql, file):
+        self.copies.append(sql)
+        name = sql.split()[1]
+        if name in self.stale:
+            raise errors.CheckViolation('new row for relation violates partition constraint')
+        lines = []
+        while True:
+            line = file.read(8192)
+            if not line:
+                break
+            lines.append(line)
+        self.copied[name] = lines
+
+
+@mock.patch('src.etl.rds.execute_values')
+@mock.patch('src.etl.rds.connect')
+class RdsPartitionRoutingTests(TestCase):
+
+    def setUp(self):
+        self.cursor = FakePartitionedCursor([
+            ('capture.json_data_2020_01', "FOR VALUES FROM ('2020-01-01 00:00:00') TO ('2020-02-01 00:00:00')", 1),
+            ('capture.json_data_2020_02', "FOR VALUES FROM ('2020-02-01 00:00:00') TO ('2020-03-01 00:00:00')", 2),
+        ])
+        attributes = {
+            'response_time': '1580000001', 'response_code': '200', 'script_pid': '1234',
+            'url': 'https://some.net/api/call', 'api': 'api', 'script_name': 'script', 'parameters': '{"a": 1}'
+        }
+        # January, February, January and March of 2020
+        self.data = [FakeData(content=f'{{"n": {n}}}', start_time=start_time, **attributes)
+                     for n, start_time in enumerate(['1580000000', '1581000000', '1580100000', '1583500000'])]
+
+    def rds(self, mock_conn):
+        mock_conn.return_value.cursor.return_value = self.cursor
+        return RDS(dedup=False, partition_routing=True)
+
+    def test_batch_copied_by_partition(self, mock_conn, mock_execute_values):
+        outcomes = self.rds(mock_conn).persist_batch(self.data[:3])
+        self.assertEqual([(100, 1), (102, 2), (101, 1)], outcomes)
+        self.assertEqual(['{"n": 0}', '{"n": 2}'],
+                         [line.split('\t')[-1].strip() for line in self.cursor.copied['capture.json_data_2020_01']])
+        self.assertEqual(1, len(self.cursor.copied['capture.json_data_2020_02']))
+        self.assertEqual([COPY_JSON_DATA_ROWS.format(table='capture.json_data_2020_01'),
+                          COPY_JSON_DATA_ROWS.format(table='capture.json_data_2020_02')],
+                         self.cursor.copies)
+        mock_execute_values.assert_not_called()
+        self.assertIn('RELEASE SAVEPOINT json_data_partitions', self.cursor.statements)
+        mock_conn.return_value.commit.assert_called_once()
+
+    def test_unmapped_rows_through_table(self, mock_conn, mock_execute_values):
+        mock_execute_values.return_value = [(500, 3)]
+        rds = self.rds(mock_conn)
+        outcomes = rds.persist_batch(self.data)
+        self.assertEqual([(100, 1), (102, 2), (101, 1), (500, 3)], outcomes)
+        # the map had just been read
+        self.assertEqual(1, self.cursor.statements.count(SELECT_PARTITIONS))
+        rds.persist_batch(self.data)
+        # read again in case the partition of March has been added since
+        self.assertEqual(2, self.cursor.statements.count(SELECT_PARTITIONS))
+        _, sql, rows = mock_execute_values.call_args[0]
+        self.assertEqual(INSERT_JSON_DATA_VALUES, sql)
+        self.assertEqual(['{"n": 3}'], [row[-1] for row in rows])
+
+    def test_stale_map_falls_back_to_table(self, mock_conn, mock_execute_values):
+        mock_execute_values.return_value = [(7, 1), (8, 2), (9, 1)]
+        rds = self.rds(mock_conn)
+        self.cursor.stale.add('capture.json_data_2020_02')
+        self.assertEqual([(7, 1), (8, 2), (9, 1)], rds.persist_batch(self.data[:3]))
+        self.assertIn('ROLLBACK TO SAVEPOINT json_data_partitions', self.cursor.statements)
+        _, sql, rows = mock_execute_values.call_args[0]
+        self.assertEqual(3, len(rows))
+        mock_conn.return_value.commit.assert_called_once()
+
+        # the map is read again before the next batch
+        self.cursor.stale.clear()
+        mock_execute_values.reset_mock()
+        rds.persist_batch(self.data[:3])
+        self.assertEqual(2, self.cursor.statements.count(SELECT_PARTITIONS))
+        mock_execute_values.assert_not_called()
+
+    def test_unpartitioned_table(self, mock_conn, mock_execute_values):
+        self.cursor.key = None
+        mock_execute_values.return_value = [(1, 1), (2, 1), (3, 1)]
+        self.assertEqual([(1, 1), (2, 1), (3, 1)], self.rds(mock_conn).persist_batch(self.data[:3]))
+        self.assertEqual({}, self.cursor.copied)
+
+
+@mock.patch('src.etl.rds.execute_values')
+@mock.patch('src.etl.rds.connect')
+class RdsCopyTests(TestCase):
+
+    def setUp(self):
+        self.cursor = FakePartitionedCursor([
+            ('capture.json_data_2020_01', "FOR VALUES FROM ('2020-01-01 00:00:00') TO ('2020-02-01 00:00:00')", 1),
+            ('capture.json_data_2020_02', "FOR VALUES FROM ('2020-02-01 00:00:00') TO ('2020-03-01 00:00:00')", 2),
+        ])
+        attributes = {
+            'response_time': '1580000001', 'response_code': '200', 'script_pid': '1234',
+            'url': 'https://some.net/api/call', 'api': 'api', 'script_name': 'script', 'parameters': '{"a": 1}'
+        }
+        self.data = [FakeData(content=f'{{"n": {n}}}', start_time=start_time, **attributes)
+                     for n, start_time in enumerate(['1580000000', '1581000000', '1580100000'])]
+
+    def rds(self, mock_conn, partition_routing=False):
+        mock_conn.return_value.cursor.return_value = self.cursor
+        rds = RDS(dedup=False, partition_routing=partition_routing)
+        return rds, [rds.batch_row(datum) for datum in self.data]
+
+    def test_copied_together(self, mock_conn, mock_execute_values):
+        rds, rows = self.rds(mock_conn)
+        self.assertEqual([(100, 1), (101, 1), (102, 1)], rds.copy_rows(rows))
+        self.assertEqual([COPY_JSON_DATA_ROWS.format(table='capture.json_data')], self.cursor.copies)
+        self.assertEqual(['100', '101', '102'],
+                         [line.split('\t')[0] for line in self.cursor.copied['capture.json_data']])
+        mock_execute_values.assert_not_called()
+        mock_conn.return_value.commit.assert_called_once()
+        self.assertTrue(mock_conn.return_value.autocommit)
+        # the sequence is looked up once
+        rds.copy_rows(rows)
+        self.assertEqual(1, self.cursor.statements.count(SELECT_JSON_DATA_SEQUENCE))
+
+    def test_copied_into_partitions(self, mock_conn, mock_execute_values):
+        rds, rows = self.rds(mock_conn, partition_routing=True)
+        self.assertEqual([(100, 1), (102, 2), (101, 1)], rds.copy_rows(rows))
+        self.assertEqual({'capture.json_data_2020_01', 'capture.json_data_2020_02'}, set(self.cursor.copied))
+        self.assertNotIn(SELECT_JSON_DATA_SEQUENCE, self.cursor.statements)
+
+    def test_bad_row_inserted_instead(self, mock_conn, mock_execute_values):
+        rds, rows = self.rds(mock_conn)
+        mock_execute_values.return_value = [(7, 1), (8, 1), (9, 1)]
+        with mock.patch.object(self.cursor, 'copy_expert', side_effect=DataError('invalid input syntax')):
+            self.assertEqual([(7, 1), (8, 1), (9, 1)], rds.copy_rows(rows))
+        mock_conn.return_value.rollback.assert_called_once()
+        mock_conn.return_value.commit.assert_called_once()
+
+    def test_no_sequence(self, mock_conn, mock_execute_values):
+        self.cursor.sequence = None
+        rds, rows = self.rds(mock_conn)
+        mock_execute_values.return_value = [(7, 1), (8, 1), (9, 1)]
+        self.assertEqual([(7, 1), (8, 1), (9, 1)], rds.copy_rows(rows))
+        self.assertEqual([], self.cursor.copies)
+
+
+@mock.patch('src.etl.rds.connect')
+class RdsLookupTests(TestCase):
+
+    def setUp(self):
+        self.attributes = {
+            'start_time': '1580000000', 'response_time': '1580000001', 'response_code': '200',
+            'script_pid': '1234', 'url': 'https://some.net/api/call', 'api': 'api',
+            'script_name': 'script', 'parameters': '{"a": 1}'
+        }
+        self.cache = mock.patch('src.etl.rds.LOOKUP_CACHE', LookupCache(10))
+        self.cache.start()
+        self.lookups = []
+
+    def tearDown(self):
+        self.cache.stop()
+
+    def cursor(self, mock_conn):
+        cursor = mock_conn.return_value.cursor.return_value
+        cursor.fetchone.return_value = (1, 2)
+
+        def execute(sql, params=None):
+            if sql == SELECT_JSON_DATA_LOOKUPS:
+                self.lookups.append(list(zip(*params)))
+                cursor.fetchall.return_value = [(10 + i, attribute, value, True)
+                                                for i, (attribute, value) in enumerate(zip(*params))]
+        cursor.execute.side_effect = execute
+        return cursor
+
+    def statements(self, cursor):
+        return [call[0][0] for call in cursor.execute.call_args_list]
+
+    def test_stored_by_id(self, mock_conn):
+        cursor = self.cursor(mock_conn)
+        datum = FakeData(content='{"n": 1}', **self.attributes)
+        rds = RDS(dedup=False, attribute_lookups=True)
+        self.assertEqual((1, 2), rds.persist_data(datum))
+        self.assertEqual([[('url', 'https://some.net/api/call'), ('api', 'api'), ('script_name', 'script'),
+                           ('parameters', '{"a": 1}')]], self.lookups)
+        statements = self.statements(cursor)
+        self.assertFalse([sql for sql in statements if 'CREATE' in sql])
+        self.assertIn(rds_module.PREPARED['insert_json_data_with_lookups'], statements)
+        self.assertNotIn(PREPARE_INSERT_JSON_DATA, statements)
+        sql, params = cursor.execute.call_args[0]
+        self.assertEqual('EXECUTE insert_json_data_with_lookups (%s, %s, %s, %s, %s, %s, %s, %s, %s);', sql)
+        self.assertEqual((10, 11, 12, 1234, 13, '{"n": 1}'), params[3:])
+
+        # the values were added outside of a transaction, so their ids are cached
+        rds.persist_data(FakeData(content='{"n": 2}', **self.attributes))
+        self.assertEqual(1, len(self.lookups))
+        self.assertEqual((10, 11, 12, 1234, 13, '{"n": 2}'), cursor.execute.call_args[0][1][3:])
+
+    def test_missing_script_name(self, mock_conn):
+        cursor = self.cursor(mock_conn)
+        self.attributes['script_name'] = None
+        RDS(dedup=False, attribute_lookups=True).persist_data(FakeData(content='{}', **self.attributes))
+        self.assertNotIn('script_name', [attribute for attribute, _ in self.lookups[0]])
+        self.assertIsNone(cursor.execute.call_args[0][1][5])
+
+    def test_missing_migration(self, mock_conn):
+        cursor = mock_conn.return_value.cursor.return_value
+        datum = FakeData(content='{}', **self.attributes)
+        cursor.execute.side_effect = errors.UndefinedTable('relation "capture.json_data_lookup" does not exist')
+        with self.assertRaisesRegex(RuntimeError, 'migrations/003_json_data_lookup.sql'):
+            RDS(dedup=False, attribute_lookups=True).persist_data(datum)
+        self.cursor(mock_conn)
+        execute = cursor.execute.side_effect
+
+        def undefined_column(sql, params=None):
+            if sql.startswith('\n    PREPARE'):
+                raise errors.UndefinedColumn('column "url_id" of relation "json_data" does not exist')
+            execute(sql, params)
+        cursor.execute.side_effect = undefined_column
+        with self.assertRaisesRegex(RuntimeError, 'migrations/003_json_data_lookup.sql'):
+            RDS(dedup=False, attribute_lookups=True).persist_data(datum)
+
+    def test_stream_not_cached_until_committed(self, mock_conn):
+        cursor = self.cursor(mock_conn)
+        cursor.copy_expert.side_effect = lambda sql, file: list(iter(lambda: file.read(8192), ''))
+        rds = RDS(dedup=False, attribute_lookups=True)
+        for _ in range(2):
+            rds.persist_stream(FakeStreamedData(['{}'], **self.attributes))
+        # looked up within the loading transaction, the ids of values added then are not cached
+        self.assertEqual(2, len(self.lookups))
+        self.assertEqual('EXECUTE insert_json_data_from_stage_with_lookups (%s, %s, %s, %s, %s, %s, %s, %s);',
+                         cursor.execute.call_args[0][0])
+
+    def test_statements_taking_ids(self, _):
+        prepare = rds_module.PREPARED['insert_json_data_with_lookups']
+        self.assertIn('PREPARE insert_json_data_with_lookups '
+                      '(timestamp, timestamp, integer, integer, integer, integer, integer, integer, text) AS', prepare)
+        self.assertRegex(prepare, r'url_id, api_id,\s+script_name_id, script_pid,\s+parameters_id, json_content\)')
+        for name, prepare in rds_module.PREPARED.items():
+            if name.endswith('_with_lookups'):
+                self.assertNotRegex(prepare, r'\b(url|api|script_name|parameters),|\$8::jsonb', msg=name)
+        # an insert the rewrites no longer match is not prepared with the wrong columns
+        with self.assertRaises(ValueError):
+            rds_module._with_lookups('insert_json_data', PREPARE_INSERT_JSON_DATA.replace('url, api,', 'api, url,'))
+
+    def test_parameters_checked_here(self, mock_conn):
+        cursor = self.cursor(mock_conn)
+        rds = RDS(dedup=False, json_validator='jsonb', attribute_lookups=True)
+        rds.persist_data(FakeData(content='{}', **self.attributes))
+        self.assertIn('insert_checked_json_data_with_lookups', cursor.execute.call_args[0][0])
+        self.assertNotIn('$8::jsonb', rds_module.PREPARED['insert_checked_json_data_with_lookups'])
+        self.attributes['parameters'] = 'not json'
+        with self.assertRaises(ValidationException):
+            rds.persist_data(FakeData(content='{}', **self.attributes))
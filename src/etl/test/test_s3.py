@@ -0,0 +1,191 @@
+import gzip
+import hashlib
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from botocore.exceptions import EndpointConnectionError
+
+import src.etl.s3 as s3_module
+from src.etl import compression
+from src.etl.compression import DecompressionError
+from src.etl.local_s3 import LocalS3Client
+from src.etl.s3 import S3
+
+
+@mock.patch('src.etl.s3.new_client')
+class TestS3Client(TestCase):
+
+    def setUp(self):
+        s3_module._clients.clear()
+        self.stats = mock.patch.dict('src.etl.s3.CLIENT_STATS', {'created': 0, 'reused': 0})
+        self.stats.start()
+
+    def tearDown(self):
+        self.stats.stop()
+        s3_module._clients.clear()
+
+    def test_client_reused(self, mock_client):
+        first = S3('us-south-1')
+        second = S3('us-south-1')
+        self.assertIs(first.s3, second.s3)
+        mock_client.assert_called_once()
+        self.assertEqual(('s3',), mock_client.call_args[0])
+        self.assertEqual('us-south-1', mock_client.call_args[1]['region_name'])
+        self.assertEqual({'created': 1, 'reused': 1}, s3_module.CLIENT_STATS)
+
+    def test_client_per_region(self, mock_client):
+        S3('us-south-1')
+        S3('us-north-1')
+        self.assertEqual(2, mock_client.call_count)
+
+    def test_client_discarded_after_failure(self, mock_client):
+        broken, fresh = mock.Mock(), mock.Mock()
+        broken.get_object.side_effect = EndpointConnectionError(endpoint_url='https://s3')
+        mock_client.side_effect = [broken, fresh]
+        with self.assertRaises(EndpointConnectionError):
+            S3('us-south-1').get_file('bucket', 'key')
+        self.assertIs(fresh, S3('us-south-1').s3)
+        self.assertEqual({'created': 2, 'reused': 0}, s3_module.CLIENT_STATS)
+
+
+class TestRangedDownload(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.client = LocalS3Client(self.root.name)
+        # leading with a byte no compressed object starts with
+        self.data = b'{' + os.urandom(100002)
+        self.client.put_object(Bucket='bucket', Key='capture.json', Body=self.data)
+        self.s3 = S3.__new__(S3)
+        self.s3.region = 'us-south-1'
+        self.s3.s3 = mock.Mock(wraps=self.client)
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def test_assembled_bytes_match(self):
+        for part_size, concurrency in ((1000, 4), (97, 16), (100003, 2), (200000, 1), (33334, 3)):
+            buffer = self.s3.get_ranges('bucket', 'capture.json', len(self.data), part_size, concurrency)
+            self.assertEqual(self.data, bytes(buffer), msg=f'parts of {part_size} with {concurrency} workers')
+
+    def test_part_count(self):
+        self.s3.get_ranges('bucket', 'capture.json', len(self.data), 10000, 4)
+        ranges = sorted(call[1]['Range'] for call in self.s3.s3.get_object.call_args_list)
+        self.assertEqual(11, len(ranges))
+        self.assertIn('bytes=100000-100002', ranges)
+
+    def test_size_mismatch(self):
+        with self.assertRaises(IOError):
+            self.s3.get_ranges('bucket', 'capture.json', len(self.data) - 1, 10000, 4)
+
+    def test_spill(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            with mock.patch.dict(s3_module.CONFIG['load'], {'spill_dir': spill_dir, 'download_part_size': 10000}):
+                spill = self.s3.spill('bucket', 'capture.json', len(self.data))
+            with spill:
+                self.assertEqual(self.data, spill.buffer[:])
+                self.assertEqual([os.path.basename(spill.path)], os.listdir(spill_dir))
+            self.assertEqual([], os.listdir(spill_dir))
+            self.assertTrue(spill.buffer.closed)
+
+    def test_digest(self):
+        expected = hashlib.sha256(self.data).hexdigest()
+        with mock.patch.dict(s3_module.CONFIG['load'], {'download_part_size': 10000}):
+            for read in (lambda digest: self.s3.get_bytes('bucket', 'capture.json', len(self.data), digest),
+                         lambda digest: list(self.s3.iter_file('bucket', 'capture.json', 999, digest)),
+                         lambda digest: self.s3.spill('bucket', 'capture.json', len(self.data), digest).close()):
+                digest = hashlib.sha256()
+                read(digest)
+                self.assertEqual(expected, digest.hexdigest())
+
+    def test_spill_removed_on_failure(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            with mock.patch.dict(s3_module.CONFIG['load'], {'spill_dir': spill_dir, 'download_part_size': 10000}):
+                with self.assertRaises(IOError):
+                    self.s3.spill('bucket', 'capture.json', len(self.data) + 1)
+            self.assertEqual([], os.listdir(spill_dir))
+
+    def test_get_file_threshold(self):
+        text = 'é' * 50000
+        self.client.put_object(Bucket='bucket', Key='text.json', Body=text)
+        size = len(text.encode('utf-8'))
+        load = {'ranged_download_threshold': size, 'download_part_size': 999, 'download_concurrency': 4}
+        with mock.patch.dict('src.etl.s3.CONFIG', {'load': load}):
+            self.assertEqual(text, self.s3.get_file('bucket', 'text.json', size))
+            self.assertEqual(101, self.s3.s3.get_object.call_count)
+            for below_threshold in ((), (size - 1,)):
+                self.s3.s3.get_object.reset_mock()
+                self.assertEqual(text, self.s3.get_file('bucket', 'text.json', *below_threshold))
+                self.s3.s3.get_object.assert_called_once_with(Bucket='bucket', Key='text.json')
+
+
+class TestCompressedObjects(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.spill_dir = tempfile.TemporaryDirectory()
+        self.client = LocalS3Client(self.root.name)
+        self.data = b''.join(b'{"n": %d, "s": "\xc3\xa9"}\n' % i for i in range(20000))
+        self.s3 = S3.__new__(S3)
+        self.s3.region = 'us-south-1'
+        self.s3.s3 = mock.Mock(wraps=self.client)
+        self.config = mock.patch.dict(s3_module.CONFIG['load'], {
+            'spill_dir': self.spill_dir.name, 'download_part_size': 10000, 'ranged_download_threshold': 50000,
+            'max_decompression_ratio': 100})
+        self.config.start()
+
+    def tearDown(self):
+        self.config.stop()
+        self.root.cleanup()
+        self.spill_dir.cleanup()
+
+    def encodings(self):
+        """ the key and stored bytes of the data in each encoding available """
+        stored = [('capture.json.gz', gzip.compress(self.data)), ('capture.json', gzip.compress(self.data))]
+        if compression.zstandard is not None:
+            stored.append(('capture.json.zst', compression.zstandard.ZstdCompressor().compress(self.data)))
+        for key, body in stored:
+            self.client.put_object(Bucket='bucket', Key=key, Body=body)
+            yield key, body
+
+    def test_read_decompressed(self):
+        for key, body in self.encodings():
+            for size in (None, len(body)):
+                digest = hashlib.sha256()
+                self.assertEqual(self.data, self.s3.get_bytes('bucket', key, size, digest), msg=key)
+                self.assertEqual(hashlib.sha256(body).hexdigest(), digest.hexdigest())
+            digest = hashlib.sha256()
+            chunks = list(self.s3.iter_file('bucket', key, 1000, digest))
+            self.assertEqual(self.data, b''.join(chunks), msg=key)
+            self.assertLessEqual(max(len(chunk) for chunk in chunks), 1000)
+            self.assertEqual(hashlib.sha256(body).hexdigest(), digest.hexdigest())
+            with self.s3.spill('bucket', key, len(body)) as spill:
+                self.assertEqual(self.data, spill.buffer[:], msg=key)
+                self.assertEqual(1, len(os.listdir(self.spill_dir.name)))
+            self.assertEqual([], os.listdir(self.spill_dir.name))
+
+    def test_decompressed_size(self):
+        for key, body in self.encodings():
+            self.assertIn(self.s3.decompressed_size('bucket', key, len(body), compression.object_encoding(key)),
+                          (len(self.data), None))
+
+    def test_ratio_guard(self):
+        for key, body in self.encodings():
+            with mock.patch.dict(s3_module.CONFIG['load'], {'max_decompression_ratio': 2}):
+                with self.assertRaises(DecompressionError):
+                    self.s3.get_bytes('bucket', key, len(body))
+                with self.assertRaises(DecompressionError):
+                    list(self.s3.iter_file('bucket', key))
+                with self.assertRaises(DecompressionError):
+                    self.s3.spill('bucket', key, len(body))
+            self.assertEqual([], os.listdir(self.spill_dir.name))
+
+    def test_corrupt(self):
+        body = gzip.compress(self.data)[:-100]
+        self.client.put_object(Bucket='bucket', Key='capture.json.gz', Body=body)
+        with self.assertRaises(DecompressionError):
+            self.s3.get_bytes('bucket', 'capture.json.gz', len(body))
+        with self.assertRaises(DecompressionError):
+            self.s3.spill('bucket', 'capture.json.gz', len(body))
+        self.assertEqual([], os.listdir(self.spill_dir.name))
@@ -0,0 +1,142 @@
+import datetime
+import json
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from psycopg2.errors import UndefinedTable
+
+import src.etl.s3 as s3_module
+from src.etl.config import CONFIG
+from src.etl.spool import DELETE_JSON_DATA_FAILURES, INSERT_JSON_DATA_FAILURE, FileSpool, S3Spool, TableSpool, \
+    failure_entry, open_spool
+
+
+def s3_record(key):
+    return {'s3': {'bucket': {'name': 'bucket'}, 'object': {'key': key, 'size': 10}}}
+
+
+def wrapped_error():
+    try:
+        try:
+            raise ValueError('bad content')
+        except ValueError as e:
+            raise RuntimeError(repr(e)) from e
+    except RuntimeError as e:
+        return e
+
+
+class TestFailureEntry(TestCase):
+
+    def test_cause_recorded(self):
+        entry = failure_entry(s3_record('a.json'), wrapped_error(), 'validate')
+        self.assertEqual('ValueError', entry['error'])
+        self.assertEqual("ValueError('bad content')", entry['message'])
+        self.assertEqual('validate', entry['stage'])
+        self.assertEqual(s3_record('a.json'), entry['record'])
+        datetime.datetime.fromisoformat(entry['failed_at'])
+
+    def test_defaults(self):
+        entry = failure_entry(s3_record('a.json'), KeyError('x' * 2000))
+        self.assertEqual('load', entry['stage'])
+        self.assertEqual(1000, len(entry['message']))
+
+
+class TestFileSpool(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.spool = FileSpool(os.path.join(self.directory.name, 'failures.jsonl'))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_put_and_remove(self):
+        self.assertEqual([], list(self.spool.entries()))
+        for key in ('a.json', 'b.json', 'c.json'):
+            self.spool.put(s3_record(key), wrapped_error(), 'fetch')
+        entries = list(self.spool.entries())
+        self.assertEqual(['a.json', 'b.json', 'c.json'], [entry.record['s3']['object']['key'] for entry in entries])
+        self.assertEqual({('ValueError', 'fetch')}, {(entry.error, entry.stage) for entry in entries})
+        self.spool.remove([entries[0].handle, entries[2].handle])
+        self.assertEqual([entries[1]], list(self.spool.entries()))
+        self.spool.remove([])
+        self.assertEqual([entries[1]], list(self.spool.entries()))
+
+    def test_removed_while_read(self):
+        for key in ('a.json', 'b.json'):
+            self.spool.put(s3_record(key), wrapped_error())
+        entries = self.spool.entries()
+        first = next(entries)
+        self.spool.remove([first.handle])
+        self.assertEqual('b.json', next(entries).record['s3']['object']['key'])
+
+
+class TestS3Spool(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        s3_module._clients.clear()
+        self.config = mock.patch.dict(CONFIG['aws'], {'s3-local-root': self.root.name})
+        self.config.start()
+
+    def tearDown(self):
+        self.config.stop()
+        s3_module._clients.clear()
+        self.root.cleanup()
+
+    def test_put_and_remove(self):
+        spool = open_spool('s3://spool-bucket/failed/')
+        self.assertIsInstance(spool, S3Spool)
+        for key in ('a.json', 'b.json'):
+            spool.put(s3_record(key), wrapped_error(), 'persist')
+        entries = list(spool.entries())
+        self.assertEqual(2, len(entries))
+        self.assertTrue(all(entry.handle.startswith('failed/') for entry in entries))
+        self.assertEqual({'a.json', 'b.json'}, {entry.record['s3']['object']['key'] for entry in entries})
+        spool.remove(entry.handle for entry in entries[:1])
+        self.assertEqual(entries[1:], list(spool.entries()))
+
+
+class TestTableSpool(TestCase):
+
+    def test_put_entries_and_remove(self):
+        rds = mock.MagicMock()
+        spool = TableSpool(rds)
+        spool.put(s3_record('a.json'), wrapped_error(), 'persist')
+        spool.put(s3_record('b.json'), wrapped_error(), 'persist')
+        # the table is left to its migration
+        self.assertEqual(2, rds.cursor.execute.call_count)
+        sql, params = rds.cursor.execute.call_args[0]
+        self.assertEqual(INSERT_JSON_DATA_FAILURE, sql)
+        self.assertEqual(('persist', 'ValueError'), params[1:3])
+        self.assertEqual(s3_record('b.json'), json.loads(params[-1]))
+
+        cursor = rds.conn.cursor.return_value.__enter__.return_value
+        cursor.__iter__ = mock.Mock(return_value=iter([
+            (7, json.dumps(s3_record('a.json')), 'ValueError', 'bad', 'persist', datetime.datetime(2020, 1, 1)),
+        ]))
+        entries = list(spool.entries())
+        self.assertEqual([7], [entry.handle for entry in entries])
+        self.assertEqual(s3_record('a.json'), entries[0].record)
+        spool.remove([7])
+        rds.cursor.execute.assert_called_with(DELETE_JSON_DATA_FAILURES, ([7],))
+
+    def test_missing_table(self):
+        rds = mock.MagicMock()
+        rds.cursor.execute.side_effect = UndefinedTable('relation "capture.json_data_failure" does not exist')
+        with self.assertRaisesRegex(RuntimeError, 'migrations/002_json_data_failure.sql'):
+            TableSpool(rds).put(s3_record('a.json'), wrapped_error())
+
+
+class TestOpenSpool(TestCase):
+
+    def test_configured(self):
+        with mock.patch.dict(CONFIG['load'], {'dead_letter_spool': None}):
+            self.assertIsNone(open_spool())
+        with mock.patch.dict(CONFIG['load'], {'dead_letter_spool': '/tmp/failures.jsonl'}):
+            self.assertEqual('/tmp/failures.jsonl', open_spool().path)
+        with mock.patch.dict(CONFIG['load'], {'dead_letter_spool': 'table'}):
+            self.assertIsInstance(open_spool(), TableSpool)
+        spool = open_spool('s3://bucket/prefix/')
+        self.assertEqual(('bucket', 'prefix/'), (spool.bucket, spool.prefix))
@@ -3,9 +3,17 @@ ETL loads content S3 and persist it into an RDS
 """
 import logging
 import os
+import shutil
 
-from .etl.event_processor import TriggerEvent
-from .etl.rds import RDS
+from .etl import metrics
+from .etl.compression import object_encoding
+from .etl.event_processor import BUFFER, MEMORY, PREVALIDATION_STATS, SPILL, STREAM, BatchTriggerEvent, \
+    TriggerEvent, object_uuid
+from .etl.lookups import LOOKUP_STATS
+from .etl.rds import ADMISSION_STATS, CONNECTION_STATS, DEDUP_STATS, AdmissionTimeout, DatabaseUnavailable, \
+    ValidationException, discard_shared_rds, shared_rds
+from .etl.s3 import CLIENT_STATS, decompression_limit
+from .etl.spool import TABLE, TableSpool, open_spool
 from .etl.config import CONFIG
 
 log_level = os.getenv('LOG_LEVEL', logging.ERROR)
@@ -14,23 +22,257 @@ logger = logging.getLogger(__name__)
 logger.setLevel(log_level)
 
 
-def etl(trigger_event):
+def memory_budget():
+    """ the bytes of memory a load may use, or None when the memory of the function is not known """
+    memory_size = CONFIG['load']['memory_size']
+    if memory_size is None:
+        return None
+    return int(memory_size) * 1048576 - CONFIG['load']['memory_reserve']
+
+
+def estimated_peak(strategy, size):
+    """ the memory a load of a capture of size bytes is expected to use on top of the reserve """
+    if strategy == MEMORY:
+        return int(size * CONFIG['load']['in_memory_factor'])
+    if strategy == BUFFER:
+        # the object itself and the pieces of it being decoded and validated, where the
+        # validator may build the parsed tree of a piece before finding it is cut short
+        return size + 24 * CONFIG['load']['stream_chunk_size']
+    if strategy == SPILL:
+        # the mapped object is backed by its file so only the pieces being worked on count
+        return 24 * CONFIG['load']['stream_chunk_size']
+    # a streamed load only holds a few chunks of the capture at a time
+    return 4 * CONFIG['load']['stream_chunk_size']
+
+
+def spill_space():
+    """ the free bytes where captures too large to hold in memory are downloaded to """
+    try:
+        return shutil.disk_usage(CONFIG['load']['spill_dir']).free
+    except OSError:
+        return 0
+
+
+def choose_strategy(size):
+    """
+    picks how a capture of size bytes is loaded in the memory the function is configured with:
+    parsed in memory when that fits, else held as the bytes of the object when they fit,
+    else downloaded to a temporary file when there is room for it, else streamed
+    """
+    if os.getenv('STREAMING_LOAD', 'false').lower() == 'true':
+        return STREAM
+    budget = memory_budget()
+    if budget is None:
+        # not running in Lambda, fall back on a fixed size limit
+        if size < int(os.getenv('S3_OBJECT_SIZE_LIMIT', 150000000)):
+            return MEMORY
+    else:
+        for strategy in (MEMORY, BUFFER):
+            if estimated_peak(strategy, size) <= budget:
+                return strategy
+    return SPILL if size < spill_space() else STREAM
+
+
+def memory_headroom(strategy, size):
+    """ the bytes of memory expected to be left over by the load, None when the memory is not known """
+    budget = memory_budget()
+    return None if budget is None else budget - estimated_peak(strategy, size)
+
+
+def etl(trigger_event, strategy=None):
+    """
+    loads the object of an S3 event, by the given strategy or by the one that suits its size
+    :return: the json_data_id and partition_number of the new row
+    """
+    with metrics.invocation('etl'):
+        try:
+            return _etl(trigger_event, strategy)
+        except Exception as e:
+            spool_failure(trigger_event, e)
+            raise
+
+
+def _etl(trigger_event, strategy):
+    key = trigger_event['Record']['s3']['object']['key']
+    metrics.put_property('objectKey', key)
+    size = int(trigger_event['Record']['s3']['object'].get('size', 0))
+    encoding = object_encoding(key)
+    if encoding is None and strategy is None and size and \
+            choose_strategy(size) != choose_strategy(decompression_limit(size)):
+        # an object is also compressed when its leading bytes say so, whatever its key. they are only
+        # read when the strategy of the object would change were it to decompress to the most allowed
+        encoding = TriggerEvent(CONFIG['aws']['region']).object_encoding(trigger_event)
+    if encoding is not None:
+        # a compressed capture is loaded by the size it decompresses to
+        metrics.put_property('contentEncoding', encoding)
+        size = TriggerEvent(CONFIG['aws']['region']).decompressed_size(trigger_event, encoding)
+    if strategy is None:
+        strategy = choose_strategy(size)
+    headroom = memory_headroom(strategy, size)
+    metrics.put_property('strategy', strategy)
+    metrics.put_property('memoryHeadroom', headroom)
+    logger.debug(f'Loading {size} bytes by {strategy} with {headroom} bytes of memory to spare')
+    # the connection outlives the invocation, it is health checked before it is reused
+    with metrics.stage('connect'):
+        rds = shared_rds()
+    try:
+        record_id = load_record(trigger_event, rds, strategy)
+    except RuntimeError:
+        if rds.conn.closed:
+            discard_shared_rds()
+        raise
+    if rds.dedup:
+        metrics.put_property('dedup', dict(DEDUP_STATS))
+    if rds.attribute_lookups:
+        metrics.put_property('lookups', dict(LOOKUP_STATS))
+    if CONFIG['connect']['max_active']:
+        metrics.put_property('admission', dict(ADMISSION_STATS))
+    logger.debug(f'S3 clients: {CLIENT_STATS}, database connections: {CONNECTION_STATS}')
+    return record_id
+
+
+def database_unavailable(error):
+    """ whether a load failed for want of a connection to the database, rather than waiting for its turn on one """
+    error = error.__cause__ or error
+    return isinstance(error, DatabaseUnavailable) and not isinstance(error, AdmissionTimeout)
+
+
+def spool_failure(trigger_event, error):
+    """
+    keeps the record of a capture that failed to load in the dead letter spool, when there is one,
+    so that it can be replayed later. a failure to spool it is logged, the load failed either way
+    """
+    try:
+        spool = open_spool()
+        if isinstance(spool, TableSpool) and database_unavailable(error):
+            # connecting again to spool it would spend another connect budget on a database known to be down
+            fallback = CONFIG['load']['dead_letter_fallback']
+            spool = open_spool(fallback) if fallback and fallback != TABLE else None
+            if spool is None:
+                logger.warning(f'Not spooling {repr(error)}, the database is unavailable and there is no fallback')
+        if spool is not None:
+            spool.put(trigger_event['Record'], error, metrics.failed_stage())
+            metrics.put_property('spooled', True)
+    except Exception as e:
+        logger.warning(f'Failed to spool {repr(error)}: {repr(e)}', exc_info=True)
+
+
+def load_record(trigger_event, rds, strategy=MEMORY):
+    """
+    loads the object of an S3 event record into the database through rds
+    :return: the json_data_id and partition_number of the new row
+    """
     aws_region = CONFIG['aws']['region']
     event = TriggerEvent(aws_region)
-    event.extract(trigger_event)
 
-    rds = RDS()
+    if rds.dedup:
+        # a redelivered event costs one query rather than a download and an insert
+        with metrics.stage('dedup'):
+            found = rds.find_loaded(object_uuid(trigger_event['Record']['s3']['object']['key']))
+        if found is not None:
+            metrics.put_property('duplicate', True)
+            return found
+
+    size = int(trigger_event['Record']['s3']['object'].get('size', 0))
+    try:
+        if size >= CONFIG['load']['prevalidate_min_size']:
+            # reject captures with bad metadata before paying for the whole download
+            try:
+                event.prevalidate(trigger_event, rds.validate_attributes)
+            finally:
+                metrics.put_property('prevalidation', dict(PREVALIDATION_STATS))
+    except ValidationException as e:
+        logger.debug(repr(e), exc_info=True)
+        raise RuntimeError(repr(e)) from e
+    event.extract(trigger_event, strategy)
     datum = event.data
     try:
-        record_id = rds.persist_data(datum)
+        # waits for a slot when the loads using the database at once are capped
+        with rds.admitted():
+            if strategy == STREAM:
+                record_id = rds.persist_stream(datum)
+            elif strategy in (BUFFER, SPILL):
+                record_id = rds.persist_buffer(datum)
+            else:
+                record_id = rds.persist_data(datum)
+    except DatabaseUnavailable:
+        raise
     except Exception as e:
         logger.debug(repr(e), exc_info=True)
-        raise RuntimeError(repr(e))
+        raise RuntimeError(repr(e)) from e
     finally:
-        rds.disconnect()
+        datum.close()
     return record_id
 
 
+def batch_etl(trigger_event):
+    """
+    loads every record of a batch event
+    returns the loaded (item identifier, (json_data_id, partition_number)) pairs
+    and the (item identifier, exception) pairs that failed
+    """
+    with metrics.invocation('batch_etl'):
+        loaded, failures = _batch_etl(trigger_event)
+        metrics.put_property('loaded', len(loaded))
+        metrics.put_property('failed', len(failures))
+    return loaded, failures
+
+
+def _batch_etl(trigger_event):
+    event = BatchTriggerEvent(CONFIG['aws']['region'])
+    rds = None
+    find_loaded = None
+    if CONFIG['load']['dedup']:
+        # captures already loaded are not fetched again
+        with metrics.stage('connect'):
+            rds = shared_rds()
+        find_loaded = rds.find_loaded_many
+    event.extract(trigger_event, int(os.getenv('S3_OBJECT_SIZE_LIMIT', 150000000)), find_loaded)
+    failures = list(event.failures)
+    loaded = list(event.duplicates)
+    if event.data:
+        if rds is None:
+            with metrics.stage('connect'):
+                rds = shared_rds()
+        try:
+            with rds.admitted():
+                outcomes = rds.persist_batch([datum for _, datum in event.data])
+        except Exception as e:
+            logger.debug(repr(e), exc_info=True)
+            if rds.conn.closed:
+                discard_shared_rds()
+            outcomes = [e] * len(event.data)
+        for (item_id, _), outcome in zip(event.data, outcomes):
+            if isinstance(outcome, Exception):
+                failures.append((item_id, outcome))
+            else:
+                loaded.append((item_id, outcome))
+    return loaded, failures
+
+
+def batch_handler(event, context):
+    """
+    takes a batch of AWS S3 events, delivered directly or as SQS messages, and loads them together
+    :param event: AWS S3 JSON event or SQS event with a Records list of messages
+    :param context:
+    :return: the id and partition number of each loaded record, and the failed items
+             as an SQS partial batch response so that only those are retried
+    """
+    logger.debug(event)
+    loaded, failures = batch_etl(event)
+    for item_id, e in failures:
+        logger.info(f'Failed to load {item_id}: {repr(e)}')
+    return {
+        'records': [
+            {'itemIdentifier': item_id, 'id': record_id[0], 'partitionNumber': record_id[1]}
+            for item_id, record_id in loaded
+        ],
+        'batchItemFailures': [
+            {'itemIdentifier': item_id} for item_id in dict.fromkeys(item_id for item_id, _ in failures)
+        ]
+    }
+
+
 def lambda_handler(event, context):
     """
     takes an AWS S3 event and processes it
@@ -41,11 +283,8 @@ def lambda_handler(event, context):
     response = None
     try:
         logger.debug(event)
-        size = int(event['Record']['s3']['object']['size'])
-        if size < int(os.getenv('S3_OBJECT_SIZE_LIMIT', 150000000)):
-            record_id = etl(event)
-        else:
-            raise Exception(f"File too large to process for event {event}")
+        # the capture is loaded in memory or streamed depending on its size and the memory of the function
+        record_id = etl(event)
     except Exception as e:
         logger.info(f'About to exit with this exception: {repr(e)}')
         raise e
@@ -0,0 +1,154 @@
+"""
+Replays the captures of the dead letter spool, re-validating them in bulk and
+copying the valid ones into capture.json_data together rather than loading
+them one at a time.
+
+    python -m src.replay [SPOOL] [--batch-size 500] [--max-size 25600000] [--dry-run]
+
+SPOOL names the spool as DEAD_LETTER_SPOOL does, and defaults to it. Each
+batch of spooled captures is fetched, validated and copied with a single COPY
+in one transaction. Captures that load, or were loaded meanwhile, are removed
+from the spool; those that fail again are reported and stay in it. Captures
+of max-size bytes or more are streamed into the database one at a time.
+"""
+import argparse
+import logging
+import os
+import sys
+
+from .etl import metrics
+from .etl.config import CONFIG
+from .etl.event_processor import BatchTriggerEvent
+from .etl.rds import shared_rds
+from .etl.spool import open_spool
+from .load import STREAM, load_record
+
+log_level = os.getenv('LOG_LEVEL', logging.ERROR)
+logger = logging.getLogger(__name__)
+logger.setLevel(log_level)
+
+
+class Replay:
+
+    def __init__(self, spool, batch_size=500, max_size=25600000, dry_run=False, rds=None, out=sys.stderr):
+        self.spool = spool
+        self.batch_size = batch_size
+        self.max_size = max_size
+        self.dry_run = dry_run
+        self._rds = rds
+        self.out = out
+        self.loaded = 0
+        self.duplicates = 0
+        self.failed = 0
+        # the keys loaded so far, a capture spooled again in a later batch is not loaded twice
+        self._replayed = set()
+
+    @property
+    def rds(self):
+        if self._rds is None:
+            self._rds = shared_rds()
+        return self._rds
+
+    def run(self):
+        """ replays every spooled capture, returns the replay """
+        batch = []
+        for failure in self.spool.entries():
+            batch.append(failure)
+            if len(batch) >= self.batch_size:
+                self._replay(batch)
+                batch = []
+        if batch:
+            self._replay(batch)
+        self.out.write(f'loaded {self.loaded} already loaded {self.duplicates} failed {self.failed}\n')
+        return self
+
+    def _replay(self, batch):
+        # a capture whose load failed more than once is spooled as often, it is replayed once
+        handles = {}
+        records = {}
+        for failure in batch:
+            key = failure.record['s3']['object']['key']
+            handles.setdefault(key, []).append(failure.handle)
+            records.setdefault(key, failure.record)
+        done = [key for key in records if key in self._replayed]
+        self.duplicates += len(done)
+        for key in done:
+            del records[key]
+        large = [key for key, record in records.items()
+                 if int(record['s3']['object'].get('size', 0)) >= self.max_size]
+        done.extend(key for key in large if self._replay_one(key, records.pop(key)))
+        if records:
+            done.extend(self._replay_batch(records))
+        if not self.dry_run:
+            self._replayed.update(done)
+            self.spool.remove(handle for key in done for handle in handles[key])
+
+    def _replay_one(self, key, record):
+        if self.dry_run:
+            return False
+        try:
+            load_record({'Record': record}, self.rds, STREAM)
+        except Exception as e:
+            self._failed(key, e)
+            return False
+        self.loaded += 1
+        return True
+
+    def _replay_batch(self, records):
+        """ loads records together, returning the keys of those loaded or found loaded already """
+        rds = self.rds
+        event = BatchTriggerEvent(CONFIG['aws']['region'])
+        event.extract({'Records': list(records.values())}, self.max_size,
+                      rds.find_loaded_many if rds.dedup else None)
+        for key, e in event.failures:
+            self._failed(key, e)
+        done = [key for key, _ in event.duplicates]
+        self.duplicates += len(done)
+        rows, keys, loads = [], [], []
+        with metrics.stage('validate'):
+            for key, datum in event.data:
+                try:
+                    rows.append(rds.batch_row(datum))
+                except Exception as e:
+                    self._failed(key, e)
+                    continue
+                keys.append(key)
+                loads.append((datum.uuid, datum.content_hash))
+        if not rows or self.dry_run:
+            return done
+        try:
+            outcomes = rds.copy_rows(rows, loads if rds.dedup else None)
+        except Exception as e:
+            outcomes = [e] * len(rows)
+        for key, outcome in zip(keys, outcomes):
+            if isinstance(outcome, Exception):
+                self._failed(key, outcome)
+            else:
+                self.loaded += 1
+                done.append(key)
+        return done
+
+    def _failed(self, key, e):
+        self.failed += 1
+        logger.warning(f'Failed to replay {key}: {repr(e)}')
+        self.out.write(f'failed {key}: {repr(e)}\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('spool', nargs='?', help='the spool to replay, DEAD_LETTER_SPOOL when not given')
+    parser.add_argument('--batch-size', type=int, default=500, help='captures copied in one transaction')
+    parser.add_argument('--max-size', type=int, default=25600000,
+                        help='size from which a capture is streamed into the database on its own')
+    parser.add_argument('--dry-run', action='store_true', help='validate the spooled captures without loading them')
+    args = parser.parse_args(argv)
+
+    spool = open_spool(args.spool)
+    if spool is None:
+        parser.error('no spool given and DEAD_LETTER_SPOOL is not set')
+    replay = Replay(spool, args.batch_size, args.max_size, args.dry_run).run()
+    return 1 if replay.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
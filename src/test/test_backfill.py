@@ -0,0 +1,132 @@
+import io
+import json
+import os
+import tempfile
+import time
+from unittest import TestCase, mock
+
+import src.etl.s3 as s3_module
+from src.backfill import Backfill, Checkpoint, RateLimiter, main
+from src.etl.config import CONFIG
+from src.etl.local_s3 import LocalS3Client
+
+
+class TestCheckpoint(TestCase):
+
+    def test_advances_over_completed_keys_only(self):
+        checkpoint = Checkpoint(None, 'bucket', 'prefix')
+        for key in ('a', 'b', 'c'):
+            checkpoint.started(key)
+        checkpoint.finished('b', 10)
+        self.assertEqual('', checkpoint.after)
+        checkpoint.finished('a', 10, RuntimeError('bad'))
+        self.assertEqual('b', checkpoint.after)
+        checkpoint.finished('c', 10)
+        self.assertEqual('c', checkpoint.after)
+        self.assertEqual((2, 1, 20), (checkpoint.loaded, checkpoint.failed, checkpoint.bytes))
+        self.assertEqual({'a': 10}, checkpoint.failures)
+        checkpoint.finished('a', 10)
+        self.assertEqual(('c', 3, 0, {}), (checkpoint.after, checkpoint.loaded, checkpoint.failed,
+                                           checkpoint.failures))
+
+    def test_saved_and_resumed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'checkpoint.json')
+            checkpoint = Checkpoint(path, 'bucket', 'prefix')
+            checkpoint.started('a')
+            checkpoint.finished('a', 10)
+            resumed = Checkpoint(path, 'bucket', 'prefix')
+            self.assertEqual(('a', 1, 10), (resumed.after, resumed.loaded, resumed.bytes))
+            with self.assertRaises(ValueError):
+                Checkpoint(path, 'bucket', 'other-prefix')
+
+
+class TestRateLimiter(TestCase):
+
+    def test_spaces_calls(self):
+        limiter = RateLimiter(200)
+        start = time.monotonic()
+        for _ in range(5):
+            limiter.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 0.019)
+
+
+@mock.patch('src.etl.rds.connect')
+class TestBackfill(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        client = LocalS3Client(self.root.name)
+        metadata = {
+            'URL': {'StringValue': 'https://some.net/api/call'}, 'API': {'StringValue': 'api'},
+            'Parameters': {'StringValue': '{}'}, 'StartTime': {'StringValue': '1580000000'},
+            'ResponseTime': {'StringValue': '1580000001'}, 'PID': {'StringValue': '1234'},
+            'ScriptName': {'StringValue': 'script'}, 'ResponseCode': {'StringValue': '200'},
+        }
+        self.keys = [f'2020-01-01/body_{i:02d}.json' for i in range(12)]
+        for i, key in enumerate(self.keys):
+            content = 'not json' if i == 5 else json.dumps({'i': i})
+            client.put_object(Bucket='bucket', Key=key, Body=json.dumps({'metadata': metadata, 'content': content}))
+        client.put_object(Bucket='bucket', Key='2020-01-02/body_00.json', Body='{}')
+        self.checkpoint = os.path.join(self.root.name, 'checkpoint.json')
+        s3_module._clients.clear()
+        self.config = mock.patch.dict(CONFIG['aws'], {'s3-local-root': self.root.name})
+        self.config.start()
+
+    def tearDown(self):
+        self.config.stop()
+        s3_module._clients.clear()
+        self.root.cleanup()
+
+    def inserted(self, mock_conn):
+        cursor = mock_conn.return_value.cursor.return_value
+        return sorted(json.loads(call[0][1][-1])['i'] for call in cursor.execute.call_args_list
+                      if len(call[0]) > 1)
+
+    def test_loads_prefix(self, mock_conn):
+        mock_conn.return_value.closed = 0
+        mock_conn.return_value.cursor.return_value.fetchone.return_value = (1, 1)
+        out = io.StringIO()
+        checkpoint = Backfill('bucket', '2020-01-01/', workers=4, connections=2, checkpoint=self.checkpoint,
+                              out=out).run()
+        self.assertEqual([i for i in range(12) if i != 5], self.inserted(mock_conn))
+        self.assertEqual((11, 1), (checkpoint.loaded, checkpoint.failed))
+        self.assertLessEqual(mock_conn.call_count, 2)
+        with open(self.checkpoint) as f:
+            self.assertEqual(self.keys[-1], json.load(f)['after'])
+        self.assertIn(f'failed {self.keys[5]}', out.getvalue())
+        self.assertIn('records/s', out.getvalue())
+
+    def test_resumes_from_checkpoint(self, mock_conn):
+        mock_conn.return_value.closed = 0
+        mock_conn.return_value.cursor.return_value.fetchone.return_value = (1, 1)
+        with open(self.checkpoint, 'w') as f:
+            json.dump({'bucket': 'bucket', 'prefix': '2020-01-01/', 'after': self.keys[7],
+                       'loaded': 7, 'failed': 1, 'bytes': 700}, f)
+        status = main(['bucket', '2020-01-01/', '--workers', '2', '--checkpoint', self.checkpoint])
+        self.assertEqual([8, 9, 10, 11], self.inserted(mock_conn))
+        with open(self.checkpoint) as f:
+            saved = json.load(f)
+        self.assertEqual((self.keys[-1], 11, 1), (saved['after'], saved['loaded'], saved['failed']))
+        self.assertEqual(1, status)
+
+    def test_retries_failures_on_resume(self, mock_conn):
+        mock_conn.return_value.closed = 0
+        mock_conn.return_value.cursor.return_value.fetchone.return_value = (1, 1)
+        status = main(['bucket', '2020-01-01/', '--workers', '2', '--checkpoint', self.checkpoint])
+        self.assertEqual(1, status)
+        with open(self.checkpoint) as f:
+            self.assertEqual([self.keys[5]], list(json.load(f)['failures']))
+        # the key failed while the database was down, say, and loads once it is back
+        document = json.loads(LocalS3Client(self.root.name).get_object(Bucket='bucket', Key=self.keys[5])['Body']
+                              .read())
+        document['content'] = json.dumps({'i': 5})
+        LocalS3Client(self.root.name).put_object(Bucket='bucket', Key=self.keys[5], Body=json.dumps(document))
+        mock_conn.return_value.cursor.return_value.execute.reset_mock()
+        status = main(['bucket', '2020-01-01/', '--workers', '2', '--checkpoint', self.checkpoint])
+        self.assertEqual(0, status)
+        self.assertEqual([5], self.inserted(mock_conn))
+        with open(self.checkpoint) as f:
+            saved = json.load(f)
+        self.assertEqual((self.keys[-1], 12, 0, {}),
+                         (saved['after'], saved['loaded'], saved['failed'], saved['failures']))
@@ -0,0 +1,411 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from psycopg2 import OperationalError
+
+from src import load
+from src.etl import metrics
+from src.etl.compression import DecompressionError
+from src.etl.config import CONFIG
+import src.etl.s3 as s3_module
+from src.etl.local_s3 import LocalS3Client
+from src.etl.rds import RDS, CircuitOpen, ValidationException
+
+MB = 1048576
+LOAD_CONFIG = {'memory_size': '256', 'memory_reserve': 100 * MB, 'in_memory_factor': 6.0, 'stream_chunk_size': MB}
+
+
+def s3_event(size):
+    return {'Record': {'s3': {'bucket': {'name': 'bucket'}, 'object': {'key': 'key', 'size': size}}}}
+
+
+@mock.patch.dict(CONFIG['load'], LOAD_CONFIG)
+@mock.patch.dict('os.environ', {'STREAMING_LOAD': 'false'})
+@mock.patch('src.load.spill_space', mock.Mock(return_value=0))
+class TestChooseStrategy(TestCase):
+
+    def test_boundary(self):
+        largest = 156 * MB // 6
+        self.assertEqual(load.MEMORY, load.choose_strategy(0))
+        self.assertEqual(load.MEMORY, load.choose_strategy(largest))
+        self.assertEqual(load.BUFFER, load.choose_strategy(largest + 1))
+        self.assertEqual(0, load.memory_headroom(load.MEMORY, largest))
+
+    def test_buffer_boundary(self):
+        largest = 132 * MB
+        self.assertEqual(load.BUFFER, load.choose_strategy(largest))
+        self.assertEqual(load.STREAM, load.choose_strategy(largest + 1))
+        self.assertEqual(0, load.memory_headroom(load.BUFFER, largest))
+        self.assertEqual(152 * MB, load.memory_headroom(load.STREAM, largest + 1))
+
+    def test_boundary_follows_memory_size(self):
+        with mock.patch.dict(CONFIG['load'], {'memory_size': '1536'}):
+            largest = (1536 - 100) * MB // 6
+            self.assertEqual(load.MEMORY, load.choose_strategy(largest))
+            self.assertEqual(load.BUFFER, load.choose_strategy(largest + 1))
+            largest = (1536 - 124) * MB
+            self.assertEqual(load.BUFFER, load.choose_strategy(largest))
+            self.assertEqual(load.STREAM, load.choose_strategy(largest + 1))
+
+    def test_streaming_load(self):
+        with mock.patch.dict('os.environ', {'STREAMING_LOAD': 'true'}):
+            self.assertEqual(load.STREAM, load.choose_strategy(1))
+
+    def test_memory_size_unknown(self):
+        with mock.patch.dict(CONFIG['load'], {'memory_size': None}), \
+                mock.patch.dict('os.environ', {'S3_OBJECT_SIZE_LIMIT': '1000'}):
+            self.assertEqual(load.MEMORY, load.choose_strategy(999))
+            self.assertEqual(load.STREAM, load.choose_strategy(1000))
+            self.assertIsNone(load.memory_headroom(load.MEMORY, 999))
+
+    def test_spill_when_there_is_room(self):
+        largest = 132 * MB
+        with mock.patch('src.load.spill_space', return_value=500 * MB):
+            self.assertEqual(load.BUFFER, load.choose_strategy(largest))
+            self.assertEqual(load.SPILL, load.choose_strategy(largest + 1))
+            self.assertEqual(load.SPILL, load.choose_strategy(500 * MB - 1))
+            self.assertEqual(load.STREAM, load.choose_strategy(500 * MB))
+            self.assertEqual(132 * MB, load.memory_headroom(load.SPILL, largest + 1))
+
+
+@mock.patch.dict(CONFIG['load'], LOAD_CONFIG)
+@mock.patch.dict('os.environ', {'STREAMING_LOAD': 'false'})
+@mock.patch('src.load.spill_space', mock.Mock(return_value=0))
+@mock.patch('src.load.TriggerEvent.object_encoding', mock.Mock(return_value=None))
+@mock.patch('src.load.load_record')
+@mock.patch('src.load.shared_rds')
+class TestLambdaHandler(TestCase):
+
+    def handle(self, size):
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as out:
+            response = load.lambda_handler(s3_event(size), None)
+        return response, json.loads(out.getvalue().splitlines()[-1])
+
+    def test_small_in_memory(self, mock_rds, mock_load):
+        mock_load.return_value = (5, 1)
+        response, logged = self.handle(10 * MB)
+        mock_load.assert_called_once_with(s3_event(10 * MB), mock_rds.return_value, load.MEMORY)
+        self.assertEqual({'id': 5, 'partitionNumber': 1}, response)
+        self.assertEqual('memory', logged['strategy'])
+        self.assertEqual(96 * MB, logged['memoryHeadroom'])
+
+    def test_medium_buffered(self, mock_rds, mock_load):
+        mock_load.return_value = (7, 1)
+        response, logged = self.handle(100 * MB)
+        mock_load.assert_called_once_with(s3_event(100 * MB), mock_rds.return_value, load.BUFFER)
+        self.assertEqual('buffer', logged['strategy'])
+        self.assertEqual(32 * MB, logged['memoryHeadroom'])
+
+    def test_large_streamed(self, mock_rds, mock_load):
+        mock_load.return_value = (6, 1)
+        response, logged = self.handle(500 * MB)
+        mock_load.assert_called_once_with(s3_event(500 * MB), mock_rds.return_value, load.STREAM)
+        self.assertEqual({'id': 6, 'partitionNumber': 1}, response)
+        self.assertEqual('stream', logged['strategy'])
+        self.assertEqual(152 * MB, logged['memoryHeadroom'])
+
+    def test_failure_spooled(self, mock_rds, mock_load):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'failures.jsonl')
+
+            def fail(*args):
+                with metrics.stage('persist'):
+                    try:
+                        raise ValueError('bad content')
+                    except ValueError as e:
+                        raise RuntimeError(repr(e)) from e
+            mock_load.side_effect = fail
+            with mock.patch.dict(CONFIG['load'], {'dead_letter_spool': path}):
+                with self.assertRaises(RuntimeError):
+                    self.handle(10 * MB)
+            with open(path) as f:
+                spooled = json.loads(f.read())
+        self.assertEqual(s3_event(10 * MB)['Record'], spooled['record'])
+        self.assertEqual(('ValueError', 'persist'), (spooled['error'], spooled['stage']))
+
+    def test_unavailable_database_not_spooled_to(self, mock_rds, mock_load):
+        mock_rds.side_effect = CircuitOpen('the circuit breaker is open')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'failures.jsonl')
+            with mock.patch.dict(CONFIG['load'], {'dead_letter_spool': 'table', 'dead_letter_fallback': None}):
+                with self.assertRaises(CircuitOpen):
+                    self.handle(10 * MB)
+            # the database is not tried again only to spool the failure
+            self.assertEqual(1, mock_rds.call_count)
+            with mock.patch.dict(CONFIG['load'], {'dead_letter_spool': 'table', 'dead_letter_fallback': path}):
+                with self.assertRaises(CircuitOpen):
+                    self.handle(10 * MB)
+            self.assertEqual(2, mock_rds.call_count)
+            with open(path) as f:
+                spooled = json.loads(f.read())
+        self.assertEqual(('CircuitOpen', 'connect'), (spooled['error'], spooled['stage']))
+
+    def test_failure_not_spooled(self, mock_rds, mock_load):
+        mock_load.side_effect = RuntimeError('bad')
+        with mock.patch.dict(CONFIG['load'], {'dead_letter_spool': 's3://bucket/failed/'}), \
+                mock.patch('src.etl.spool.S3Spool.put', side_effect=OSError('unreachable')):
+            with self.assertRaises(RuntimeError):
+                self.handle(10 * MB)
+
+
+class TestBatchHandler(TestCase):
+
+    def setUp(self):
+        self.event = {'Records': [
+            {'messageId': 'one', 'body': '{}'},
+            {'messageId': 'two', 'body': '{}'},
+            {'messageId': 'three', 'body': '{}'},
+        ]}
+
+    @mock.patch('src.load.shared_rds')
+    @mock.patch('src.load.BatchTriggerEvent')
+    def test_partial_failure(self, mock_event, mock_rds):
+        mock_event.return_value.data = [('one', 'datum one'), ('two', 'datum two')]
+        mock_event.return_value.failures = [('three', RuntimeError('no such key'))]
+        mock_rds.return_value.persist_batch.return_value = [(5, 1), ValidationException('', '', '', '')]
+
+        response = load.batch_handler(self.event, None)
+
+        mock_rds.return_value.persist_batch.assert_called_once_with(['datum one', 'datum two'])
+        self.assertEqual([{'itemIdentifier': 'one', 'id': 5, 'partitionNumber': 1}], response['records'])
+        self.assertEqual([{'itemIdentifier': 'three'}, {'itemIdentifier': 'two'}], response['batchItemFailures'])
+
+    @mock.patch('src.load.shared_rds')
+    @mock.patch('src.load.BatchTriggerEvent')
+    def test_database_failure(self, mock_event, mock_rds):
+        mock_event.return_value.data = [('one', 'datum one'), ('two', 'datum two')]
+        mock_event.return_value.failures = []
+        mock_rds.return_value.persist_batch.side_effect = RuntimeError('connection lost')
+
+        response = load.batch_handler(self.event, None)
+
+        self.assertEqual([], response['records'])
+        self.assertEqual([{'itemIdentifier': 'one'}, {'itemIdentifier': 'two'}], response['batchItemFailures'])
+
+
+class TestDedup(TestCase):
+
+    @mock.patch('src.load.TriggerEvent')
+    def test_duplicate_not_fetched(self, mock_event):
+        rds = mock.Mock(dedup=True)
+        rds.find_loaded.return_value = (9, 1)
+        event = s3_event(100 * MB)
+        event['Record']['s3']['object']['key'] = 'body_mod_444abb55-afe0-40f7-9791-c824ac396a75.json'
+
+        self.assertEqual((9, 1), load.load_record(event, rds))
+
+        rds.find_loaded.assert_called_once_with('444abb55-afe0-40f7-9791-c824ac396a75')
+        mock_event.return_value.prevalidate.assert_not_called()
+        mock_event.return_value.extract.assert_not_called()
+        rds.persist_data.assert_not_called()
+
+    @mock.patch('src.load.shared_rds')
+    @mock.patch('src.load.BatchTriggerEvent')
+    def test_batch_duplicates_loaded(self, mock_event, mock_rds):
+        mock_event.return_value.data = [('two', 'datum two')]
+        mock_event.return_value.failures = []
+        mock_event.return_value.duplicates = [('one', (4, 1))]
+        mock_rds.return_value.persist_batch.return_value = [(5, 1)]
+
+        with mock.patch.dict(CONFIG['load'], {'dedup': True}):
+            response = load.batch_handler({'Records': []}, None)
+
+        self.assertEqual(mock_rds.return_value.find_loaded_many, mock_event.return_value.extract.call_args[0][2])
+        self.assertEqual(['one', 'two'], [record['itemIdentifier'] for record in response['records']])
+        self.assertEqual([], response['batchItemFailures'])
+
+
+@mock.patch('src.etl.rds.connect')
+class TestSpilledLoad(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.spill_dir = tempfile.TemporaryDirectory()
+        s3_module._clients.pop(CONFIG['aws']['region'], None)
+        self.config = [
+            mock.patch.dict(CONFIG['aws'], {'s3-local-root': self.root.name}),
+            mock.patch.dict(CONFIG['load'], {'spill_dir': self.spill_dir.name, 'stream_chunk_size': 1000,
+                                             'download_part_size': 10000, 'prevalidate_min_size': 1}),
+        ]
+        for patch in self.config:
+            patch.start()
+        self.metadata = {name: {'StringValue': value} for name, value in (
+            ('StartTime', '1580000000'), ('ResponseTime', '1580000001'), ('ResponseCode', '200'),
+            ('PID', '1234'), ('URL', 'https://some.net/api/call'), ('API', 'api'),
+            ('ScriptName', 'script'), ('Parameters', '{"a": 1}'))}
+        self.digest = hashlib.sha256()
+
+    def tearDown(self):
+        for patch in self.config:
+            patch.stop()
+        s3_module._clients.pop(CONFIG['aws']['region'], None)
+        self.root.cleanup()
+        self.spill_dir.cleanup()
+
+    def put(self, content):
+        document = json.dumps({'metadata': self.metadata, 'content': content}, ensure_ascii=False).encode('utf-8')
+        LocalS3Client(self.root.name).put_object(Bucket='bucket', Key='capture.json', Body=document)
+        event = {'Record': {'s3': {'bucket': {'name': 'bucket'},
+                                   'object': {'key': 'capture.json', 'size': len(document)}}}}
+        return document, event
+
+    def copy_expert(self, sql, file, size=8192):
+        while True:
+            data = file.read(size)
+            if not data:
+                break
+            self.digest.update(data)
+
+    def load(self, mock_conn, event):
+        cursor = mock_conn.return_value.cursor.return_value
+        cursor.copy_expert.side_effect = self.copy_expert
+        cursor.fetchone.return_value = (3, 1)
+        return load.load_record(event, RDS(), load.SPILL)
+
+    def test_content_copied_byte_for_byte(self, mock_conn):
+        content = json.dumps({'Points': [{'v': i, 's': 'é "quoted" \\ 😀'} for i in range(2000)]})
+        document, event = self.put(content)
+        self.assertEqual((3, 1), self.load(mock_conn, event))
+        literal = json.dumps(content, ensure_ascii=False).encode('utf-8')
+        self.assertEqual(hashlib.sha256(literal + b'\n').hexdigest(), self.digest.hexdigest())
+        self.assertEqual([], os.listdir(self.spill_dir.name))
+
+    def test_removed_when_content_invalid(self, mock_conn):
+        _, event = self.put('{"Points": [1, 2,]}')
+        with self.assertRaises(RuntimeError):
+            self.load(mock_conn, event)
+        mock_conn.return_value.cursor.return_value.copy_expert.assert_not_called()
+        self.assertEqual([], os.listdir(self.spill_dir.name))
+
+    def test_removed_when_copy_fails(self, mock_conn):
+        _, event = self.put('{"Points": [1, 2]}')
+        mock_conn.return_value.cursor.return_value.copy_expert.side_effect = OperationalError('connection lost')
+        with self.assertRaises(RuntimeError):
+            load.load_record(event, RDS(), load.SPILL)
+        mock_conn.return_value.rollback.assert_called_once()
+        self.assertEqual([], os.listdir(self.spill_dir.name))
+
+
+@mock.patch('src.etl.rds.connect')
+class TestCompressedLoad(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.spill_dir = tempfile.TemporaryDirectory()
+        s3_module._clients.pop(CONFIG['aws']['region'], None)
+        self.config = [
+            mock.patch.dict(CONFIG['aws'], {'s3-local-root': self.root.name}),
+            mock.patch.dict(CONFIG['load'], dict(LOAD_CONFIG, spill_dir=self.spill_dir.name, stream_chunk_size=1000,
+                                                 download_part_size=10000, prevalidate_min_size=1,
+                                                 max_decompression_ratio=100, dedup=False,
+                                                 content_compression=None)),
+            mock.patch.dict('os.environ', {'STREAMING_LOAD': 'false'}),
+        ]
+        for patch in self.config:
+            patch.start()
+        self.metadata = {name: {'StringValue': value} for name, value in (
+            ('StartTime', '1580000000'), ('ResponseTime', '1580000001'), ('ResponseCode', '200'),
+            ('PID', '1234'), ('URL', 'https://some.net/api/call'), ('API', 'api'),
+            ('ScriptName', 'script'), ('Parameters', '{"a": 1}'))}
+        self.content = json.dumps({'Points': [{'v': i, 's': 'é "quoted" \\ 😀'} for i in range(2000)]})
+        self.copied = []
+
+    def tearDown(self):
+        for patch in self.config:
+            patch.stop()
+        s3_module._clients.pop(CONFIG['aws']['region'], None)
+        self.root.cleanup()
+        self.spill_dir.cleanup()
+
+    def put(self, key, compress, content=None):
+        document = json.dumps({'metadata': self.metadata, 'content': content or self.content}).encode('utf-8')
+        stored = compress(document)
+        LocalS3Client(self.root.name).put_object(Bucket='bucket', Key=key, Body=stored)
+        return stored, {'Record': {'s3': {'bucket': {'name': 'bucket'}, 'object': {'key': key, 'size': len(stored)}}}}
+
+    def copy_expert(self, sql, file, size=8192):
+        while True:
+            data = file.read(size)
+            if not data:
+                break
+            self.copied.append(data)
+
+    def load(self, mock_conn, event, strategy):
+        cursor = mock_conn.return_value.cursor.return_value
+        cursor.copy_expert.side_effect = self.copy_expert
+        cursor.fetchone.return_value = (3, 1)
+        self.copied = []
+        return load.load_record(event, RDS(), strategy)
+
+    def assert_loaded(self, mock_conn, event, strategy):
+        self.assertEqual((3, 1), self.load(mock_conn, event, strategy), msg=strategy)
+        cursor = mock_conn.return_value.cursor.return_value
+        if strategy == load.MEMORY:
+            self.assertEqual(self.content, cursor.execute.call_args[0][1][-1])
+        elif strategy == load.STREAM:
+            copied = ''.join(self.copied)
+            self.assertEqual(self.content.replace('\\', '\\\\') + '\n', copied)
+        else:
+            literal = b''.join(self.copied)
+            self.assertEqual(self.content, json.loads(literal))
+        self.assertEqual([], os.listdir(self.spill_dir.name))
+
+    def test_gzip(self, mock_conn):
+        for key in ('capture.json.gz', 'capture.json'):
+            _, event = self.put(key, gzip.compress)
+            for strategy in (load.MEMORY, load.BUFFER, load.SPILL, load.STREAM):
+                self.assert_loaded(mock_conn, event, strategy)
+
+    @mock.patch('src.load.load_record')
+    def test_strategy_by_decompressed_size(self, mock_load, mock_conn):
+        mock_load.return_value = (3, 1)
+        # compressed by its key, and by its leading bytes alone
+        for key in ('capture.json.gz', 'capture.json'):
+            stored, event = self.put(key, gzip.compress, json.dumps('x' * (30 * MB)))
+            self.assertLess(len(stored), MB)
+            with mock.patch.dict(CONFIG['load'], {'max_decompression_ratio': 2000}), \
+                    mock.patch('sys.stdout', new_callable=io.StringIO) as out:
+                load.etl(event)
+            logged = json.loads(out.getvalue().splitlines()[-1])
+            mock_load.assert_called_with(event, mock.ANY, load.BUFFER)
+            self.assertEqual('gzip', logged['contentEncoding'], msg=key)
+
+    @mock.patch('src.load.load_record')
+    def test_uncompressed_not_sniffed(self, mock_load, mock_conn):
+        mock_load.return_value = (3, 1)
+        stored, event = self.put('capture.json', lambda document: document)
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as out, \
+                mock.patch.object(load.TriggerEvent, 'object_encoding', return_value=None) as mock_encoding:
+            with mock.patch.dict(CONFIG['load'], {'max_decompression_ratio': 2000}):
+                load.etl(event)
+            mock_encoding.assert_called_once_with(event)
+            # the object is loaded in memory even were it to decompress to the most allowed
+            load.etl(event)
+            mock_encoding.assert_called_once_with(event)
+        self.assertNotIn('contentEncoding', json.loads(out.getvalue().splitlines()[-1]))
+        mock_load.assert_called_with(event, mock.ANY, load.MEMORY)
+
+    @mock.patch('src.load.load_record')
+    def test_decompression_bomb(self, mock_load, mock_conn):
+        _, event = self.put('capture.json.gz', gzip.compress, json.dumps('x' * (10 * MB)))
+        with mock.patch.dict(CONFIG['load'], {'max_decompression_ratio': 10}), \
+                mock.patch('sys.stdout', new_callable=io.StringIO), \
+                self.assertRaises(DecompressionError):
+            load.etl(event)
+        mock_load.assert_not_called()
+
+    def test_decompression_bomb_not_named(self, mock_conn):
+        _, event = self.put('capture.json', gzip.compress, json.dumps('x' * (10 * MB)))
+        with mock.patch.dict(CONFIG['load'], {'max_decompression_ratio': 10}):
+            for strategy in (load.MEMORY, load.SPILL):
+                with self.assertRaises(DecompressionError, msg=strategy):
+                    self.load(mock_conn, event, strategy)
+            # a streamed object is only decompressed as it is copied
+            with self.assertRaisesRegex(RuntimeError, 'DecompressionError'):
+                self.load(mock_conn, event, load.STREAM)
+        self.assertEqual([], os.listdir(self.spill_dir.name))
@@ -0,0 +1,125 @@
+import io
+import json
+import os
+import tempfile
+from unittest import TestCase, mock
+
+import src.etl.s3 as s3_module
+from src.etl.config import CONFIG
+from src.etl.local_s3 import LocalS3Client
+from src.etl.rds import RDS, SELECT_JSON_DATA_IDS, SELECT_JSON_DATA_SEQUENCE
+from src.etl.spool import FileSpool
+from src.replay import Replay, main
+
+
+def record_of(spool, key):
+    return next(failure.record for failure in spool.entries() if failure.record['s3']['object']['key'] == key)
+
+
+class CopyCursor:
+    """ a cursor taking ids from a sequence and keeping the contents copied """
+
+    def __init__(self):
+        self.next_id = 1
+        self.copied = []
+        self.copies = 0
+        self.rows = []
+
+    def execute(self, sql, params=None):
+        if sql == SELECT_JSON_DATA_SEQUENCE:
+            self.rows = [('json_data_id_seq',)]
+        elif sql == SELECT_JSON_DATA_IDS:
+            self.rows = [(self.next_id + i,) for i in range(params[1])]
+            self.next_id += params[1]
+        elif sql.startswith('SELECT json_data_id, partition_number FROM'):
+            self.rows = [(json_data_id, 1) for json_data_id in params[0]]
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def fetchall(self):
+        return self.rows
+
+    def copy_expert(self, sql, file):
+        self.copies += 1
+        while True:
+            line = file.read(8192)
+            if not line:
+                break
+            self.copied.append(json.loads(line.rstrip('\n').split('\t')[-1].replace('\\\\', '\\'))['i'])
+
+
+@mock.patch('src.etl.rds.connect')
+class TestReplay(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        client = LocalS3Client(self.root.name)
+        metadata = {
+            'URL': {'StringValue': 'https://some.net/api/call'}, 'API': {'StringValue': 'api'},
+            'Parameters': {'StringValue': '{}'}, 'StartTime': {'StringValue': '1580000000'},
+            'ResponseTime': {'StringValue': '1580000001'}, 'PID': {'StringValue': '1234'},
+            'ScriptName': {'StringValue': 'script'}, 'ResponseCode': {'StringValue': '200'},
+        }
+        self.spool = FileSpool(os.path.join(self.root.name, 'failures.jsonl'))
+        self.keys = [f'2020-01-01/body_{i:02d}.json' for i in range(5)]
+        for i, key in enumerate(self.keys):
+            content = 'not json' if i == 3 else json.dumps({'i': i})
+            document = json.dumps({'metadata': metadata, 'content': content})
+            client.put_object(Bucket='bucket', Key=key, Body=document)
+            record = {'s3': {'bucket': {'name': 'bucket'}, 'object': {'key': key, 'size': len(document)}}}
+            self.spool.put(record, RuntimeError('database unavailable'), 'connect')
+        # the first capture failed twice
+        self.spool.put(record_of(self.spool, self.keys[0]), RuntimeError('database unavailable'), 'connect')
+        s3_module._clients.clear()
+        self.config = [
+            mock.patch.dict(CONFIG['aws'], {'s3-local-root': self.root.name}),
+            mock.patch.dict(CONFIG['load'], {'dedup': False, 'partition_routing': False}),
+        ]
+        for patch in self.config:
+            patch.start()
+        self.cursor = CopyCursor()
+
+    def tearDown(self):
+        for patch in self.config:
+            patch.stop()
+        s3_module._clients.clear()
+        self.root.cleanup()
+
+    def replay(self, mock_conn, **kwargs):
+        mock_conn.return_value.cursor.return_value = self.cursor
+        out = io.StringIO()
+        return Replay(self.spool, rds=RDS(dedup=False), out=out, **kwargs).run(), out.getvalue()
+
+    def test_replayed_in_batches(self, mock_conn):
+        replay, out = self.replay(mock_conn, batch_size=4)
+        self.assertEqual((4, 1), (replay.loaded, replay.failed))
+        self.assertEqual([0, 1, 2, 4], sorted(self.cursor.copied))
+        # a COPY for each batch
+        self.assertEqual(2, self.cursor.copies)
+        self.assertIn(f'failed {self.keys[3]}', out)
+        self.assertIn('loaded 4 already loaded 1 failed 1', out)
+        self.assertEqual([self.keys[3]], [failure.record['s3']['object']['key'] for failure in self.spool.entries()])
+
+    def test_large_captures_streamed(self, mock_conn):
+        with mock.patch('src.replay.load_record', return_value=(9, 1)) as mock_load:
+            replay, _ = self.replay(mock_conn, max_size=1)
+        self.assertEqual((5, 0), (replay.loaded, replay.failed))
+        self.assertEqual(5, mock_load.call_count)
+        self.assertEqual([], self.cursor.copied)
+        self.assertEqual([], list(self.spool.entries()))
+
+    def test_dry_run(self, mock_conn):
+        replay, out = self.replay(mock_conn, dry_run=True)
+        self.assertEqual((0, 1), (replay.loaded, replay.failed))
+        self.assertEqual(0, self.cursor.copies)
+        self.assertEqual(6, len(list(self.spool.entries())))
+
+    def test_main(self, mock_conn):
+        mock_conn.return_value.cursor.return_value = self.cursor
+        with mock.patch('sys.stderr', new_callable=io.StringIO), \
+                mock.patch('src.replay.shared_rds', return_value=RDS(dedup=False)):
+            self.assertEqual(1, main([self.spool.path, '--dry-run']))
+            with self.assertRaises(SystemExit):
+                with mock.patch.dict(CONFIG['load'], {'dead_letter_spool': None}):
+                    main([])
@@ -0,0 +1,31 @@
+import os
+import subprocess
+import sys
+from unittest import TestCase
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# the longest importing the Lambda entry point may take, about 1.5 times the 60-70 ms it takes without the botocore
+# session, so that importing the session again, some 150 ms, fails it
+IMPORT_BUDGET_MS = float(os.getenv('IMPORT_BUDGET_MS', 100))
+
+
+def run(code):
+    return subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT, capture_output=True,
+                          text=True, check=True)
+
+
+class TestStartup(TestCase):
+
+    def test_heavy_imports_deferred(self):
+        modules = ['boto3', 's3transfer', 'botocore.session', 'botocore.client', 'cProfile', 'pstats', 'tracemalloc']
+        completed = run(f'import sys, src.load; print(*[m for m in {modules!r} if m in sys.modules])')
+        self.assertEqual('', completed.stdout.strip())
+
+    def test_import_within_budget(self):
+        times = []
+        for _ in range(5):
+            stderr = run('import src.load').stderr
+            line = next(line for line in stderr.splitlines() if line.endswith('| src.load'))
+            times.append(int(line.split('|')[1]) / 1000)
+        self.assertLess(min(times), IMPORT_BUDGET_MS,
+                        f'importing src.load took {min(times):.0f} ms, over the {IMPORT_BUDGET_MS:.0f} ms budget')
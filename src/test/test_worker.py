@@ -0,0 +1,180 @@
+import io
+import json
+import tempfile
+import threading
+import time
+from unittest import TestCase, mock
+
+from botocore.exceptions import ClientError
+from psycopg2 import OperationalError
+
+import src.etl.s3 as s3_module
+from src.etl.config import CONFIG
+from src.etl.local_s3 import LocalS3Client
+from src.etl.queues import LocalQueue
+from src.etl.rds import RDS
+from src.worker import Worker
+
+
+def s3_message(key):
+    return json.dumps({'Records': [{'s3': {'bucket': {'name': 'bucket'}, 'object': {'key': key, 'size': 100}}}]})
+
+
+@mock.patch('src.etl.rds.execute_values')
+@mock.patch('src.etl.rds.connect')
+class TestWorker(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        client = LocalS3Client(self.root.name)
+        metadata = {
+            'URL': {'StringValue': 'https://some.net/api/call'}, 'API': {'StringValue': 'api'},
+            'Parameters': {'StringValue': '{}'}, 'StartTime': {'StringValue': '1580000000'},
+            'ResponseTime': {'StringValue': '1580000001'}, 'PID': {'StringValue': '1234'},
+            'ScriptName': {'StringValue': 'script'}, 'ResponseCode': {'StringValue': '200'},
+        }
+        self.keys = [f'body_{i:02d}.json' for i in range(5)]
+        for i, key in enumerate(self.keys):
+            content = 'not json' if i == 3 else json.dumps({'i': i})
+            client.put_object(Bucket='bucket', Key=key, Body=json.dumps({'metadata': metadata, 'content': content}))
+        s3_module._clients.clear()
+        self.config = [mock.patch.dict(CONFIG['aws'], {'s3-local-root': self.root.name}),
+                       mock.patch.dict(CONFIG['load'], {'dedup': False}),
+                       mock.patch('sys.stdout', new_callable=io.StringIO)]
+        self.out = [patch.start() for patch in self.config][-1]
+        self.queue = LocalQueue()
+
+    def tearDown(self):
+        for patch in self.config:
+            patch.stop()
+        s3_module._clients.clear()
+        self.root.cleanup()
+
+    def worker(self, mock_conn, **thresholds):
+        mock_conn.return_value.closed = 0
+        rds = RDS()
+        patch = mock.patch('src.worker.shared_rds', return_value=rds)
+        patch.start()
+        self.addCleanup(patch.stop)
+        return Worker(self.queue, **thresholds)
+
+    def flushes(self):
+        return [json.loads(line) for line in self.out.getvalue().splitlines() if '"Operation": "flush"' in line]
+
+    def test_flush_by_rows(self, mock_conn, mock_execute_values):
+        mock_execute_values.side_effect = lambda cursor, sql, rows, **kwargs: [(n, 1) for n in range(len(rows))]
+        worker = self.worker(mock_conn, max_rows=2, max_seconds=60)
+        for key in self.keys[:2]:
+            self.queue.put(s3_message(key))
+        worker.add(self.queue.receive(10))
+        self.assertEqual('rows', worker._due())
+        self.assertEqual(2, worker.flush(worker._due()))
+        _, _, rows = mock_execute_values.call_args[0]
+        self.assertEqual([{'i': 0}, {'i': 1}], [json.loads(row[-1]) for row in rows])
+        mock_conn.return_value.commit.assert_called_once()
+        self.assertEqual(2, len(self.queue.acked))
+        logged = self.flushes()[-1]
+        self.assertEqual(('rows', 2, 2, 2), (logged['reason'], logged['rows'], logged['inserted'], logged['acked']))
+        self.assertIn('flush_ms', logged)
+
+    def test_flush_by_bytes_and_seconds(self, mock_conn, mock_execute_values):
+        worker = self.worker(mock_conn, max_rows=100, max_bytes=1, max_seconds=60)
+        self.queue.put(s3_message(self.keys[0]))
+        worker.add(self.queue.receive(10))
+        self.assertEqual('bytes', worker._due())
+        worker = Worker(self.queue, max_rows=100, max_seconds=0.01)
+        self.assertIsNone(worker._due())
+        self.queue.put(s3_message(self.keys[1]))
+        worker.add(self.queue.receive(10))
+        time.sleep(0.02)
+        self.assertEqual('seconds', worker._due())
+
+    def test_acked_only_after_commit(self, mock_conn, mock_execute_values):
+        mock_execute_values.return_value = [(1, 1)]
+        acked_at_commit = []
+        mock_conn.return_value.commit.side_effect = lambda: acked_at_commit.append(len(self.queue.acked))
+        worker = self.worker(mock_conn)
+        self.queue.put(s3_message(self.keys[0]))
+        worker.add(self.queue.receive(10))
+        worker.flush()
+        self.assertEqual([0], acked_at_commit)
+        self.assertEqual(1, len(self.queue.acked))
+
+    def test_failed_flush_not_acked(self, mock_conn, mock_execute_values):
+        mock_execute_values.side_effect = OperationalError('connection lost')
+        worker = self.worker(mock_conn)
+        for key in self.keys[:2]:
+            self.queue.put(s3_message(key))
+        worker.add(self.queue.receive(10))
+        self.assertEqual(0, worker.flush())
+        mock_conn.return_value.rollback.assert_called_once()
+        self.assertEqual([], self.queue.acked)
+        self.assertEqual(2, len(self.queue.in_flight))
+        self.assertEqual(2, self.flushes()[-1]['failed'])
+
+    def test_bad_messages_left_for_redelivery(self, mock_conn, mock_execute_values):
+        mock_execute_values.side_effect = lambda cursor, sql, rows, **kwargs: [(n, 1) for n in range(len(rows))]
+        worker = self.worker(mock_conn)
+        for key in (self.keys[2], self.keys[3], 'missing.json'):
+            self.queue.put(s3_message(key))
+        self.queue.put('not an event')
+        worker.add(self.queue.receive(10))
+        self.assertEqual(1, worker.flush())
+        self.assertEqual(['message-1'], [message.id for message in self.queue.acked])
+        self.assertEqual(['message-2', 'message-3', 'message-4'],
+                         sorted(message.id for message in self.queue.in_flight))
+
+    def test_drains_when_stopped(self, mock_conn, mock_execute_values):
+        mock_execute_values.side_effect = lambda cursor, sql, rows, **kwargs: [(n, 1) for n in range(len(rows))]
+        worker = self.worker(mock_conn, max_rows=100, max_seconds=60)
+        with mock.patch('src.worker.SQS_MAX_WAIT', 0.05):
+            thread = threading.Thread(target=worker.run)
+            thread.start()
+            for key in self.keys[:3]:
+                self.queue.put(s3_message(key))
+            deadline = time.monotonic() + 5
+            while len(self.queue) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            worker.stop()
+            thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(3, len(self.queue.acked))
+        self.assertEqual('drain', self.flushes()[-1]['reason'])
+
+    @mock.patch('src.worker.backoff', return_value=0.001)
+    def test_backs_off_after_transient_failures(self, mock_backoff, mock_conn, mock_execute_values):
+        mock_execute_values.side_effect = lambda cursor, sql, rows, **kwargs: [(n, 1) for n in range(len(rows))]
+        worker = self.worker(mock_conn, max_rows=2, max_seconds=60)
+        rds = RDS()
+        receive = self.queue.receive
+        receive_errors = [ClientError({'Error': {'Code': 'ServiceUnavailable'}}, 'ReceiveMessage')]
+        rds_errors = [OperationalError('server closed the connection unexpectedly')]
+
+        def flaky_receive(*args):
+            if receive_errors:
+                raise receive_errors.pop()
+            return receive(*args)
+
+        def flaky_rds():
+            if rds_errors:
+                # as the messages become visible again once their visibility timeout passes
+                self.queue.release(self.queue.in_flight)
+                raise rds_errors.pop()
+            return rds
+
+        for key in self.keys[:2]:
+            self.queue.put(s3_message(key))
+        with mock.patch.object(self.queue, 'receive', flaky_receive), mock.patch('src.worker.shared_rds', flaky_rds), \
+                mock.patch('src.worker.SQS_MAX_WAIT', 0.05):
+            thread = threading.Thread(target=worker.run, daemon=True)
+            thread.start()
+            deadline = time.monotonic() + 5
+            while len(self.queue.acked) < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            worker.stop()
+            thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([1, 2], [call[0][0] for call in mock_backoff.call_args_list])
+        self.assertEqual(0, worker.failures)
+        self.assertEqual(2, len(self.queue.acked))
+        self.assertEqual(1, mock_execute_values.call_count)
@@ -0,0 +1,194 @@
+"""
+Loads captures from the S3 event messages of a queue in a long running
+process, rather than one Lambda invocation per capture.
+
+    python -m src.worker QUEUE_URL [--max-rows 100] [--max-bytes 67108864] [--max-seconds 5]
+                                   [--visibility-timeout 300]
+
+Captures are fetched and validated as their messages arrive and held until
+max rows or max bytes of them are held, or the oldest has been held for max
+seconds, then inserted in one transaction. Messages are acknowledged only
+once the transaction holding their captures has committed. Messages that
+fail are left for the queue to redeliver. When the database or SQS cannot
+be reached the worker backs off and tries again rather than exiting.
+SIGTERM or SIGINT stops the worker after the captures it holds have been
+flushed.
+"""
+import argparse
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+from botocore.exceptions import BotoCoreError, ClientError
+from psycopg2 import InterfaceError, OperationalError
+
+from .etl import metrics
+from .etl.config import CONFIG
+from .etl.event_processor import BatchTriggerEvent
+from .etl.queues import SQS_BATCH, SQS_MAX_WAIT, SqsQueue
+from .etl.rds import DatabaseUnavailable, backoff, discard_shared_rds, shared_rds
+
+log_level = os.getenv('LOG_LEVEL', logging.ERROR)
+logger = logging.getLogger(__name__)
+logger.setLevel(log_level)
+
+# failures of the database or of SQS that may pass, the worker waits and carries on after them
+TRANSIENT_ERRORS = (OperationalError, InterfaceError, DatabaseUnavailable, BotoCoreError, ClientError)
+
+
+class Worker:
+
+    def __init__(self, queue, max_rows=100, max_bytes=67108864, max_seconds=5.0):
+        self.queue = queue
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.size_limit = int(os.getenv('S3_OBJECT_SIZE_LIMIT', 150000000))
+        self.stopping = threading.Event()
+        # the messages being worked on by id, and those of them that have failed
+        self._messages = {}
+        self._failed = set()
+        # the (message id, datum, row) of each capture held, and those of captures already loaded
+        self._held = []
+        self._loaded = []
+        self._bytes = 0
+        self._oldest = None
+        self.flushes = 0
+        # the transient failures in a row, which the wait before carrying on grows with
+        self.failures = 0
+
+    def stop(self, *args):
+        self.stopping.set()
+
+    def run(self):
+        """ receives and loads messages until stopped, then flushes what is held """
+        while not self.stopping.is_set():
+            try:
+                self.poll()
+            except TRANSIENT_ERRORS as e:
+                self.failures += 1
+                delay = backoff(self.failures)
+                logger.warning(f'Waiting {delay:.1f}s after {self.failures} failures in a row: {repr(e)}')
+                self.stopping.wait(delay)
+            else:
+                self.failures = 0
+        self.flush('drain')
+
+    def poll(self):
+        """ receives messages, and flushes what is held when it is due """
+        messages = self.queue.receive(max(1, min(SQS_BATCH, self.max_rows - len(self._held))), self._wait())
+        if messages:
+            self.add(messages)
+        reason = self._due()
+        if reason:
+            self.flush(reason)
+
+    def _wait(self):
+        """ how long a receive may wait without holding captures past max seconds """
+        if self._oldest is None:
+            return SQS_MAX_WAIT
+        return max(0.0, min(SQS_MAX_WAIT, self._oldest + self.max_seconds - time.monotonic()))
+
+    def _due(self):
+        """ why what is held should be flushed now, None when it need not be """
+        if len(self._held) >= self.max_rows:
+            return 'rows'
+        if self._bytes >= self.max_bytes:
+            return 'bytes'
+        if self._oldest is not None and time.monotonic() - self._oldest >= self.max_seconds:
+            return 'seconds'
+        return None
+
+    def add(self, messages):
+        """
+        fetches and validates the captures of messages, holding those that are valid. when the database
+        cannot be reached none of the messages are held, they are redelivered once they are visible again
+        """
+        event = {'Records': [{'messageId': message.id, 'body': message.body} for message in messages]}
+        batch = BatchTriggerEvent(CONFIG['aws']['region'])
+        rds = shared_rds()
+        batch.extract(event, self.size_limit, rds.find_loaded_many if rds.dedup else None)
+        for message in messages:
+            self._messages[message.id] = message
+        for message_id, e in batch.failures:
+            logger.info(f'Failed to load message {message_id}: {repr(e)}')
+            self._failed.add(message_id)
+        self._loaded.extend(batch.duplicates)
+        for message_id, datum in batch.data:
+            try:
+                row = rds.batch_row(datum)
+            except Exception as e:
+                logger.info(f'Invalid capture in message {message_id}: {repr(e)}')
+                self._failed.add(message_id)
+                continue
+            self._held.append((message_id, datum, row))
+            self._bytes += len(datum.content)
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+
+    def flush(self, reason='drain'):
+        """
+        inserts the captures held in one transaction, then acknowledges every message
+        whose captures have all been loaded. returns the number of captures inserted
+        """
+        if not self._messages:
+            return 0
+        held, loaded, failed, messages = self._held, self._loaded, self._failed, self._messages
+        self._held, self._loaded, self._failed, self._messages = [], [], set(), {}
+        size, self._bytes, self._oldest = self._bytes, 0, None
+        inserted = 0
+        with metrics.invocation('flush'):
+            metrics.put_property('reason', reason)
+            metrics.put_property('rows', len(held))
+            metrics.put_property('bytes', size)
+            if held:
+                rds = None
+                try:
+                    rds = shared_rds()
+                    loads = [(datum.uuid, datum.content_hash) for _, datum, _ in held] if rds.dedup else None
+                    with metrics.stage('flush', size), rds.admitted():
+                        outcomes = rds.persist_rows([row for _, _, row in held], loads)
+                except Exception as e:
+                    logger.info(f'Failed to flush {len(held)} captures: {repr(e)}')
+                    if rds is not None and rds.conn.closed:
+                        discard_shared_rds()
+                    outcomes = [e] * len(held)
+                for (message_id, _, _), outcome in zip(held, outcomes):
+                    if isinstance(outcome, Exception):
+                        failed.add(message_id)
+                    else:
+                        inserted += 1
+            done = [message for message_id, message in messages.items() if message_id not in failed]
+            with metrics.stage('ack'):
+                unacknowledged = self.queue.ack(done) if done else []
+            metrics.put_property('inserted', inserted)
+            metrics.put_property('duplicates', len(loaded))
+            metrics.put_property('acked', len(done) - len(unacknowledged))
+            metrics.put_property('failed', len(failed))
+        self.flushes += 1
+        return inserted
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('queue_url')
+    parser.add_argument('--max-rows', type=int, default=100, help='captures held before they are flushed')
+    parser.add_argument('--max-bytes', type=int, default=67108864, help='content held before it is flushed')
+    parser.add_argument('--max-seconds', type=float, default=5.0, help='longest a capture is held before a flush')
+    parser.add_argument('--visibility-timeout', type=int,
+                        help='seconds a received message is hidden for, longer than a flush can take')
+    args = parser.parse_args(argv)
+
+    worker = Worker(SqsQueue(args.queue_url, visibility_timeout=args.visibility_timeout),
+                    args.max_rows, args.max_bytes, args.max_seconds)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    worker.run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())